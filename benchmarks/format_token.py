@@ -0,0 +1,116 @@
+"""Micro-benchmark for rendering token pair messages
+
+Compares the format_token from before templates were built once (baseline), filling in the templates (uncached) and
+a render cache hit (cached). Filling in the templates costs about what the baseline did, the gain is from the cache.
+
+Run from the project root with `python -m benchmarks.format_token`"""
+
+import os
+from timeit import repeat
+
+# Only the rendering code is loaded, so placeholder settings are enough
+for key, value in { "PORT": "0", "DB_PATH": ":memory:", "TELEGRAM_TOKEN": "", "SECRET_TOKEN": "", "BOT_WEB_URL": "" }.items():
+    os.environ.setdefault(key, value)
+
+from dexscreener import TokenPair
+
+from bot.utils import format_token, render_token
+
+
+def baseline_format_token(token: TokenPair, detailed = False) -> str:
+    """format_token as it was before templates were built once and rendered messages cached, kept as the baseline"""
+    try:
+        created = token.pair_created_at.strftime("%A, %B %d %Y %h:%M:%S %p")
+    except:
+        created = "Unknown"
+    finally:
+        chain = token.chain_id.title()
+        dex = token.dex_id.title()
+
+    text_format = (
+        f"⛓ Chain ID:  {chain}\n"
+        f"💱 DEX ID:  {dex}\n"
+        + ("🔗 Token Pair:  {token.base_token.symbol}/{token.quote_token.symbol}\n\n" if not detailed else "") +
+        "📍 Address:  {token.pair_address}\n\n"
+        f"🗓️ Created:  {created}\n\n"
+
+        "<b>Prices</b>\n"
+        "FDV:  {token.fdv:,} USD\n"
+        "USD Price:    {token.price_usd:.16f} USD\n"
+        "Native Price: {token.price_native:.16f} {token.quote_token.symbol}\n\n"
+
+    )
+
+    if detailed:
+        text_format += (
+            "<b>Base Token</b>\n"
+            "Name:    {token.base_token.name}\n"
+            "Symbol:  {token.base_token.symbol}\n"
+            "📍 Address: {token.base_token.address}\n\n"
+
+            "<b>Quote Token</b>\n"
+            "Name:    {token.quote_token.name}\n"
+            "Symbol:  {token.quote_token.symbol}\n"
+            "📍 Address: {token.quote_token.address}\n\n"
+
+            "<b>Liquidity</b>\n"
+            "USD:   {token.liquidity.usd:,}\n"
+            "Base:  {token.liquidity.base:,}\n"
+            "Quote: {token.liquidity.quote:,}\n\n"
+
+            "<b>Transactions</b>\n"
+            "5m:  {token.transactions.m5.buys:>8,} bought  {token.transactions.m5.sells:>8,} sold\n"
+            "1h:  {token.transactions.h1.buys:>8,} bought  {token.transactions.h1.sells:>8,} sold\n"
+            "6h:  {token.transactions.h6.buys:>8,} bought  {token.transactions.h6.sells:>8,} sold\n"
+            "24h: {token.transactions.h24.buys:>8,} bought  {token.transactions.h24.sells:>8,} sold\n\n"
+
+            "<b>Volume</b>\n"
+            "5m:   {token.volume.m5}\n"
+            "1h:   {token.volume.h1}\n"
+            "6h:   {token.volume.h6}\n"
+            "24h:  {token.volume.h24}\n\n"
+
+            "<b>Price Change</b>\n"
+            "5m:   {token.price_change.m5}\n"
+             "1h:   {token.price_change.h1}\n"
+            "6h:   {token.price_change.h6}\n"
+            "24h:  {token.price_change.h24}\n\n"
+
+        )
+
+    text_format += "URL: {token.url}"
+    text = text_format.format(token = token)
+    return text
+
+
+def sample_token() -> TokenPair:
+    periods = ("m5", "h1", "h6", "h24")
+    return TokenPair(**{
+        "chainId": "ethereum", "dexId": "uniswap", "url": "https://dexscreener.com/ethereum/0x0000",
+        "pairAddress": "0x0000", "priceNative": 60000.5, "priceUsd": 60001.25, "fdv": 1e9, "pairCreatedAt": 1600000000000,
+        "baseToken": { "address": "0x0001", "name": "Wrapped BTC", "symbol": "WBTC" },
+        "quoteToken": { "address": "0x0002", "name": "USD Coin", "symbol": "USDC" },
+        "txns": { period: { "buys": 100, "sells": 200 } for period in periods },
+        "volume": { period: 1e6 for period in periods },
+        "priceChange": { period: 1.5 for period in periods },
+        "liquidity": { "usd": 1e7, "base": 100, "quote": 6e6 },
+    })
+
+
+def measure(function, number: int = 20000) -> float:
+    """Returns the best per call time in microseconds"""
+    return min(repeat(function, number = number, repeat = 5)) / number * 1e6
+
+
+def main():
+    token = sample_token()
+    print(f"{'view':<10}{'baseline (us)':>16}{'uncached (us)':>16}{'cached (us)':>14}")
+    for detailed in (False, True):
+        baseline = measure(lambda: baseline_format_token(token, detailed))
+        uncached = measure(lambda: render_token(token, detailed))
+        cached = measure(lambda: format_token(token, detailed))
+        print(f"{'detailed' if detailed else 'short':<10}{baseline:>16.2f}{uncached:>16.2f}{cached:>14.2f}")
+
+
+if __name__ == "__main__":
+    main()
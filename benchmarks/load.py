@@ -0,0 +1,524 @@
+"""End-to-end load benchmark: replays webhook updates against the real app with Telegram and DexScreener faked locally
+
+The app runs in its own process, pointed at two local stand-in servers with configurable latency and error rates.
+Each simulated chat sends its updates one after another and waits for the reply, the latency of an update is the
+time from posting it to the webhook until its reply reaches the fake Telegram API.
+
+Run from the project root with `python -m benchmarks.load`, `--help` lists the options. A stream can be saved with
+`--save updates.jsonl` and replayed with `--replay updates.jsonl`, recorded updates work as well, one per line."""
+
+import os
+import sys
+import json
+import socket
+import random
+import argparse
+from hashlib import sha1
+from pathlib import Path
+from tempfile import mkdtemp
+from collections import Counter, deque
+from time import monotonic, time
+from asyncio import Future, Semaphore, create_subprocess_exec, gather, get_running_loop, run, sleep, subprocess, wait_for
+
+from aiohttp import ClientSession, ClientTimeout, web
+
+
+ROOT = Path(__file__).resolve().parent.parent
+SECRET_TOKEN = "benchmark"
+BOT_TOKEN = "1:benchmark"
+# Telegram methods whose call is the reply to an update
+REPLY_METHODS = {"sendMessage", "editMessageText", "sendDocument", "sendPhoto"}
+# Telegram's own limits would measure the rate limiter rather than the bot, they are lifted unless overridden
+APP_ENV = {
+    "WORKERS": "1",
+    "LOG_LEVEL": "warning",
+    "SEND_GLOBAL_RATE": "1000000",
+    "SEND_CHAT_RATE": "1000000",
+    "SEND_CHAT_BURST": "1000000",
+    "SEND_GROUP_RATE": "1000000",
+    "UPSTREAM_RATE_LIMIT": "1000000",
+    "UPSTREAM_BURST": "1000000",
+    "UPSTREAM_BACKOFF": "0.05",
+}
+
+CHAINS = ("ethereum", "bsc", "solana", "base")
+QUERIES = ("WBTC", "PEPE", "USDC", "DOGE", "SHIB", "BONK", "WIF", "LINK", "UNI", "ARB", "OP", "TON", "WETH", "FLOKI", "MOG")
+
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def percentile(values: list[float], percent: float) -> float:
+    """Nearest rank percentile of sorted values"""
+    if not values:
+        return 0.0
+    return values[max(0, min(len(values) - 1, round(percent / 100 * len(values) + 0.5) - 1))]
+
+
+def callback_data(pattern: str, value: str | int, text: str) -> str:
+    # The inline form bot/callbacks.py gives buttons whose text fits
+    return f"{pattern}:{value}:={text}"
+
+
+def pair_address(seed: str) -> str:
+    return "0x" + sha1(seed.encode()).hexdigest()
+
+
+
+class FakeServer:
+    """A local stand-in for an API, sleeping for about `latency` seconds per call and failing `error_rate` of them"""
+
+    def __init__(self, latency: float, error_rate: float, seed: int) -> None:
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.calls: Counter[str] = Counter()
+        self.errors: Counter[str] = Counter()
+        self.runner: web.AppRunner | None = None
+        self.url = ""
+
+    async def delay(self, name: str, inject_errors: bool = True) -> bool:
+        """Counts and delays a call, returns True if it should fail"""
+        self.calls[name] += 1
+        if self.latency:
+            await sleep(self.latency * self.random.uniform(0.5, 1.5))
+        if inject_errors and self.random.random() < self.error_rate:
+            self.errors[name] += 1
+            return True
+        return False
+
+    def routes(self) -> list[web.RouteDef]:
+        raise NotImplementedError
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.add_routes(self.routes())
+        self.runner = web.AppRunner(app, access_log = None)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, "127.0.0.1", 0)
+        await site.start()
+        self.url = "http://127.0.0.1:{}".format(site._server.sockets[0].getsockname()[1])
+
+    async def close(self) -> None:
+        if self.runner is not None:
+            await self.runner.cleanup()
+
+
+
+class FakeDexScreener(FakeServer):
+    """Answers searches and pair lookups with made up but well formed pairs, the same request always gets the same pairs"""
+
+    search_results = 30
+
+    @staticmethod
+    def pair(chain: str, address: str, symbol: str) -> dict:
+        rng = random.Random(address)
+        periods = ("m5", "h1", "h6", "h24")
+        price = rng.uniform(0.0001, 70000)
+        return {
+            "chainId": chain, "dexId": rng.choice(("uniswap", "pancakeswap", "raydium", "stonfi")),
+            "url": f"https://dexscreener.com/{chain}/{address}", "pairAddress": address,
+            "priceNative": price / 3000, "priceUsd": price, "fdv": rng.uniform(1e5, 1e10),
+            "pairCreatedAt": int((time() - rng.uniform(3600, 3e7)) * 1000),
+            "baseToken": { "address": pair_address(symbol), "name": symbol.title(), "symbol": symbol },
+            "quoteToken": { "address": pair_address("USDC"), "name": "USD Coin", "symbol": "USDC" },
+            "txns": { period: { "buys": rng.randint(0, 5000), "sells": rng.randint(0, 5000) } for period in periods },
+            "volume": { period: rng.uniform(0, 1e7) for period in periods },
+            "priceChange": { period: rng.uniform(-50, 50) for period in periods },
+            "liquidity": { "usd": rng.uniform(1e3, 1e8), "base": rng.uniform(1, 1e6), "quote": rng.uniform(1, 1e6) },
+        }
+
+    def failure(self) -> web.Response:
+        return web.json_response({ "error": "injected" }, status = 503)
+
+
+    async def search(self, request: web.Request) -> web.Response:
+        if await self.delay("search"):
+            return self.failure()
+        query = request.query.get("q", "")
+        symbol = query.split()[0].upper() if query else "TOKEN"
+        pairs = [ self.pair(CHAINS[i % len(CHAINS)], pair_address(f"{query}:{i}"), symbol) for i in range(self.search_results) ]
+        return web.json_response({ "schemaVersion": "1.0.0", "pairs": pairs })
+
+    async def pairs(self, request: web.Request) -> web.Response:
+        if await self.delay("pairs"):
+            return self.failure()
+        chain = request.match_info["chain"]
+        pairs = [ self.pair(chain, address, "PAIR") for address in request.match_info["addresses"].split(",") ]
+        return web.json_response({ "schemaVersion": "1.0.0", "pairs": pairs, "pair": pairs[0] if pairs else None })
+
+    async def tokens(self, request: web.Request) -> web.Response:
+        if await self.delay("tokens"):
+            return self.failure()
+        address = request.match_info["address"]
+        pairs = [ self.pair(CHAINS[i % len(CHAINS)], pair_address(f"{address}:{i}"), "TOKEN") for i in range(5) ]
+        return web.json_response({ "schemaVersion": "1.0.0", "pairs": pairs })
+
+    def routes(self) -> list[web.RouteDef]:
+        return [
+            web.get("/latest/dex/search", self.search),
+            web.get("/latest/dex/pairs/{chain}/{addresses}", self.pairs),
+            web.get("/latest/dex/tokens/{address}", self.tokens),
+        ]
+
+
+
+class FakeTelegram(FakeServer):
+    """Answers Bot API calls and tells the waiting chat when a reply arrives. Errors are only injected into replies,
+    so the app can always start."""
+
+    def __init__(self, latency: float, error_rate: float, seed: int) -> None:
+        super().__init__(latency, error_rate, seed)
+        self.message_id = 0
+        # Per chat, the futures of updates waiting for their reply, oldest first
+        self.waiting: dict[int, deque[Future]] = {}
+
+    def expect(self, chat_id: int) -> Future:
+        future = get_running_loop().create_future()
+        self.waiting.setdefault(chat_id, deque()).append(future)
+        return future
+
+    def replied(self, chat_id: int) -> None:
+        waiting = self.waiting.get(chat_id)
+        while waiting:
+            future = waiting.popleft()
+            if not future.done():
+                future.set_result(monotonic())
+                return
+
+
+    async def call(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        if request.content_type == "application/json":
+            params = await request.json()
+        else:
+            # PTB sends form fields whose non string values are JSON encoded
+            params = dict(await request.post())
+
+        if await self.delay(method, inject_errors = method in REPLY_METHODS):
+            return web.json_response({ "ok": False, "error_code": 500, "description": "Internal Server Error: injected" }, status = 500)
+
+        if method == "getMe":
+            result = { "id": 1, "is_bot": True, "first_name": "Benchmark", "username": "benchmark_bot" }
+        elif method == "getWebhookInfo":
+            result = { "url": "", "has_custom_certificate": False, "pending_update_count": 0 }
+        elif method in REPLY_METHODS and "chat_id" in params:
+            chat_id = int(params["chat_id"])
+            self.message_id += 1
+            result = {
+                "message_id": self.message_id, "date": int(time()), "text": str(params.get("text", "")),
+                "chat": { "id": chat_id, "type": "private" }, "from": { "id": 1, "is_bot": True, "first_name": "Benchmark" },
+            }
+            self.replied(chat_id)
+        else:
+            result = True
+        return web.json_response({ "ok": True, "result": result })
+
+    def routes(self) -> list[web.RouteDef]:
+        return [ web.post("/bot{token}/{method}", self.call) ]
+
+
+
+class UpdateStream:
+    """Builds the updates a simulated user sends: a search, page flips, a pair lookup, the details toggle and pair lists"""
+
+    def __init__(self, seed: int) -> None:
+        self.random = random.Random(seed)
+        self.update_id = 0
+
+    def next_id(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    def message(self, chat_id: int, text: str) -> dict:
+        update_id = self.next_id()
+        return {
+            "update_id": update_id,
+            "message": {
+                "message_id": update_id, "date": int(time()), "text": text,
+                "chat": { "id": chat_id, "type": "private" }, "from": { "id": chat_id, "is_bot": False, "first_name": "User" },
+            },
+        }
+
+    def callback(self, chat_id: int, data: str) -> dict:
+        update_id = self.next_id()
+        return {
+            "update_id": update_id,
+            "callback_query": {
+                "id": str(update_id), "chat_instance": str(chat_id), "data": data,
+                "from": { "id": chat_id, "is_bot": False, "first_name": "User" },
+                "message": {
+                    "message_id": update_id, "date": int(time()), "text": "",
+                    "chat": { "id": chat_id, "type": "private" }, "from": { "id": 1, "is_bot": True, "first_name": "Benchmark" },
+                },
+            },
+        }
+
+
+    def session(self, chat_id: int, actions: int) -> list[dict]:
+        """A user session, popular queries and pairs are picked more often so caches see a realistic mix"""
+        updates = []
+        while len(updates) < actions:
+            # Squaring the draw favours the start of the list
+            query = QUERIES[int(self.random.random() ** 2 * len(QUERIES))]
+            chain = self.random.choice(CHAINS)
+            address = pair_address(f"{query}:{int(self.random.random() ** 2 * 20)}")
+            choice = self.random.random()
+
+            if choice < 0.5:
+                updates.append(self.message(chat_id, query))
+                for page in range(2, 2 + self.random.randint(0, 3)):
+                    updates.append(self.callback(chat_id, callback_data("token", page, query)))
+            elif choice < 0.85:
+                updates.append(self.message(chat_id, f"{chain} {address}"))
+                for details in ("more", "less")[:self.random.randint(0, 2)]:
+                    updates.append(self.callback(chat_id, callback_data("details", details, f"{chain} {address}")))
+            else:
+                addresses = ",".join(pair_address(f"{query}:{i}") for i in range(self.random.randint(2, 6)))
+                updates.append(self.message(chat_id, f"{chain} {addresses}"))
+        return updates[:actions]
+
+
+    @staticmethod
+    def kind(update: dict) -> str:
+        """Names the kind of an update for the report"""
+        if "callback_query" in update:
+            return { "token": "page", "details": "details", "pairs": "pairs page" }.get(update["callback_query"].get("data", "").split(":")[0], "callback")
+        text = (update.get("message") or {}).get("text", "")
+        words = text.split(" ")
+        if text.startswith("/"):
+            return "command"
+        if len(words) == 2:
+            return "pairs" if "," in words[1] else "pair"
+        return "search"
+
+    @staticmethod
+    def chat_id(update: dict) -> int | None:
+        for key in ("message", "edited_message"):
+            if key in update:
+                return update[key]["chat"]["id"]
+        if "callback_query" in update:
+            return update["callback_query"]["message"]["chat"]["id"]
+        return None
+
+
+
+class LoadReplay:
+    """Posts each chat's updates in order, waiting for the reply to one before sending the next"""
+
+    def __init__(self, webhook_url: str, telegram: FakeTelegram, concurrency: int, think: float, timeout: float) -> None:
+        self.webhook_url = webhook_url
+        self.telegram = telegram
+        self.concurrency = concurrency
+        self.think = think
+        self.timeout = timeout
+        self.latencies: dict[str, list[float]] = {}
+        self.timeouts = 0
+        self.rejected = 0
+        self.sent = 0
+
+
+    async def post(self, session: ClientSession, update: dict) -> bool:
+        """Posts an update, retrying like Telegram does while the app asks to back off"""
+        for _ in range(20):
+            async with session.post(self.webhook_url, json = update, headers = { "X-Telegram-Bot-Api-Secret-Token": SECRET_TOKEN }) as response:
+                if response.status < 300:
+                    return True
+                if response.status != 503:
+                    return False
+                self.rejected += 1
+                await sleep(float(response.headers.get("Retry-After", 1)))
+        return False
+
+
+    async def chat(self, session: ClientSession, semaphore: Semaphore, chat_id: int, updates: list[dict]) -> None:
+        async with semaphore:
+            for update in updates:
+                kind = UpdateStream.kind(update)
+                replied = self.telegram.expect(chat_id)
+                started = monotonic()
+                self.sent += 1
+                try:
+                    if not await self.post(session, update):
+                        replied.cancel()
+                        continue
+                    finished = await wait_for(replied, self.timeout)
+                except TimeoutError:
+                    self.timeouts += 1
+                    continue
+                self.latencies.setdefault(kind, []).append(finished - started)
+                if self.think:
+                    await sleep(self.think)
+
+
+    async def run(self, chats: dict[int, list[dict]]) -> float:
+        """Replays every chat, returns the wall time it took"""
+        semaphore = Semaphore(self.concurrency)
+        started = monotonic()
+        async with ClientSession(timeout = ClientTimeout(total = self.timeout)) as session:
+            await gather(*(self.chat(session, semaphore, chat_id, updates) for chat_id, updates in chats.items()))
+        return monotonic() - started
+
+
+
+async def start_app(dexscreener: FakeDexScreener, telegram: FakeTelegram, overrides: dict[str, str], log_path: Path) -> tuple[subprocess.Process, str]:
+    port = free_port()
+    env = os.environ | APP_ENV | {
+        "PORT": str(port),
+        "HOST": "127.0.0.1",
+        "DB_PATH": str(log_path.parent / "benchmark.db"),
+        "TELEGRAM_TOKEN": BOT_TOKEN,
+        "SECRET_TOKEN": SECRET_TOKEN,
+        "BOT_WEB_URL": f"http://127.0.0.1:{port}",
+        "DEXSCREENER_URL": dexscreener.url,
+        "TELEGRAM_API_URL": f"{telegram.url}/bot",
+        "PYTHONPATH": str(ROOT),
+    } | overrides
+
+    log = open(log_path, "wb")
+    process = await create_subprocess_exec(sys.executable, "server.py", cwd = ROOT, env = env, stdout = log, stderr = subprocess.STDOUT)
+    url = f"http://127.0.0.1:{port}"
+
+    # Wait for the health check, the lifespan has finished once it answers
+    async with ClientSession(timeout = ClientTimeout(total = 1)) as session:
+        deadline = monotonic() + 60
+        while monotonic() < deadline:
+            if process.returncode is not None:
+                break
+            try:
+                async with session.get(url + env.get("HEALTH_URL", "/health/")) as response:
+                    if response.status < 300:
+                        return process, url
+            except OSError:
+                pass
+            await sleep(0.2)
+
+    process.kill()
+    raise RuntimeError(f"The app didn't start, see {log_path}")
+
+
+async def stop_app(process: subprocess.Process) -> None:
+    if process.returncode is None:
+        # SIGINT lets uvicorn run the shutdown side of the lifespan
+        process.send_signal(2)
+        try:
+            await wait_for(process.wait(), 15)
+        except TimeoutError:
+            process.kill()
+
+
+def load_chats(args: argparse.Namespace) -> dict[int, list[dict]]:
+    if args.replay:
+        chats: dict[int, list[dict]] = {}
+        with open(args.replay) as file:
+            for line in file:
+                if line.strip():
+                    update = json.loads(line)
+                    chats.setdefault(UpdateStream.chat_id(update), []).append(update)
+        chats.pop(None, None)
+        return chats
+
+    stream = UpdateStream(args.seed)
+    chats = { 1000 + i: stream.session(1000 + i, args.actions) for i in range(args.users) }
+    if args.save:
+        with open(args.save, "w") as file:
+            for updates in chats.values():
+                file.writelines(json.dumps(update) + "\n" for update in updates)
+    return chats
+
+
+def report(replay: LoadReplay, wall: float, dexscreener: FakeDexScreener, telegram: FakeTelegram) -> dict:
+    everything = sorted(value for values in replay.latencies.values() for value in values)
+    summary = {
+        "sent": replay.sent,
+        "completed": len(everything),
+        "timeouts": replay.timeouts,
+        "rejected": replay.rejected,
+        "seconds": wall,
+        "throughput": len(everything) / wall if wall else 0,
+        "latency": {},
+        "dexscreener_calls": dict(dexscreener.calls),
+        "dexscreener_errors": dict(dexscreener.errors),
+        "telegram_calls": dict(telegram.calls),
+        "telegram_errors": dict(telegram.errors),
+    }
+    for kind, values in sorted(replay.latencies.items()) + [("all", everything)]:
+        values = sorted(values)
+        summary["latency"][kind] = { "count": len(values), **{ f"p{p}": percentile(values, p) for p in (50, 95, 99) } }
+    return summary
+
+
+def print_report(summary: dict) -> None:
+    print(f"{summary['completed']} of {summary['sent']} updates answered in {summary['seconds']:.2f}s, "
+          f"{summary['throughput']:.1f} updates/s, {summary['timeouts']} timed out, {summary['rejected']} rejected by the webhook")
+    print()
+    print(f"{'update':<12}{'count':>8}{'p50 (ms)':>12}{'p95 (ms)':>12}{'p99 (ms)':>12}")
+    for kind, latency in summary["latency"].items():
+        print(f"{kind:<12}{latency['count']:>8}{latency['p50'] * 1000:>12.1f}{latency['p95'] * 1000:>12.1f}{latency['p99'] * 1000:>12.1f}")
+    print()
+
+    calls = sum(summary["dexscreener_calls"].values())
+    per_update = calls / summary["completed"] if summary["completed"] else 0
+    print(f"DexScreener calls: {calls} ({per_update:.3f} per update)")
+    for name, count in sorted(summary["dexscreener_calls"].items()):
+        print(f"  {name:<10}{count:>8}  ({summary['dexscreener_errors'].get(name, 0)} failed)")
+    print("Telegram calls:")
+    for name, count in sorted(summary["telegram_calls"].items()):
+        print(f"  {name:<22}{count:>8}  ({summary['telegram_errors'].get(name, 0)} failed)")
+
+
+async def benchmark(args: argparse.Namespace) -> dict:
+    dexscreener = FakeDexScreener(args.upstream_latency, args.upstream_errors, args.seed)
+    telegram = FakeTelegram(args.telegram_latency, args.telegram_errors, args.seed + 1)
+    chats = load_chats(args)
+    overrides = dict(item.split("=", 1) for item in args.env)
+
+    await dexscreener.start()
+    await telegram.start()
+    log_path = Path(mkdtemp(prefix = "dex-sentinel-load-")) / "app.log"
+    try:
+        process, url = await start_app(dexscreener, telegram, overrides, log_path)
+        try:
+            replay = LoadReplay(url + overrides.get("WEBHOOK_URL", "/webhook/"), telegram, args.concurrency, args.think, args.timeout)
+            wall = await replay.run(chats)
+        finally:
+            await stop_app(process)
+    finally:
+        await dexscreener.close()
+        await telegram.close()
+
+    print(f"App log: {log_path}", file = sys.stderr)
+    return report(replay, wall, dexscreener, telegram)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = __doc__.splitlines()[0])
+    parser.add_argument("--users", type = int, default = 200, help = "simulated chats")
+    parser.add_argument("--actions", type = int, default = 10, help = "updates sent by each chat")
+    parser.add_argument("--concurrency", type = int, default = 50, help = "chats active at the same time")
+    parser.add_argument("--think", type = float, default = 0, help = "seconds a chat waits after each reply")
+    parser.add_argument("--timeout", type = float, default = 10, help = "seconds to wait for a reply")
+    parser.add_argument("--upstream-latency", type = float, default = 0.15, help = "mean DexScreener latency in seconds")
+    parser.add_argument("--upstream-errors", type = float, default = 0.0, help = "share of DexScreener calls which fail")
+    parser.add_argument("--telegram-latency", type = float, default = 0.05, help = "mean Bot API latency in seconds")
+    parser.add_argument("--telegram-errors", type = float, default = 0.0, help = "share of replies the Bot API fails")
+    parser.add_argument("--replay", help = "JSON lines file of updates to send instead of a synthetic stream")
+    parser.add_argument("--save", help = "write the synthetic stream to this JSON lines file")
+    parser.add_argument("--env", action = "append", default = [], metavar = "NAME=VALUE", help = "setting passed to the app, repeatable")
+    parser.add_argument("--seed", type = int, default = 1)
+    parser.add_argument("--json", action = "store_true", help = "print the summary as JSON")
+    args = parser.parse_args()
+
+    summary = run(benchmark(args))
+    if args.json:
+        print(json.dumps(summary, indent = 2))
+    else:
+        print_report(summary)
+
+
+if __name__ == "__main__":
+    main()
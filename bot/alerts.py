@@ -0,0 +1,211 @@
+"""Polls every watched pair once per interval and alerts users when a watched value crosses their threshold"""
+
+from __future__ import annotations
+
+from asyncio import Task, create_task, gather, sleep
+from html import escape as html_escape
+
+from typing import TYPE_CHECKING
+from telegram import Bot as TelegramBot
+from telegram.constants import ParseMode
+
+from .filters import TokenFilter, OPERATORS
+from .ratelimit import SendPriority
+from .upstream import MAX_PAIRS_PER_REQUEST
+from .keyboards import TokenDetailsKeyboard, TokenPaginationKeyboard
+from .index import get_token_index
+from storage import get_storage
+from settings import get_settings, get_logger
+
+# Only needed for annotations, dexscreener is imported when the first response is parsed
+if TYPE_CHECKING:
+    from dexscreener import TokenPair
+
+
+storage = get_storage()
+token_index = get_token_index()
+settings = get_settings()
+logger = get_logger(__name__)
+
+# Fields a watch can compare, age only ever grows so it isn't useful for alerts
+WATCH_FIELDS = tuple(name for name in TokenFilter.fields if name != "age")
+
+
+
+class Watch:
+    __slots__ = ("watch_id", "user_id", "chat_id", "chain", "address", "field", "op", "threshold")
+
+    def __init__(self, watch_id: int, user_id: int, chat_id: int, chain: str, address: str, field: str, op: str, threshold: float) -> None:
+        self.watch_id = watch_id
+        self.user_id = user_id
+        self.chat_id = chat_id
+        self.chain = chain
+        self.address = address
+        self.field = field
+        self.op = op
+        self.threshold = threshold
+
+    @property
+    def pair_key(self) -> tuple[str, str]:
+        # Same key as the pair cache, the address keeps its case since some chains have case sensitive addresses
+        return (self.chain, self.address)
+
+    def holds(self, token: TokenPair | None) -> bool | None:
+        """If the watched condition holds for a snapshot, None if the snapshot has no value for the field"""
+        value = TokenFilter.fields[self.field](token) if token is not None else None
+        return None if value is None else OPERATORS[self.op](value, self.threshold)
+
+    def describe(self) -> str:
+        return f"#{self.watch_id} {self.chain} {self.address} {self.field}{self.op}{self.threshold:g}"
+
+
+
+class WatchPoller:
+    """Keeps every watch in memory grouped by pair, so a pair watched by many users is fetched once per interval.
+    Each poll is compared with the previous snapshot of the pair and a watch alerts when its condition starts holding.
+    With several workers only the one holding the watches lease polls, and it reloads the watches every worker saved."""
+
+    lease = "watches"
+
+    def __init__(self, bot: TelegramBot, interval: float = settings.WATCH_INTERVAL) -> None:
+        self.bot = bot
+        self.interval = interval
+        self.watches: dict[int, Watch] = {}
+        self.pairs: dict[tuple[str, str], set[int]] = {}
+        self.snapshots: dict[tuple[str, str], TokenPair | None] = {}
+        self.task: Task | None = None
+
+        self.polls = 0
+        self.alerts = 0
+
+
+    def add(self, watch: Watch) -> None:
+        self.watches[watch.watch_id] = watch
+        self.pairs.setdefault(watch.pair_key, set()).add(watch.watch_id)
+
+    def remove(self, watch_id: int) -> None:
+        watch = self.watches.pop(watch_id, None)
+        if watch is None:
+            return
+
+        watch_ids = self.pairs[watch.pair_key]
+        watch_ids.discard(watch_id)
+        if not watch_ids:
+            # Nobody watches the pair any more, stop polling it
+            del self.pairs[watch.pair_key]
+            self.snapshots.pop(watch.pair_key, None)
+
+
+    async def fetch(self) -> dict[tuple[str, str], TokenPair | None]:
+        """Fetches every watched pair, grouped by chain in as few requests as the API allows"""
+        chains: dict[str, list[str]] = {}
+        for chain, address in self.pairs:
+            chains.setdefault(chain, []).append(address)
+
+        requests = [
+            (chain, addresses[i:i+MAX_PAIRS_PER_REQUEST])
+            for chain, addresses in chains.items() for i in range(0, len(addresses), MAX_PAIRS_PER_REQUEST)
+        ]
+        results = await gather(*(TokenPaginationKeyboard.client.get_token_pair_list_async(chain, chunk) for chain, chunk in requests), return_exceptions = True)
+
+        snapshot = {}
+        for (chain, chunk), tokens in zip(requests, results):
+            if isinstance(tokens, Exception):
+                logger.warning(f"Failed to poll {len(chunk)} watched pairs on {chain}: {tokens!r}")
+                continue
+
+            token_index.add(tokens, tokens.fetched)
+            # EVM addresses may come back in a different case than they were sent in
+            found = { token.pair_address.lower(): token for token in tokens }
+            for address in chunk:
+                snapshot[(chain, address)] = found.get(address.lower())
+        return snapshot
+
+
+    async def poll(self) -> None:
+        """Fetches a snapshot of every watched pair and alerts the watches whose condition just started holding"""
+        if not self.pairs:
+            return
+
+        self.polls += 1
+        snapshot = await self.fetch()
+        alerts = []
+        for key, token in snapshot.items():
+            previous = self.snapshots.get(key)
+            self.snapshots[key] = token
+            if token is not None:
+                # Fresh data for free, /pair and the details toggle can use it
+                TokenDetailsKeyboard.cache.set(key, token)
+
+            # The first snapshot of a pair is only a baseline, there is nothing to compare it with yet
+            if previous is None or token is None:
+                continue
+
+            for watch_id in self.pairs.get(key, ()):
+                watch = self.watches[watch_id]
+                if watch.holds(token) and watch.holds(previous) is False:
+                    alerts.append((watch, token))
+
+        await gather(*(self.alert(watch, token) for watch, token in alerts))
+
+
+    async def alert(self, watch: Watch, token: TokenPair) -> None:
+        value = TokenFilter.fields[watch.field](token)
+        text = (
+            f"🔔 <b>{html_escape(token.base_token.symbol)}/{html_escape(token.quote_token.symbol)}</b> {watch.field} is now {value:,.8g}\n"
+            f"Watch {html_escape(watch.describe())}\n"
+            f"{token.url}"
+        )
+        try:
+            await self.bot.send_message(chat_id = watch.chat_id, text = text, parse_mode = ParseMode.HTML, rate_limit_args = SendPriority.BROADCAST)
+            self.alerts += 1
+        except Exception:
+            logger.exception(f"Failed to send alert for watch {watch.watch_id}")
+
+
+    async def reload(self) -> None:
+        """Replaces the watches with the saved ones, keeping the snapshots of pairs which are still watched"""
+        snapshots = self.snapshots
+        self.watches, self.pairs, self.snapshots = {}, {}, {}
+        for row in await storage.run(storage.get_watches):
+            self.add(Watch(**row))
+        self.snapshots = { key: value for key, value in snapshots.items() if key in self.pairs }
+
+
+    async def poll_periodically(self) -> None:
+        while True:
+            try:
+                if settings.WORKERS > 1:
+                    # The lease outlives a few intervals, so another worker takes over if this one stops renewing it
+                    if not await storage.run(storage.acquire_lease, self.lease, self.interval * 3):
+                        # Start from a fresh baseline if this worker takes over later
+                        self.snapshots.clear()
+                        await sleep(self.interval)
+                        continue
+                    await self.reload()
+                await self.poll()
+            except Exception:
+                logger.exception("Failed to poll watched pairs")
+            await sleep(self.interval)
+
+
+    async def start(self) -> None:
+        """Loads the saved watches and starts polling, called from the app lifespan"""
+        await self.reload()
+
+        if self.task is None:
+            self.task = create_task(self.poll_periodically())
+
+    async def close(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+
+
+    def stats(self) -> dict:
+        return {
+            "watches": len(self.watches),
+            "pairs": len(self.pairs),
+            "polls": self.polls,
+            "alerts": self.alerts,
+        }
@@ -1,19 +1,39 @@
-from json import dumps
-from traceback import format_exception
+from typing import Iterable
+from asyncio import Queue, gather
+from functools import partial
+from datetime import datetime
 from html import escape as html_escape
 
 from telegram.constants import ParseMode
 from telegram import BotCommand, Update
 from telegram.ext import filters, Application, CommandHandler, MessageHandler, ContextTypes, CallbackContext
 
-from .utils import format_token
+from .utils import format_token, render_cache
+from .callbacks import CallbackData
+from .errors import ErrorReporter
+from .filters import TokenFilter
+from .alerts import Watch, WatchPoller, WATCH_FIELDS
+from .prefetch import get_prefetcher
+from .inline import InlineSearch
+from .index import get_token_index
+from .webhook import WebhookIngestor
+from .processor import ChatOrderedUpdateProcessor
+from .ratelimit import SendPriority, SendScheduler
 from settings import get_settings, get_logger
-from storage import get_storage, DatabaseTables
-from .keyboards import TokenPaginationKeyboard, TokenDetailsKeyboard
+from storage import get_storage
+from startup import fingerprint, get_startup_timer
+from metrics import Sample, get_metrics
+from profiler import Profile, get_profiler
+from .keyboards import TokenPaginationKeyboard, TokenDetailsKeyboard, PairListKeyboard
 
 
 storage = get_storage()
 settings = get_settings()
+prefetcher = get_prefetcher()
+token_index = get_token_index()
+timer = get_startup_timer()
+metrics = get_metrics()
+profiler = get_profiler()
 logger = get_logger(__name__)
 
 
@@ -29,13 +49,18 @@ class BotContext(CallbackContext):
 
 
 async def log_in_channels(text: str, context: BotContext):
-    for chat_id in settings.LOG_CHAT_IDS:
-        await context.bot.send_message(chat_id = chat_id, text = text, parse_mode = ParseMode.HTML)
+    # Sent to every chat at once, the send scheduler keeps them within the flood limits behind user replies
+    await gather(*(
+        context.bot.send_message(chat_id = chat_id, text = text, parse_mode = ParseMode.HTML, rate_limit_args = SendPriority.LOG)
+        for chat_id in settings.LOG_CHAT_IDS
+    ))
 
 
 async def send_to_developers(text: str, context: BotContext):
-    for chat_id in settings.DEVELOPER_CHAT_IDS:
-        await context.bot.send_message(chat_id = chat_id, text = text, parse_mode = ParseMode.HTML)
+    await gather(*(
+        context.bot.send_message(chat_id = chat_id, text = text, parse_mode = ParseMode.HTML, rate_limit_args = SendPriority.LOG)
+        for chat_id in settings.DEVELOPER_CHAT_IDS
+    ))
 
 
 class Bot:
@@ -44,79 +69,138 @@ class Bot:
 
         # Set updater to None so updates are handled by webhook
         context_types = ContextTypes(context = BotContext)
-        self.application = Application.builder().token(bot_token).updater(None).context_types(context_types).build()
+        # Bounded so the webhook refuses updates instead of buffering them without limit when handlers fall behind
+        update_queue = Queue(maxsize = settings.UPDATE_QUEUE_SIZE)
+        # Updates of different chats run concurrently, updates of one chat stay in order so their stored query state isn't mixed up
+        self.update_processor = ChatOrderedUpdateProcessor(settings.UPDATE_CONCURRENCY, settings.UPDATE_QUEUE_SIZE, settings.UPDATE_QUEUE_SIZE)
+        self.send_scheduler = SendScheduler()
+        self.application = (
+            Application.builder().token(bot_token).base_url(settings.TELEGRAM_API_URL).updater(None).update_queue(update_queue)
+            .concurrent_updates(self.update_processor).rate_limiter(self.send_scheduler).context_types(context_types).build()
+        )
+        self.ingestor = WebhookIngestor(self.application.bot, self.application.update_queue, self.update_processor)
+        self.error_reporter = ErrorReporter()
+        self.watch_poller = WatchPoller(self.application.bot)
+        self.inline_search = InlineSearch()
+        metrics.register(self.collect_metrics)
 
 
     async def setup(self, secret_token: str, bot_web_url: str) -> None:
         # Set webhook url and secret_key
-        await self.application.bot.set_webhook(url = bot_web_url, secret_token = secret_token)
-        await self.set_bot_commands_menu()
+        with timer.stage("webhook"):
+            await self.register("webhook", (bot_web_url, secret_token), self.application.bot.set_webhook, url = bot_web_url, secret_token = secret_token)
+        with timer.stage("commands"):
+            await self.set_bot_commands_menu()
 
         # Add handlers here
         self.application.add_error_handler(self.handle_error)
+        self.error_reporter.start(self.application.bot)
 
         self.application.add_handler( CommandHandler("start", self.cmd_start) )
         self.application.add_handler( CommandHandler("help", self.cmd_help) )
         self.application.add_handler( CommandHandler("about", self.cmd_about) )
+        self.application.add_handler( CommandHandler("watch", self.cmd_watch) )
+        self.application.add_handler( CommandHandler("unwatch", self.cmd_unwatch) )
+        self.application.add_handler( CommandHandler("watches", self.cmd_watches) )
+        # Left out of the commands menu, other chats' /profile messages are ignored
+        self.application.add_handler( CommandHandler("profile", self.cmd_profile, filters = filters.Chat(settings.DEVELOPER_CHAT_IDS)) )
 
         self.application.add_handler(TokenDetailsKeyboard.create_handler())
         self.application.add_handler(TokenPaginationKeyboard.create_handler())
+        self.application.add_handler(PairListKeyboard.create_handler())
+        # Needs inline mode turned on for the bot with BotFather
+        self.application.add_handler(self.inline_search.create_handler())
         self.application.add_handler( MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_message) )
 
 
+    async def shutdown(self) -> None:
+        """Stops polling watches, prefetching, inline searches and profiling, saves the token index, sends the pending error reports and closes the upstream session, called after the application stops processing updates"""
+        await self.watch_poller.close()
+        prefetcher.close()
+        self.inline_search.close()
+        profiler.close()
+        await token_index.close()
+        await self.error_reporter.close()
+        await TokenPaginationKeyboard.client.close()
+
+
     # Bot methods
 
+    def collect_metrics(self) -> Iterable[Sample]:
+        """Reads the counters every component keeps anyway, called when the metrics are scraped"""
+        yield from metrics.from_stats("webhook", self.ingestor.stats())
+        yield from metrics.from_stats("updates", self.update_processor.stats())
+        yield from metrics.from_stats("telegram", self.send_scheduler.stats())
+        yield from metrics.from_stats("dexscreener", TokenPaginationKeyboard.client.stats())
+        yield from metrics.from_stats("watches", self.watch_poller.stats())
+        yield from metrics.from_stats("prefetch", prefetcher.stats())
+        yield from metrics.from_stats("inline", self.inline_search.stats())
+        yield from metrics.from_stats("index", token_index.stats())
+
+        yield from metrics.from_cache("search", TokenPaginationKeyboard.cache.stats())
+        yield from metrics.from_cache("pair", TokenDetailsKeyboard.cache.stats())
+        yield from metrics.from_cache("render", render_cache.stats())
+        yield from metrics.from_cache("callback", CallbackData.cache.stats())
+        yield from metrics.from_cache("users", storage.stats())
+
+
+    async def register(self, name: str, values, method, *args, **kwargs) -> None:
+        """Calls a Telegram registration method, unless the same values were registered on a previous start"""
+        stamp = fingerprint(values)
+        if settings.FAST_STARTUP and await storage.run(storage.get_stamp, name) == stamp:
+            logger.debug(f"Skipped registering the {name}, they are unchanged since the last start")
+            return
+
+        await method(*args, **kwargs)
+        await storage.run(storage.set_stamp, name, stamp)
+
+
+    async def verify_webhook(self, bot_web_url: str, secret_token: str) -> None:
+        """Registers the webhook again if Telegram doesn't have it, in case it was changed since it was last registered"""
+        try:
+            info = await self.application.bot.get_webhook_info()
+            if info.url != bot_web_url:
+                logger.warning(f"The webhook was changed to {info.url!r}, registering it again")
+                await self.application.bot.set_webhook(url = bot_web_url, secret_token = secret_token)
+                await storage.run(storage.set_stamp, "webhook", fingerprint((bot_web_url, secret_token)))
+        except Exception:
+            logger.exception("Failed to verify the webhook")
+
+
     async def set_bot_commands_menu(self) -> None:
         # Register commands for bot menu
         commands = [
             BotCommand("start", "Start the bot"),
             BotCommand("help", "Get help about this bot"),
             BotCommand("about", "Get information about the bot"),
+            BotCommand("watch", "Get an alert when a pair crosses a price or liquidity threshold"),
+            BotCommand("watches", "List your watches"),
+            BotCommand("unwatch", "Remove a watch or all of them"),
 
         ]
-        await self.application.bot.set_my_commands(commands)
+        await self.register("commands", [ (i.command, i.description) for i in commands ], self.application.bot.set_my_commands, commands)
 
 
     # Bot handlers
 
     async def handle_error(self, update: Update, context: BotContext) -> None:
-        """Log the error and send a message to notify the developer."""
-        # Log the error first so it can be seen even if something breaks.
-        logger.error("Exception while handling an update:", exc_info = context.error)
-
-        # traceback.format_exception returns the usual python message about an exception, but as a
-        # list of strings rather than a single string, so we have to join them together.
-        tb_list = format_exception(None, context.error, context.error.__traceback__)
-        tb_string = "".join(tb_list)
-
-        # Build the message with some markup and additional information about what happened.
-
-        update_str = dumps(update.to_dict() if isinstance(update, Update) else str(update), indent = 2, ensure_ascii = False)
-        for text in (
-            f"An exception was raised while handling an update\n"
-            f"<pre>update = {html_escape(update_str)}</pre>\n",
-
-            "<b>Context</b>\n"
-            f"<pre><u>context.bot_data</u> = {html_escape(dumps(context.bot_data, indent = 2, ensure_ascii = False))}</pre>\n\n"
-            f" <pre><u>context.chat_data</u> = {html_escape(dumps(context.chat_data, indent = 2, ensure_ascii = False))}</pre>\n\n"
-            f"<pre><u>context.user_data</u> = {html_escape(dumps(context.user_data, indent = 2, ensure_ascii = False))}</pre>\n\n",
-
-            "<b>Traceback</b>\n"
-            f"<pre>{html_escape(tb_string)}</pre>\n",
-        ):
-            await log_in_channels(text, context)
+        """Log the error and queue it for the next aggregated report to the log channels."""
+        # Serializing and sending happens in the reporter's flush task, so a burst of failures stays cheap here
+        self.error_reporter.record(context.error, update, context)
 
 
+    @metrics.timed
     async def handle_message(self, update: Update, context: BotContext) -> None:
         """Handles messages"""
         if not update.effective_message:
             return
         
         args = update.effective_message.text.split(" ")
-        # If text has more than one word or filter flag found from second word upwards
-        if len(args) == 1 or args[1:].count('/filter') == 1:
+        # If text has more than one word or a search flag found from second word upwards
+        if len(args) == 1 or any(args[1:].count(flag) == 1 for flag in ("/filter", "/sort", "/top")):
             await self.cmd_search(update, context)
-        elif len(args) == 2:
+        # A chain and one address, or a chain and a comma separated list of addresses
+        elif len(args) == 2 or "," in "".join(args[1:]):
             await self.cmd_pair(update, context)
         else:
             text = "Use the /help command to learn how to use me"
@@ -124,6 +208,7 @@ class Bot:
 
 
     # Bot commands
+    @metrics.timed
     async def cmd_start(self, update: Update, context: BotContext):
         text = (
             f"Welcome, {update.effective_user.first_name} !\n"
@@ -138,6 +223,7 @@ class Bot:
         await update.effective_message.reply_text(text)
 
 
+    @metrics.timed
     async def cmd_help(self, update: Update, context: BotContext):
         text = (
             "Usage\nTo use the functions listed below, send me a message using the patterns defined\n"
@@ -145,7 +231,9 @@ class Bot:
 
             "1. Get token pair info for a specific blockchain\n\n"
             "Pattern: <blockchain id> <token address>\n\n"
-            "Example: ethereum 0xAbc123456789\n\n\n"
+            "Example: ethereum 0xAbc123456789\n\n"
+            "Several pairs on one chain: <blockchain id> <address>,<address>,...\n\n"
+            "Example: ethereum 0xAbc123456789,0xDef123456789\n\n\n"
 
             "2. Find token pairs by address or name\n\n"
             "Pattern: <token address or token name>\n\n"
@@ -159,11 +247,29 @@ class Bot:
             "Examples:\n"
             "0xAbc123456789 /filter chain=ton\n"
             "WBTC/USDC /filter dex=stonfi\n"
-            "WBTC /filter chain=ton,dex=stonf\n\n\n"
+            "WBTC /filter chain=ton,dex=stonf\n"
+            "WBTC /filter liquidity>100k,volume24h>=1m,age<1d\n\n"
+            "Number filters: price, fdv, liquidity, age, volume, pricechange, buys and sells with a 5m, 1h, 6h or 24h period\n"
+            "Operators: = < > <= >=\n\n\n"
+
+            "4. Sorting\nSort search results by a number filter, highest first unless asc is given\n\n"
+            "Pattern: <token address or token name> [/filter ...] /sort <field> [asc] or /top [field]\n\n"
+            "Examples:\n"
+            "WBTC /sort liquidity\n"
+            "WBTC /filter chain=ethereum /sort age asc\n"
+            "PEPE /top volume24h\n\n\n"
+
+            "5. Alerts\nGet a message when a value of a pair crosses a threshold\n\n"
+            "Pattern: /watch <blockchain id> <pair address> <field><operator><value>\n\n"
+            "Examples:\n"
+            "/watch ethereum 0xAbc123456789 price>2000\n"
+            "/watch ton EQAbc123456789 liquidity<50k\n\n"
+            "Use /watches to list your watches and /unwatch [id] to remove one or all of them\n\n\n"
         )
         await update.effective_message.reply_text(text, reply_to_message_id = update.effective_message.id)
 
 
+    @metrics.timed
     async def cmd_about(self, update: Update, context: BotContext):
         """Handles """
         text = (
@@ -176,28 +282,130 @@ class Bot:
         await update.effective_message.reply_html(text, reply_to_message_id = update.effective_message.id)
 
 
+    @metrics.timed
     async def cmd_pair(self, update: Update, context: BotContext):
         """Handles the pair command"""
-        chain, address = update.effective_message.text.split(" ")
-        token = await TokenPaginationKeyboard.client.get_token_pair_async(chain, address)
+        chain, address = update.effective_message.text.split(" ", 1)
+        if "," in address:
+            await self.cmd_pairs(update, context)
+            return
+
+        token = await TokenDetailsKeyboard.get_pair(chain, address)
 
         if token:
             text = format_token(token)
-            keyboard = await TokenDetailsKeyboard.generate_markup("less", update, context)
+            # The button carries the pair, so pressing it doesn't depend on what the user looked up since
+            keyboard = await TokenDetailsKeyboard.generate_markup("less", f"{chain} {address}", update, context)
             await update.effective_message.reply_html(text, reply_to_message_id = update.effective_message.id, reply_markup = keyboard)
-            # Have to enclose values in quotes for TEXT column in sqlite3
-            storage.set_user_data(update.effective_user.id, DatabaseTables.USERS, query_pair = dumps(f"{chain} {address}"))
+            # The "More Details" button is the usual next step
+            prefetcher.schedule(update.effective_user.id, partial(TokenDetailsKeyboard.prefetch, token))
 
         else:
             text = f"Token not found on {chain} at {address}"
             await update.effective_message.reply_text(text, reply_to_message_id = update.effective_message.id)
 
 
+    @metrics.timed
+    async def cmd_pairs(self, update: Update, context: BotContext):
+        """Handles a list of pair addresses on one chain"""
+        await PairListKeyboard.handle(update, context, update.effective_message.text)
+
+
+    @metrics.timed
     async def cmd_search(self, update: Update, context: BotContext):
         """Handles the search command"""
         identifier = update.effective_message.text
+        await TokenPaginationKeyboard.handle(update, context, identifier)
+
 
-        # Have to enclose values in quotes for TEXT column in sqlite3
-        storage.set_user_data(update.effective_user.id, DatabaseTables.USERS, query_search = dumps(identifier))
-        await TokenPaginationKeyboard.handle(update, context)
+    @metrics.timed
+    async def cmd_watch(self, update: Update, context: BotContext):
+        """Handles the watch command"""
+        message = update.effective_message
+        usage = "Usage: /watch <blockchain id> <pair address> <field><operator><value>\nExample: /watch ethereum 0xAbc123456789 price>2000"
+        if len(context.args) < 3:
+            await message.reply_text(usage, reply_to_message_id = message.id)
+            return
 
+        chain, address = context.args[0].lower(), context.args[1]
+        conditions = TokenFilter.parse_filters(" ".join(context.args[2:]))
+        threshold = TokenFilter.parse_number(conditions[0]["value"]) if len(conditions) == 1 else None
+        if threshold is None or conditions[0]["name"] not in WATCH_FIELDS:
+            text = f"{usage}\n\nFields: {', '.join(WATCH_FIELDS)}"
+            await message.reply_text(text, reply_to_message_id = message.id)
+            return
+
+        watches = await storage.run(storage.get_watches, update.effective_user.id)
+        if len(watches) >= settings.WATCH_MAX_PER_USER:
+            text = f"You can have at most {settings.WATCH_MAX_PER_USER} watches, remove one with /unwatch first"
+            await message.reply_text(text, reply_to_message_id = message.id)
+            return
+
+        token = await TokenDetailsKeyboard.get_pair(chain, address)
+        if not token:
+            await message.reply_text(f"Token not found on {chain} at {address}", reply_to_message_id = message.id)
+            return
+
+        field, op = conditions[0]["name"], conditions[0]["op"]
+        watch_id = await storage.run(storage.add_watch, update.effective_user.id, update.effective_chat.id, chain, address, field, op, threshold)
+        watch = Watch(watch_id, update.effective_user.id, update.effective_chat.id, chain, address, field, op, threshold)
+        self.watch_poller.add(watch)
+
+        value = TokenFilter.fields[field](token)
+        text = f"Watching {watch.describe()}\nCurrent {field}: {'unknown' if value is None else f'{value:,.8g}'}"
+        await message.reply_text(text, reply_to_message_id = message.id)
+
+
+    @metrics.timed
+    async def cmd_unwatch(self, update: Update, context: BotContext):
+        """Handles the unwatch command, removes one watch by id or all of the user's watches"""
+        message = update.effective_message
+        try:
+            watch_id = int(context.args[0].lstrip("#")) if context.args else None
+        except ValueError:
+            await message.reply_text("Usage: /unwatch [watch id]", reply_to_message_id = message.id)
+            return
+
+        deleted = await storage.run(storage.delete_watches, update.effective_user.id, watch_id)
+        for i in deleted:
+            self.watch_poller.remove(i)
+
+        text = f"Removed {len(deleted)} watch{'es' if len(deleted) != 1 else ''}" if deleted else "No watch found"
+        await message.reply_text(text, reply_to_message_id = message.id)
+
+
+    @metrics.timed
+    async def cmd_watches(self, update: Update, context: BotContext):
+        """Handles the watches command"""
+        watches = [ Watch(**row) for row in await storage.run(storage.get_watches, update.effective_user.id) ]
+        text = "\n".join(watch.describe() for watch in watches) if watches else "You have no watches, add one with /watch"
+        await update.effective_message.reply_text(text, reply_to_message_id = update.effective_message.id)
+
+
+    @metrics.timed
+    async def cmd_profile(self, update: Update, context: BotContext):
+        """Handles the profile command of the developer chats, samples the event loop for a number of seconds"""
+        message = update.effective_message
+        try:
+            seconds = float(context.args[0]) if context.args else settings.PROFILE_SECONDS
+        except ValueError:
+            await message.reply_text("Usage: /profile [seconds]", reply_to_message_id = message.id)
+            return
+
+        seconds = min(max(seconds, 1), settings.PROFILE_MAX_SECONDS)
+        try:
+            # Runs in the background, so the updates of this chat aren't held up until it is done
+            profiler.start(seconds, partial(self.send_profile, message.chat_id))
+        except RuntimeError as error:
+            await message.reply_text(str(error), reply_to_message_id = message.id)
+            return
+        await message.reply_text(f"Profiling the event loop for {seconds:g} seconds", reply_to_message_id = message.id)
+
+
+    async def send_profile(self, chat_id: int, profile: Profile) -> None:
+        bot = self.application.bot
+        await bot.send_message(chat_id = chat_id, text = f"<pre>{html_escape(profile.summary())}</pre>", parse_mode = ParseMode.HTML, rate_limit_args = SendPriority.LOG)
+        await bot.send_document(
+            chat_id = chat_id, document = profile.collapsed(), filename = f"profile-{datetime.now():%Y%m%d-%H%M%S}.folded",
+            caption = "Collapsed stacks, open with speedscope or flamegraph.pl", rate_limit_args = SendPriority.LOG,
+        )
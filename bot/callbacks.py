@@ -0,0 +1,79 @@
+"""Packs what a keyboard button refers to into its callback data, so a button press doesn't need the user's stored state"""
+
+from time import time
+from hashlib import sha1
+from base64 import urlsafe_b64encode
+
+from telegram.constants import InlineKeyboardButtonLimit
+
+from cache import LRUCache, MISSING
+from storage import get_storage
+from settings import get_settings, get_logger
+
+
+storage = get_storage()
+settings = get_settings()
+logger = get_logger(__name__)
+
+# Callback data is made of "<pattern>:<value>:<reference>", the reference is last since queries may contain colons
+SEPARATOR = ":"
+# References starting with this hold the text itself
+INLINE_PREFIX = "="
+# References starting with this are short ids of text saved in the database
+SHORT_ID_PREFIX = "#"
+
+
+
+class CallbackData:
+    """Encodes and decodes callback data. Text which fits is put in the callback data as it is, longer text is saved
+    under a short id derived from its hash, so the same text always gets the same id on every worker.
+
+    Saved texts are purged once they weren't saved again for CALLBACK_TEXT_TTL. A cached text expires halfway through
+    that, so a text still in use is saved again, and renewed, long before its row could be purged."""
+
+    cache = LRUCache(settings.CALLBACK_CACHE_SIZE, settings.CALLBACK_TEXT_TTL / 2)
+
+    @staticmethod
+    def short_id(text: str) -> str:
+        # 9 bytes of the hash make 12 base64 characters
+        return SHORT_ID_PREFIX + urlsafe_b64encode(sha1(text.encode()).digest()[:9]).decode()
+
+
+    @classmethod
+    async def encode(cls, pattern: str, value: str | int, text: str) -> str:
+        """Returns the callback data for a button, saving the text if it is too long to be included"""
+        data = f"{pattern}{SEPARATOR}{value}{SEPARATOR}{INLINE_PREFIX}{text}"
+        if len(data.encode()) <= InlineKeyboardButtonLimit.MAX_CALLBACK_DATA:
+            return data
+
+        short_id = cls.short_id(text)
+        if cls.cache.get(short_id, record = False) is MISSING:
+            await storage.run(storage.save_callback_text, short_id, text)
+            cls.cache.set(short_id, text)
+        return f"{pattern}{SEPARATOR}{value}{SEPARATOR}{short_id}"
+
+
+    @staticmethod
+    def split(data: str) -> tuple[str, str, str | None]:
+        """Splits callback data into its pattern, value and reference, buttons made before references were added have none"""
+        pattern, _, rest = data.partition(SEPARATOR)
+        value, separator, reference = rest.partition(SEPARATOR)
+        return pattern, value, reference if separator else None
+
+
+    @classmethod
+    async def resolve(cls, reference: str) -> str | None:
+        """Returns the text a reference stands for, None if it can't be found"""
+        if reference.startswith(INLINE_PREFIX):
+            return reference[len(INLINE_PREFIX):]
+
+        text = cls.cache.get(reference)
+        if text is MISSING:
+            row = await storage.run(storage.load_callback_text, reference)
+            if row is None:
+                logger.debug(f"Unknown callback data reference {reference}")
+                return None
+            # Cached no longer than if this worker had saved it, so encoding it again renews it in time
+            text, created = row
+            cls.cache.set(reference, text, max(1, created + settings.CALLBACK_TEXT_TTL / 2 - time()))
+        return text
@@ -0,0 +1,157 @@
+"""Groups exceptions by where they were raised and reports each group once per window instead of once per exception"""
+
+from json import dumps
+from time import time
+from hashlib import sha1
+from html import escape as html_escape
+from traceback import format_exception
+from asyncio import Task, create_task, gather, sleep, to_thread
+from datetime import datetime, timezone
+
+from telegram import Bot as TelegramBot, Update
+from telegram.constants import ParseMode
+from telegram.ext import CallbackContext
+
+from .ratelimit import SendPriority
+from settings import get_settings, get_logger
+
+
+settings = get_settings()
+logger = get_logger(__name__)
+
+# Telegram's limit for document captions
+MAX_CAPTION_LENGTH = 1024
+
+
+
+class ErrorReport:
+    """Occurrences of one exception fingerprint within the current window, only the first one's details are kept"""
+    __slots__ = ("fingerprint", "error", "update", "bot_data", "chat_data", "user_data", "count", "first_seen", "last_seen")
+
+    def __init__(self, fingerprint: str, error: BaseException, update: object, context: CallbackContext) -> None:
+        self.fingerprint = fingerprint
+        self.error = error
+        self.update = update
+        # Shallow copies, the dicts may change before the report is serialized
+        self.bot_data = dict(context.bot_data or {})
+        self.chat_data = dict(context.chat_data or {})
+        self.user_data = dict(context.user_data or {})
+        self.count = 0
+        self.first_seen = self.last_seen = time()
+
+
+    def summary(self) -> str:
+        error = self.error
+        seen = datetime.fromtimestamp(self.first_seen, timezone.utc).strftime("%H:%M:%S")
+        text = (
+            f"<b>{html_escape(type(error).__name__)}</b>: {html_escape(str(error))}\n"
+            f"Raised {self.count} time{'s' if self.count != 1 else ''} since {seen} UTC\n"
+            f"Fingerprint: <code>{self.fingerprint}</code>"
+        )
+        return text if len(text) <= MAX_CAPTION_LENGTH else text[:MAX_CAPTION_LENGTH - 3] + "..."
+
+
+    def details(self) -> bytes:
+        """Renders the traceback, update and context of the first occurrence, this is the slow part so it runs in a thread"""
+        update = self.update.to_dict() if isinstance(self.update, Update) else str(self.update)
+        sections = (
+            ("Traceback", "".join(format_exception(None, self.error, self.error.__traceback__))),
+            ("Update", dumps(update, indent = 2, ensure_ascii = False, default = str)),
+            ("context.bot_data", dumps(self.bot_data, indent = 2, ensure_ascii = False, default = str)),
+            ("context.chat_data", dumps(self.chat_data, indent = 2, ensure_ascii = False, default = str)),
+            ("context.user_data", dumps(self.user_data, indent = 2, ensure_ascii = False, default = str)),
+        )
+        return "\n\n".join(f"{title}\n{'=' * len(title)}\n{body}" for title, body in sections).encode()
+
+
+
+class ErrorReporter:
+    """Collects exceptions from the error handler and sends one report per fingerprint to the log chats every window"""
+
+    def __init__(self, window: float = settings.ERROR_REPORT_WINDOW, max_reports: int = settings.ERROR_REPORT_MAX) -> None:
+        self.window = window
+        self.max_reports = max_reports
+        self.reports: dict[str, ErrorReport] = {}
+        self.dropped = 0
+
+        self.bot: TelegramBot | None = None
+        self.task: Task | None = None
+
+
+    @staticmethod
+    def fingerprint(error: BaseException) -> str:
+        """Identifies an exception by its type and the code locations in its traceback, not by its message"""
+        parts = [type(error).__module__, type(error).__qualname__]
+        traceback = error.__traceback__
+        while traceback is not None:
+            code = traceback.tb_frame.f_code
+            parts.append(f"{code.co_filename}:{code.co_name}:{traceback.tb_lineno}")
+            traceback = traceback.tb_next
+        return sha1("|".join(parts).encode()).hexdigest()[:12]
+
+
+    def record(self, error: BaseException, update: object, context: CallbackContext) -> None:
+        """Counts the exception, only the first of each fingerprint in a window is logged as an error with its traceback"""
+        fingerprint = self.fingerprint(error)
+        report = self.reports.get(fingerprint)
+
+        if report is None:
+            if len(self.reports) >= self.max_reports:
+                self.dropped += 1
+                logger.error(f"Exception while handling an update ({fingerprint}), too many distinct errors to report: {error!r}")
+                return
+
+            logger.error(f"Exception while handling an update ({fingerprint}):", exc_info = error)
+            report = self.reports[fingerprint] = ErrorReport(fingerprint, error, update, context)
+        else:
+            logger.debug(f"Exception while handling an update ({fingerprint}), seen {report.count + 1} times: {error!r}")
+
+        report.count += 1
+        report.last_seen = time()
+
+
+    async def send(self, report: ErrorReport) -> None:
+        document = await to_thread(report.details)
+        caption = report.summary()
+        await gather(*(
+            self.bot.send_document(
+                chat_id = chat_id, document = document, filename = f"error-{report.fingerprint}.txt",
+                caption = caption, parse_mode = ParseMode.HTML, rate_limit_args = SendPriority.LOG,
+            )
+            for chat_id in settings.LOG_CHAT_IDS
+        ))
+
+
+    async def flush(self) -> None:
+        """Sends the reports collected in the current window and starts a new one"""
+        reports, self.reports = self.reports, {}
+        if self.dropped:
+            logger.warning(f"{self.dropped} exceptions were not reported, the report limit was reached")
+            self.dropped = 0
+
+        for report in reports.values():
+            try:
+                await self.send(report)
+            except Exception:
+                # Reporting must never raise into the error handler or the flush loop
+                logger.exception(f"Failed to send error report {report.fingerprint}")
+
+
+    async def flush_periodically(self) -> None:
+        while True:
+            await sleep(self.window)
+            await self.flush()
+
+
+    def start(self, bot: TelegramBot) -> None:
+        self.bot = bot
+        if self.task is None:
+            self.task = create_task(self.flush_periodically())
+
+    async def close(self) -> None:
+        """Stops the flush task and sends what is left, called before the bot shuts down"""
+        if self.task is not None:
+            self.task.cancel()
+            self.task = None
+        if self.bot is not None:
+            await self.flush()
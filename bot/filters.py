@@ -1,79 +1,104 @@
+from __future__ import annotations
+
 import re
-from datetime import datetime
-from dexscreener import TokenPair
+from time import time
+from functools import lru_cache
+from operator import eq, ge, gt, le, lt
+from typing import TYPE_CHECKING, Callable
 
 from settings import get_logger, get_settings
 
+# Only needed for annotations, dexscreener is imported when the first response is parsed
+if TYPE_CHECKING:
+    from dexscreener import TokenPair
+
 settings = get_settings()
 logger = get_logger(__name__)
 
+# Longer operators come first so "<=" isn't read as "<" followed by "=value"
+FILTER_PATTERN = re.compile(r"(?P<name>\w+)\s*(?P<op><=|>=|=|<|>)\s*(?P<value>[^,]+)")
+NUMBER_PATTERN = re.compile(r"(?P<number>[+-]?\d+(?:\.\d+)?)\s*(?P<unit>[a-z]*)", re.IGNORECASE)
+
+OPERATORS = { "=": eq, "<": lt, ">": gt, "<=": le, ">=": ge }
+NUMBER_SUFFIXES = { "": 1, "k": 1e3, "m": 1e6, "b": 1e9 }
+TIME_UNITS = { "": 1, "s": 1, "m": 60, "h": 3600, "d": 86400, "w": 604800 }
+# Period suffixes users type, mapped to the period attributes of the token pair models
+PERIODS = { "5m": "m5", "1h": "h1", "6h": "h6", "24h": "h24" }
+
+# A compiled filter, the field it tests, the operator and the value it is compared with
+Condition = tuple[str, str, str | float]
+
 
 
 class TokenFilter:
+    # Numeric fields that can be compared, mapped to how their value is read from a token pair
+    fields: dict[str, Callable[[TokenPair], float | None]] = {
+        "price": lambda token: token.price_usd,
+        "fdv": lambda token: token.fdv,
+        "mcap": lambda token: token.fdv,
+        "liquidity": lambda token: token.liquidity.usd if token.liquidity else None,
+        "age": lambda token: time() - token.pair_created_at.timestamp() if token.pair_created_at else None,
+        **{ f"volume{name}": lambda token, period = period: getattr(token.volume, period) for name, period in PERIODS.items() },
+        **{ f"pricechange{name}": lambda token, period = period: getattr(token.price_change, period) for name, period in PERIODS.items() },
+        **{ f"buys{name}": lambda token, period = period: getattr(token.transactions, period).buys for name, period in PERIODS.items() },
+        **{ f"sells{name}": lambda token, period = period: getattr(token.transactions, period).sells for name, period in PERIODS.items() },
+    }
+
     @classmethod
-    def filter(cls, text: str, tokens: list[TokenPair]) -> list[TokenPair]:
-        filters = cls.parse_filters(text)
-        if filters:
-            filtered = filter(lambda token: cls.filter_token(token, filters), tokens)
-        else:
-            filtered = tokens
+    def parse_filters(cls, text: str) -> list[dict]:
+        return [ {key: value.strip() for key, value in matched.groupdict().items()} | {"name": matched["name"].lower()} for matched in FILTER_PATTERN.finditer(text) ]
 
-        return filtered
+    @staticmethod
+    @lru_cache(maxsize = 256)
+    def compile(text: str) -> tuple[Condition, ...]:
+        """Parses the filter text into a plan once, repeated filter texts reuse the same plan.
+        The plan is a (field, operator, value) condition per known filter, result sets test each against a whole column."""
+        return TokenFilter.compile_filters(TokenFilter.parse_filters(text))
 
     @classmethod
-    def filter_token(cls, token: TokenPair, filters: list[dict]) -> True:
-        passed = True
+    def compile_filters(cls, filters: list[dict]) -> tuple[Condition, ...]:
+        conditions = []
         for i in filters:
-            if not passed:
-                break
+            condition = cls.compile_filter(i)
+            if condition is None:
+                logger.debug(f"Ignoring unknown filter {i}")
+            else:
+                conditions.append(condition)
 
-            name = i["name"]
-            match name:
-                case "chain":
-                    passed = cls.filter_by_chain(token, i)
-                case "dex":
-                    passed = cls.filter_by_dex(token, i)
-        return passed
+        return tuple(conditions)
 
     @classmethod
-    def parse_filters(cls, text: str) -> list[dict]:
-        pattern = "(?P<name>(\w)+)(\s)*(?P<op>(=|<|>|<=|>=))(\s)*(?P<value>[^,]+)"
-        last = 0
-        filters = []
+    def compile_filter(cls, args: dict) -> Condition | None:
+        name = args["name"]
 
-        while True:
-            chunk = text[last:]
-            matched = re.search(pattern, chunk)
-            if not matched:
-                break
+        # Chains and dexes are only ever compared for equality
+        if name in ("chain", "dex"):
+            return (name, "=", args["value"].lower())
 
-            last = matched.span()[1] + 1
-            parsed = {key.lower(): value for key, value in matched.groupdict().items()}
-            filters.append(parsed)
+        if name not in cls.fields:
+            return None
 
-        return filters
+        value = cls.parse_time(args["value"]) if name == "age" else cls.parse_number(args["value"])
+        if value is None:
+            return None
 
+        return (name, args["op"], value)
 
-    # Place filter methods here
 
-    @classmethod
-    def filter_by_chain(cls, token: TokenPair, args: dict) -> bool:
-        return token.chain_id == args["value"]
-
-    @classmethod
-    def filter_by_dex(cls, token: TokenPair, args: dict) -> bool:
-        return token.dex_id == args["value"]
+    # Value parsers, return None if the value can't be used
 
     @classmethod
-    def filter_by_mcap(cls, token: TokenPair, args: dict) -> bool:
-        return token.dex_id == args["value"]
+    def parse_number(cls, text: str) -> float | None:
+        """Parses numbers like 1000, 1.5k or 2m"""
+        matched = NUMBER_PATTERN.fullmatch(text.strip())
+        if not matched or matched["unit"].lower() not in NUMBER_SUFFIXES:
+            return None
+        return float(matched["number"]) * NUMBER_SUFFIXES[matched["unit"].lower()]
 
     @classmethod
-    def filter_by_time(cls, token: TokenPair, args: dict) -> bool:
-        try:
-            value = datetime(args["value"])
-        except Exception as exception:
-            return False
-
-        # TODO: Finish the timestamp filter, add a reliable way to convert user input to datetime
-        return False
+    def parse_time(cls, text: str) -> float | None:
+        """Parses durations like 30m, 12h or 1d into seconds"""
+        matched = NUMBER_PATTERN.fullmatch(text.strip())
+        if not matched or matched["unit"].lower() not in TIME_UNITS:
+            return None
+        return float(matched["number"]) * TIME_UNITS[matched["unit"].lower()]
@@ -0,0 +1,397 @@
+"""A local index of the pairs fetched from DexScreener, so popular searches are answered without a request"""
+
+from __future__ import annotations
+
+from json import dumps, loads
+from time import time
+from asyncio import Task, create_task, gather, sleep
+from typing import TYPE_CHECKING, Iterable
+
+from .utils import normalize_query
+from .upstream import get_gateway, PairList, MAX_PAIRS_PER_REQUEST
+from startup import lazy_import
+from storage import get_storage
+from settings import get_settings, get_logger
+
+# Only needed for annotations, dexscreener is imported when the first response is parsed
+if TYPE_CHECKING:
+    from dexscreener import TokenPair
+
+
+storage = get_storage()
+settings = get_settings()
+logger = get_logger(__name__)
+dexscreener = lazy_import("dexscreener")
+
+# Words are indexed by their n-grams, and by their prefixes shorter than that so short queries can be typed ahead
+GRAM_SIZE = 3
+
+
+
+def word_grams(word: str) -> set[str]:
+    grams = { word[:i] for i in range(1, min(len(word), GRAM_SIZE - 1) + 1) }
+    grams.update(word[i:i+GRAM_SIZE] for i in range(len(word) - GRAM_SIZE + 1))
+    return grams
+
+
+def query_grams(word: str) -> set[str]:
+    """The grams every word containing this one has, a short word has to be the start of one"""
+    if len(word) < GRAM_SIZE:
+        return {word}
+    return { word[i:i+GRAM_SIZE] for i in range(len(word) - GRAM_SIZE + 1) }
+
+
+
+class IndexedPair:
+    """One pair of the index. Pairs loaded from the database keep the JSON they were saved as and are only parsed
+    when they are served, so the startup load never parses a pair."""
+    __slots__ = ("key", "address", "text", "liquidity", "updated", "body", "token")
+
+    def __init__(self, key: tuple[str, str], address: str, text: str, liquidity: float, updated: float, body: bytes | None = None, token: TokenPair | None = None) -> None:
+        self.key = key
+        self.address = address
+        self.text = text
+        self.liquidity = liquidity
+        self.updated = updated
+        self.body = body
+        self.token = token
+
+    @classmethod
+    def from_token(cls, token: TokenPair, updated: float) -> "IndexedPair":
+        base, quote = token.base_token, token.quote_token
+        return cls(
+            key = (token.chain_id.lower(), token.pair_address.lower()),
+            address = token.pair_address,
+            text = f"{base.symbol} {base.name} {quote.symbol} {quote.name}".lower(),
+            liquidity = token.liquidity.usd if token.liquidity and token.liquidity.usd is not None else 0,
+            updated = updated,
+            token = token,
+        )
+
+    @classmethod
+    def from_row(cls, row: tuple) -> "IndexedPair":
+        chain, pair_address, address, text, liquidity, body, updated = row
+        return cls((chain, pair_address), address, text, liquidity, updated, body)
+
+    def get_token(self) -> TokenPair:
+        if self.token is None:
+            self.token = dexscreener.TokenPair.model_validate_json(self.body)
+        return self.token
+
+    def to_row(self) -> tuple:
+        body = self.token.model_dump_json(by_alias = True).encode() if self.token is not None else self.body
+        return (*self.key, self.address, self.text, self.liquidity, body, self.updated)
+
+
+
+class IndexedQuery:
+    __slots__ = ("keys", "searched", "used", "hits")
+
+    @classmethod
+    def from_row(cls, row: tuple) -> "IndexedQuery":
+        query, keys, searched, used, hits = row
+        return cls(tuple(map(tuple, loads(keys))), searched, used, hits)
+
+    def __init__(self, keys: tuple[tuple[str, str], ...], searched: float, used: float, hits: int) -> None:
+        self.keys = keys
+        # When DexScreener last answered the search, and when it was last asked for by a user
+        self.searched = searched
+        self.used = used
+        self.hits = hits
+
+
+
+class TokenIndex:
+    """Holds every pair seen in a search, pair lookup or watch poll, with an n-gram index over the names and symbols
+    of its tokens and a hash index over its pair addresses. Searches remember which pairs they returned, once
+    a query was searched often enough it is answered from the index while its pairs have recent prices.
+    The pairs of recently used popular queries are refreshed in the background so their prices stay recent.
+
+    With several workers only the one holding the refresh lease refreshes. Every worker takes over the pairs and
+    queries the others saved, so the refreshed prices and the queries popular on other workers reach all of them."""
+
+    lease = "token_index_refresh"
+
+    def __init__(self, enabled: bool = settings.INDEX_ENABLED, max_pairs: int = settings.INDEX_MAX_PAIRS) -> None:
+        self.enabled = enabled
+        self.max_pairs = max_pairs
+        self.pairs: dict[tuple[str, str], IndexedPair] = {}
+        self.queries: dict[str, IndexedQuery] = {}
+        self.grams: dict[str, set[tuple[str, str]]] = {}
+        self.addresses: dict[str, set[tuple[str, str]]] = {}
+
+        # Changed since the last flush
+        self.dirty_pairs: set[tuple[str, str]] = set()
+        self.dirty_queries: set[str] = set()
+        self.removed_pairs: set[tuple[str, str]] = set()
+        self.flush_task: Task | None = None
+        self.refresh_task: Task | None = None
+
+        self.hits = 0
+        self.misses = 0
+        self.refreshed = 0
+        # When the pairs and queries other workers saved were last taken over
+        self.synced = 0.0
+
+
+    def insert(self, pair: IndexedPair) -> None:
+        """Adds a pair to the lookup indexes, replacing an older snapshot of it"""
+        old = self.pairs.get(pair.key)
+        self.pairs[pair.key] = pair
+        if old is not None:
+            # Names hardly ever change and the address is part of the key, only the snapshot is replaced then
+            if old.text == pair.text:
+                return
+            self.unindex(old)
+
+        for gram in { gram for word in pair.text.split() for gram in word_grams(word) }:
+            self.grams.setdefault(gram, set()).add(pair.key)
+        # A token address isn't indexed, its search finds every pair of the token and the index may hold only some of them
+        self.addresses.setdefault(pair.key[1], set()).add(pair.key)
+
+    def unindex(self, pair: IndexedPair) -> None:
+        for gram in { gram for word in pair.text.split() for gram in word_grams(word) }:
+            keys = self.grams.get(gram)
+            if keys is not None:
+                keys.discard(pair.key)
+                if not keys:
+                    del self.grams[gram]
+        keys = self.addresses.get(pair.key[1])
+        if keys is not None:
+            keys.discard(pair.key)
+            if not keys:
+                del self.addresses[pair.key[1]]
+
+
+    def add(self, tokens: Iterable[TokenPair | None], fetched: float) -> None:
+        """Indexes pairs DexScreener returned at the fetched time, which is older than now for cached and stale responses.
+        A pair already indexed from a newer response is kept."""
+        if not self.enabled:
+            return
+        for token in tokens:
+            if token is not None:
+                pair = IndexedPair.from_token(token, fetched)
+                old = self.pairs.get(pair.key)
+                if old is not None and old.updated >= fetched:
+                    continue
+                self.insert(pair)
+                self.dirty_pairs.add(pair.key)
+
+    def remember(self, query: str, tokens: PairList) -> None:
+        """Indexes the pairs a search returned and remembers them as its answer, as of when the search was fetched"""
+        if not self.enabled:
+            return
+        self.add(tokens, tokens.fetched)
+        query = normalize_query(query)
+        previous = self.queries.get(query)
+        if previous is not None and previous.searched > tokens.fetched:
+            previous.hits += 1
+            previous.used = time()
+            self.dirty_queries.add(query)
+            return
+        keys = tuple( (token.chain_id.lower(), token.pair_address.lower()) for token in tokens )
+        self.queries[query] = IndexedQuery(keys, tokens.fetched, time(), (previous.hits if previous else 0) + 1)
+        self.dirty_queries.add(query)
+
+
+    def search(self, query: str) -> list[TokenPair] | None:
+        """The pairs a popular query or a pair address returned, None unless all of them have recent prices"""
+        if not self.enabled:
+            return None
+        query = normalize_query(query)
+        now = time()
+
+        entry = self.queries.get(query)
+        if entry is not None and entry.hits >= settings.INDEX_POPULAR_HITS and entry.searched >= now - settings.INDEX_QUERY_TTL:
+            keys = entry.keys
+        else:
+            # Searching for a pair address only ever finds that pair, on whichever chains it is indexed. Keys are lower case,
+            # pairs whose address only matches when case is ignored are another pair
+            keys = [ key for key in self.addresses.get(query.lower(), ()) if normalize_query(self.pairs[key].address) == query ]
+
+        pairs = [ self.pairs.get(key) for key in keys ]
+        if not pairs or any(pair is None or pair.updated < now - settings.INDEX_MAX_AGE for pair in pairs):
+            self.misses += 1
+            return None
+
+        self.hits += 1
+        if entry is not None:
+            entry.hits += 1
+            entry.used = now
+            self.dirty_queries.add(query)
+        return [ pair.get_token() for pair in pairs ]
+
+
+    def get_pair(self, chain: str, address: str, max_age: float) -> TokenPair | None:
+        """A pair by its address if its snapshot is at most max_age seconds old"""
+        pair = self.pairs.get((chain.lower(), address.lower())) if self.enabled else None
+        if pair is None or pair.updated < time() - max_age or normalize_query(pair.address) != normalize_query(address):
+            return None
+        return pair.get_token()
+
+    def match(self, text: str, limit: int, max_age: float = settings.INDEX_MAX_AGE) -> list[TokenPair]:
+        """Indexed pairs with recent prices whose token names or symbols contain every word of text, the most liquid first"""
+        words = text.lower().replace("/", " ").split()
+        if not words:
+            return []
+
+        candidates = None
+        for gram in sorted({ gram for word in words for gram in query_grams(word) }, key = lambda gram: len(self.grams.get(gram, ()))):
+            keys = self.grams.get(gram)
+            if not keys:
+                return []
+            candidates = set(keys) if candidates is None else candidates & keys
+            if not candidates:
+                return []
+
+        # The grams can all be there without the word being there in one piece
+        oldest = time() - max_age
+        found = [
+            pair for pair in (self.pairs[key] for key in candidates)
+            if pair.updated >= oldest and all(word in pair.text if len(word) >= GRAM_SIZE else any(i.startswith(word) for i in pair.text.split()) for word in words)
+        ]
+        found.sort(key = lambda pair: pair.liquidity, reverse = True)
+        return [ pair.get_token() for pair in found[:limit] ]
+
+
+    def evict(self) -> None:
+        """Forgets queries too old to be answered and drops the pairs updated longest ago once there are more than max_pairs"""
+        oldest = time() - settings.INDEX_QUERY_TTL
+        self.queries = { query: entry for query, entry in self.queries.items() if entry.searched >= oldest }
+        if len(self.pairs) <= self.max_pairs:
+            return
+        for pair in sorted(self.pairs.values(), key = lambda pair: pair.updated)[:len(self.pairs) - self.max_pairs]:
+            self.unindex(pair)
+            del self.pairs[pair.key]
+            self.dirty_pairs.discard(pair.key)
+            self.removed_pairs.add(pair.key)
+
+
+    async def flush(self) -> None:
+        """Writes the pairs and queries changed since the last flush"""
+        self.evict()
+        pairs = [ self.pairs[key].to_row() for key in self.dirty_pairs if key in self.pairs ]
+        queries = [
+            (query, dumps(entry.keys), entry.searched, entry.used, entry.hits)
+            for query, entry in ((query, self.queries.get(query)) for query in self.dirty_queries) if entry is not None
+        ]
+        removed = list(self.removed_pairs)
+        self.dirty_pairs, self.dirty_queries, self.removed_pairs = set(), set(), set()
+        if pairs or queries or removed:
+            await storage.run(storage.save_token_index, pairs, queries, removed)
+
+    async def flush_periodically(self) -> None:
+        while True:
+            await sleep(settings.INDEX_FLUSH_INTERVAL)
+            try:
+                await self.flush()
+            except Exception:
+                logger.exception("Failed to save the token index")
+
+
+    async def refresh(self) -> None:
+        """Fetches the pairs of recently used popular queries whose prices are about to be too old to serve"""
+        now = time()
+        stale = { key: self.pairs[key] for entry in self.queries.values()
+            if entry.hits >= settings.INDEX_POPULAR_HITS and entry.used > now - settings.INDEX_ACTIVE_PERIOD
+            for key in entry.keys if key in self.pairs and self.pairs[key].updated < now - settings.INDEX_MAX_AGE / 2 }
+
+        chains: dict[str, list[str]] = {}
+        for pair in sorted(stale.values(), key = lambda pair: pair.updated):
+            chains.setdefault(pair.key[0], []).append(pair.address)
+        requests = [
+            (chain, addresses[i:i+MAX_PAIRS_PER_REQUEST])
+            for chain, addresses in chains.items() for i in range(0, len(addresses), MAX_PAIRS_PER_REQUEST)
+        ][:settings.INDEX_REFRESH_REQUESTS]
+
+        results = await gather(*(get_gateway().get_token_pair_list_async(chain, chunk) for chain, chunk in requests), return_exceptions = True)
+        for tokens in results:
+            if isinstance(tokens, Exception):
+                logger.warning(f"Failed to refresh indexed pairs: {tokens!r}")
+                continue
+            self.add(tokens, tokens.fetched)
+            self.refreshed += len(tokens)
+
+    async def refresh_periodically(self) -> None:
+        while True:
+            await sleep(settings.INDEX_REFRESH_INTERVAL)
+            try:
+                if settings.WORKERS > 1:
+                    await self.sync()
+                    # The lease outlives a few intervals, so another worker takes over if this one stops renewing it
+                    if not await storage.run(storage.acquire_lease, self.lease, settings.INDEX_REFRESH_INTERVAL * 3):
+                        continue
+                await self.refresh()
+            except Exception:
+                logger.exception("Failed to refresh the token index")
+
+
+    async def sync(self) -> None:
+        """Takes over the pairs and queries saved since the last sync which are newer than this worker's own"""
+        # Pairs are saved up to a flush interval after they were fetched, looking back further catches those
+        since, self.synced = self.synced - 2 * settings.INDEX_FLUSH_INTERVAL, time()
+        pair_rows, query_rows = await storage.run(storage.load_token_index_changes, since)
+        for row in pair_rows:
+            pair = IndexedPair.from_row(row)
+            old = self.pairs.get(pair.key)
+            if old is None or old.updated < pair.updated:
+                self.insert(pair)
+
+        for row in query_rows:
+            query, saved = row[0], IndexedQuery.from_row(row)
+            entry = self.queries.get(query)
+            if entry is None:
+                self.queries[query] = saved
+                continue
+            # Each worker counts its own hits, the larger count is kept so the query stays popular everywhere
+            if saved.searched > entry.searched:
+                entry.keys, entry.searched = saved.keys, saved.searched
+            entry.used = max(entry.used, saved.used)
+            entry.hits = max(entry.hits, saved.hits)
+
+
+    async def load(self) -> None:
+        self.synced = time()
+        pair_rows, query_rows = await storage.run(storage.load_token_index, time() - settings.INDEX_RETENTION, self.max_pairs)
+        for row in pair_rows:
+            self.insert(IndexedPair.from_row(row))
+        for row in query_rows:
+            self.queries[row[0]] = IndexedQuery.from_row(row)
+        logger.debug(f"Loaded {len(self.pairs)} indexed pairs and {len(self.queries)} queries")
+
+
+    async def start(self) -> None:
+        """Loads the saved index and starts saving and refreshing it, called from the app lifespan"""
+        if not self.enabled:
+            return
+        await self.load()
+        if self.flush_task is None:
+            self.flush_task = create_task(self.flush_periodically())
+        if self.refresh_task is None:
+            self.refresh_task = create_task(self.refresh_periodically())
+
+    async def close(self) -> None:
+        for task in (self.flush_task, self.refresh_task):
+            if task is not None:
+                task.cancel()
+        self.flush_task = self.refresh_task = None
+        if self.enabled:
+            await self.flush()
+
+
+    def stats(self) -> dict:
+        return {
+            "pairs": len(self.pairs),
+            "queries": len(self.queries),
+            "grams": len(self.grams),
+            "hits": self.hits,
+            "misses": self.misses,
+            "refreshed": self.refreshed,
+        }
+
+
+
+token_index = TokenIndex()
+
+def get_token_index() -> TokenIndex:
+    return token_index
@@ -0,0 +1,180 @@
+"""Answers inline queries ("@bot WBTC") as the user types, refining cached searches locally where it can"""
+
+from __future__ import annotations
+
+from hashlib import sha1
+from time import monotonic
+from asyncio import CancelledError, Task, create_task, sleep
+from typing import TYPE_CHECKING
+
+from telegram.constants import ParseMode
+from telegram.ext import CallbackContext, InlineQueryHandler
+from telegram import InlineQuery, InlineQueryResultArticle, InputTextMessageContent, Update
+
+from cache import MISSING
+from .utils import format_token
+from .results import ResultSet, parse_query
+from .upstream import MAX_SEARCH_RESULTS
+from .keyboards import TokenPaginationKeyboard
+from .index import get_token_index
+from metrics import get_metrics
+from settings import get_settings, get_logger
+
+# Only needed for annotations, dexscreener is imported when the first response is parsed
+if TYPE_CHECKING:
+    from dexscreener import TokenPair
+
+
+settings = get_settings()
+token_index = get_token_index()
+metrics = get_metrics()
+logger = get_logger(__name__)
+
+
+
+class InlineSearch:
+    """Keeps at most one pending inline query per user. Every keystroke sends a query which replaces the user's pending
+    one, and a query only searches once it was left alone for the debounce delay, so a burst of typing makes one search.
+
+    Results share the cache of searches sent as messages. A query extending a cached one, "WBTC" after "WBT", is
+    narrowed down from the cached results when they held every match, or when enough of them still match."""
+
+    def __init__(
+            self,
+            debounce: float = settings.INLINE_DEBOUNCE,
+            min_length: int = settings.INLINE_MIN_LENGTH,
+            results: int = settings.INLINE_RESULTS,
+        ) -> None:
+        self.debounce = debounce
+        self.min_length = min_length
+        self.results = results
+        self.tasks: dict[int, Task] = {}
+
+        self.queries = 0
+        self.superseded = 0
+        self.refined = 0
+        self.indexed = 0
+        self.searched = 0
+        self.failed = 0
+
+
+    def create_handler(self) -> InlineQueryHandler:
+        return InlineQueryHandler(self.handle)
+
+    async def handle(self, update: Update, context: CallbackContext) -> None:
+        """Replaces the user's pending query, it is answered in the background so the user's next keystroke isn't held up"""
+        inline_query = update.inline_query
+        user_id = inline_query.from_user.id
+        self.queries += 1
+        self.cancel(user_id)
+        if len(inline_query.query.strip()) < self.min_length:
+            return
+
+        self.tasks[user_id] = task = create_task(self.run(update, monotonic()))
+        task.add_done_callback(lambda task: self.tasks.pop(user_id, None) if self.tasks.get(user_id) is task else None)
+
+    def cancel(self, user_id: int) -> None:
+        task = self.tasks.pop(user_id, None)
+        if task is not None and not task.done():
+            task.cancel()
+            self.superseded += 1
+
+
+    async def run(self, update: Update, started: float) -> None:
+        inline_query = update.inline_query
+        try:
+            # Asking for more results of the same query isn't typing, only new text waits
+            if not inline_query.offset:
+                await sleep(self.debounce)
+            results = await self.search(inline_query.query)
+            await self.answer(inline_query, results)
+        except CancelledError:
+            raise
+        except Exception:
+            self.failed += 1
+            logger.warning(f"Failed to answer the inline query {inline_query.query!r}", exc_info = True)
+        finally:
+            metrics.observe_handler(type(self).__name__, update, started)
+
+
+    async def search(self, text: str) -> ResultSet:
+        query, filter_text, sort, descending, top = parse_query(text)
+        key = TokenPaginationKeyboard.cache_key(query, filter_text)
+        if key not in TokenPaginationKeyboard.cache:
+            results = self.refine(*key)
+            if results is not None:
+                self.refined += 1
+                return results.arrange(sort, descending, top)
+
+            # Otherwise pairs seen in earlier searches may fill the answer, filters aren't applied to them
+            if not filter_text:
+                pairs = token_index.match(query, self.results)
+                if len(pairs) >= self.results:
+                    self.indexed += 1
+                    return ResultSet(pairs).arrange(sort, descending, top)
+
+        self.searched += 1
+        return await TokenPaginationKeyboard.get_results(text)
+
+
+    def refine(self, query: str, filter_text: str) -> ResultSet | None:
+        """Narrows down the results of the longest cached prefix of a normalized query, None if they can't stand in for a search"""
+        cache = TokenPaginationKeyboard.cache
+        for end in range(len(query) - 1, self.min_length - 1, -1):
+            prefix_key = (query[:end], filter_text)
+            results = cache.get(prefix_key, record = False)
+            if results is MISSING:
+                continue
+
+            refined = results.matching(query)
+            # Every pair the prefix matched was returned, so these are every pair the query matches as well
+            if len(results.pairs) < MAX_SEARCH_RESULTS:
+                # Expires with the results it came from, so refining again doesn't keep old prices around
+                cache.set((query, filter_text), refined, cache.expires_in(prefix_key))
+                return refined
+            # The prefix's results were cut off, they still do for typeahead if they fill the answer
+            return refined if len(refined) >= self.results else None
+        return None
+
+
+    async def answer(self, inline_query: InlineQuery, results: ResultSet) -> None:
+        try:
+            offset = max(0, int(inline_query.offset or 0))
+        except ValueError:
+            offset = 0
+
+        end = min(offset + self.results, len(results))
+        articles = [ self.article(results[i]) for i in range(offset, end) ]
+        await inline_query.answer(
+            articles, cache_time = settings.INLINE_CACHE_TIME, next_offset = str(end) if end < len(results) else "",
+        )
+
+
+    @staticmethod
+    def article(token: TokenPair) -> InlineQueryResultArticle:
+        liquidity = token.liquidity.usd if token.liquidity and token.liquidity.usd is not None else 0
+        price = f"{token.price_usd:,.8g} USD" if token.price_usd is not None else f"{token.price_native:,.8g} {token.quote_token.symbol}"
+        return InlineQueryResultArticle(
+            # Result ids are limited to 64 bytes, some chains have long addresses
+            id = sha1(f"{token.chain_id}:{token.pair_address}".encode()).hexdigest(),
+            title = f"{token.base_token.symbol}/{token.quote_token.symbol} on {token.dex_id.title()}",
+            description = f"{token.chain_id.title()}  {price}\nLiquidity: {liquidity:,.0f} USD",
+            input_message_content = InputTextMessageContent(format_token(token), parse_mode = ParseMode.HTML),
+        )
+
+
+    def close(self) -> None:
+        for user_id in list(self.tasks):
+            self.cancel(user_id)
+
+
+    def stats(self) -> dict:
+        return {
+            "pending": len(self.tasks),
+            "queries": self.queries,
+            "superseded": self.superseded,
+            "refined": self.refined,
+            "indexed": self.indexed,
+            "searched": self.searched,
+            "failed": self.failed,
+        }
@@ -1,17 +1,38 @@
 """Contains classes for generating inline keyboards and handling their callback queries"""
 
+from __future__ import annotations
+
+from math import ceil
+from time import monotonic
+from asyncio import gather
+from functools import partial
 from json import dumps, loads
-from dexscreener import DexscreenerClient, TokenPair
+from typing import TYPE_CHECKING
 
 from telegram.constants import ParseMode
 from telegram.ext import CallbackQueryHandler, CallbackContext
 from telegram import error, Update, InlineKeyboardMarkup, InlineKeyboardButton
 
-from .utils import format_token
-from .filters import TokenFilter
+from cache import AsyncLRUCache, MISSING
+from .utils import format_token, format_token_summary, normalize_query
+from .callbacks import CallbackData
+from .prefetch import get_prefetcher
+from .index import get_token_index
+from .upstream import get_gateway, MAX_PAIRS_PER_REQUEST
+from .results import ResultSet, parse_query
+from metrics import get_metrics
+from settings import get_settings
 from storage import get_storage, get_logger, DatabaseTables
 
+# Only needed for annotations, dexscreener is imported when the first response is parsed
+if TYPE_CHECKING:
+    from dexscreener import TokenPair
+
 storage = get_storage()
+settings = get_settings()
+prefetcher = get_prefetcher()
+token_index = get_token_index()
+metrics = get_metrics()
 logger = get_logger(__name__)
 
 
@@ -32,16 +53,29 @@ class KeyboardHandler:
         handler = CallbackQueryHandler(cls.run, pattern = cls.pattern+':.+')
         return handler
 
+    @classmethod
+    async def encode_data(cls, value: str | int, identifier: str) -> str:
+        """Returns the callback data for a button of this keyboard, which carries the query or pair it belongs to"""
+        return await CallbackData.encode(cls.pattern, value, identifier)
+
     @classmethod
     def parse_data(cls, update: Update, context: CallbackContext) -> str:
         """This seperates the callback data (the page number) from the callback pattern"""
         # Returns None if no callback query is found, which means the keyboard markup doesn't exist
         if update.callback_query:
-            data = update.callback_query.data.split(':')[-1]
+            data = CallbackData.split(update.callback_query.data)[1]
         else:
             data = None
         return data
 
+    @classmethod
+    async def parse_identifier(cls, update: Update, context: CallbackContext) -> str | None:
+        """Returns the query or pair the pressed button belongs to, None for buttons made before callback data carried it"""
+        if not update.callback_query:
+            return None
+        reference = CallbackData.split(update.callback_query.data)[2]
+        return await CallbackData.resolve(reference) if reference is not None else None
+
 
     @classmethod
     async def handle(cls, update: Update, context: CallbackContext):
@@ -62,6 +96,7 @@ class KeyboardHandler:
         """This is the callback for the callback query handler"""
         if not await cls.answer(update, context):
             return
+        started = monotonic()
         try:
             await update.callback_query.answer()
         except error.BadRequest:
@@ -69,15 +104,17 @@ class KeyboardHandler:
             await update.effective_message.reply_text("Run the command again", reply_to_message_id = update.effective_message.id)
         else:
             await cls.handle(update, context)
+        finally:
+            metrics.observe_handler(cls.__name__, update, started)
 
 
 
 class PaginationKeyboardHandler(KeyboardHandler):
     @classmethod
-    async def generate_markup(cls, current: int, last: int,  update: Update, context: CallbackContext) -> InlineKeyboardMarkup:
+    async def generate_markup(cls, current: int, last: int, identifier: str, update: Update, context: CallbackContext) -> InlineKeyboardMarkup:
         keyboard = [
-            [InlineKeyboardButton("Previous", callback_data = f"{cls.pattern}:{current-1}"), ] if current!=1 else [],
-            [InlineKeyboardButton("Next", callback_data = f"{cls.pattern}:{current+1}"), ] if current < last else [],
+            [InlineKeyboardButton("Previous", callback_data = await cls.encode_data(current-1, identifier)), ] if current!=1 else [],
+            [InlineKeyboardButton("Next", callback_data = await cls.encode_data(current+1, identifier)), ] if current < last else [],
         ]
 
         markup = InlineKeyboardMarkup(keyboard)
@@ -102,48 +139,85 @@ class PaginationKeyboardHandler(KeyboardHandler):
 
 class TokenPaginationKeyboard(PaginationKeyboardHandler):
     pattern = "token"
-    client = DexscreenerClient()
+    client = get_gateway()
+    # Filtered result sets keyed by the normalized query and filter text, so page flips don't refetch
+    cache = AsyncLRUCache(settings.SEARCH_CACHE_SIZE, settings.SEARCH_CACHE_TTL)
+
+    @classmethod
+    def cache_key(cls, identifier: str, filter_text: str) -> tuple[str, str]:
+        """Normalizes the query and filter text so equivalent searches share a cache entry, case sensitive addresses keep their case"""
+        return normalize_query(identifier), " ".join(filter_text.lower().split())
+
+    @classmethod
+    async def get_results(cls, identifier: str) -> ResultSet:
+        """Gets the results of a search message in the order it asks for, searching once if they aren't cached"""
+        query, filter_text, sort, descending, top = parse_query(identifier)
+
+        async def search() -> ResultSet:
+            # Popular queries are answered from the local index while its prices are recent
+            pairs = token_index.search(query)
+            if pairs is None:
+                pairs = await cls.client.search_pairs_async(query)
+                token_index.remember(query, pairs)
+            return ResultSet(pairs).filter(filter_text)
+
+        results = await cls.cache.get_or_load(cls.cache_key(query, filter_text), search)
+        # Sorted views are kept on the cached result set, so only the first page sorts
+        return results.arrange(sort, descending, top)
 
     @classmethod
     async def get_data(cls, identifier: str, page: int, update: Update, context: CallbackContext) -> tuple[TokenPair, int]:
-        identifier = identifier.split("/filter")
-        filter_text = " ".join(identifier[1:]).strip() if len(identifier) > 1 else ""
-        identifier = identifier[0]
+        results = await cls.get_results(identifier)
+        token = results[page-1] if 0 < page <= len(results) else None
 
-        tokens = await cls.client.search_pairs_async(identifier)
-        filtered = list(TokenFilter.filter(filter_text, tokens)) if filter_text else tokens
-        token = filtered[page-1] if filtered else None
+        return token, len(results)
 
-        return token, len(filtered)
+
+    @classmethod
+    async def prefetch(cls, user_id: int, identifier: str, page: int) -> None:
+        """Renders the pages next to the one just shown. The detailed view isn't warmed, no button of a search page opens it"""
+        query, filter_text, *_ = parse_query(identifier)
+        # The result set holds every page, only reloading it after it expired reaches DexScreener
+        if cls.cache_key(query, filter_text) not in cls.cache and not prefetcher.spend(user_id):
+            return
+
+        for neighbour in (page + 1, page - 1):
+            token, _ = await cls.get_data(identifier, neighbour, None, None)
+            if token:
+                format_token(token)
 
 
     @classmethod
-    async def handle(cls, update: Update, context: CallbackContext) -> None:
+    async def handle(cls, update: Update, context: CallbackContext, identifier: str | None = None) -> None:
         page = cls.parse_data(update, context)
         new = not bool(page)
         page = page or 1
-        user_data = storage.get_user_data(update.effective_user.id, DatabaseTables.USERS)
-
-        # This happens if the server restarted and a user tries to interact with a previously generated keyboard
-        if user_data["query_search"] is None:
-            # Try to get the arguments from the replied to message
-            message = update.effective_message.reply_to_message
-            found = False
-            if message:
-                try:
-                    query_search = " ".join(message.text.split(" ")[1:])
-                    storage.set_user_data(update.effective_user.id, DatabaseTables.USERS, query_search = dumps(query_search))
-                    user_data = storage.get_user_data(update.effective_user.id, DatabaseTables.USERS)
-                    found = True
-                except IndexError:
-                    pass
-
-            if not found:
-                await update.effective_message.reply_text("Please search again")
-                return
-
-        # Load value in TEXT column from string
-        identifier = loads(user_data["query_search"])
+        identifier = identifier or await cls.parse_identifier(update, context)
+
+        # Buttons made before callback data carried the query fall back to the last search saved for the user
+        if identifier is None:
+            user_data = await storage.get_user_data_async(update.effective_user.id, DatabaseTables.USERS)
+
+            # This happens if the server restarted and a user tries to interact with a previously generated keyboard
+            if user_data["query_search"] is None:
+                # Try to get the arguments from the replied to message
+                message = update.effective_message.reply_to_message
+                found = False
+                if message:
+                    try:
+                        query_search = " ".join(message.text.split(" ")[1:])
+                        await storage.set_user_data_async(update.effective_user.id, DatabaseTables.USERS, query_search = dumps(query_search))
+                        user_data = await storage.get_user_data_async(update.effective_user.id, DatabaseTables.USERS)
+                        found = True
+                    except IndexError:
+                        pass
+
+                if not found:
+                    await update.effective_message.reply_text("Please search again")
+                    return
+
+            # Load value in TEXT column from string
+            identifier = loads(user_data["query_search"])
 
         token, last = await cls.get_data(identifier, page, update, context)
         if token:
@@ -152,23 +226,76 @@ class TokenPaginationKeyboard(PaginationKeyboardHandler):
         else:
             text = f"Page {page} not found for {identifier}"
 
-        markup = await cls.generate_markup(page, last, update, context)
+        markup = await cls.generate_markup(page, last, identifier, update, context)
 
         if new:
             await update.effective_message.reply_html(text, reply_to_message_id = update.effective_message.id, reply_markup = markup)
         else:
             await update.effective_message.edit_text(text, parse_mode = ParseMode.HTML, reply_markup = markup, disable_web_page_preview = False)
 
+        # Users usually open the next page next, get it ready while they read this one
+        if token:
+            prefetcher.schedule(update.effective_user.id, partial(cls.prefetch, update.effective_user.id, identifier, page))
+
 
 
 class TokenDetailsKeyboard(KeyboardHandler):
     pattern = "details"
+    # Short lived pair snapshots, concurrent lookups of the same pair share one upstream request
+    cache = AsyncLRUCache(settings.PAIR_CACHE_SIZE, settings.PAIR_CACHE_TTL)
+
+    @classmethod
+    async def get_pair(cls, chain: str, address: str) -> TokenPair | None:
+        """Gets a token pair from the cache, fetching it once if it is missing or stale"""
+        key = (chain.lower(), address)
+
+        async def load() -> TokenPair | None:
+            # A search may have just returned the pair
+            token = token_index.get_pair(chain, address, settings.PAIR_CACHE_TTL)
+            if token is None:
+                tokens = await TokenPaginationKeyboard.client.get_token_pair_async(chain, address)
+                token_index.add(tokens, tokens.fetched)
+                token = tokens[0] if tokens else None
+            return token
+
+        return await cls.cache.get_or_load(key, load)
+
+    @classmethod
+    async def get_pairs(cls, chain: str, addresses: list[str]) -> list[TokenPair | None]:
+        """Gets several pairs of one chain, the ones which aren't cached are fetched in as few requests as the API allows"""
+        chain = chain.lower()
+        found = { address: cls.cache.get((chain, address)) for address in addresses }
+        for address, token in found.items():
+            if token is MISSING:
+                found[address] = token_index.get_pair(chain, address, settings.PAIR_CACHE_TTL) or MISSING
+        missing = [ address for address, token in found.items() if token is MISSING ]
+
+        chunks = [ missing[i:i+MAX_PAIRS_PER_REQUEST] for i in range(0, len(missing), MAX_PAIRS_PER_REQUEST) ]
+        fetched = await gather(*(TokenPaginationKeyboard.client.get_token_pair_list_async(chain, chunk) for chunk in chunks))
+
+        # EVM addresses may come back in a different case than they were sent in
+        by_address = { token.pair_address.lower(): token for tokens in fetched for token in tokens }
+        for tokens in fetched:
+            token_index.add(tokens, tokens.fetched)
+        for address in missing:
+            found[address] = by_address.get(address.lower())
+            cls.cache.set((chain, address), found[address])
+
+        return [ found[address] for address in addresses ]
 
     @classmethod
-    async def generate_markup(cls, details: str, update: Update, context: CallbackContext) -> InlineKeyboardMarkup:
+    async def prefetch(cls, token: TokenPair) -> None:
+        """Caches a pair shown by another view if it isn't cached yet and renders its detailed message"""
+        key = (token.chain_id.lower(), token.pair_address)
+        if key not in cls.cache:
+            cls.cache.set(key, token)
+        format_token(token, True)
+
+    @classmethod
+    async def generate_markup(cls, details: str, identifier: str, update: Update, context: CallbackContext) -> InlineKeyboardMarkup:
         details = "more" if details == "less" else "less"
         keyboard = [
-            [InlineKeyboardButton(f"{details.title()} Details", callback_data = f"{cls.pattern}:{details}"), ],
+            [InlineKeyboardButton(f"{details.title()} Details", callback_data = await cls.encode_data(details, identifier)), ],
         ]
 
         markup = InlineKeyboardMarkup(keyboard)
@@ -178,34 +305,90 @@ class TokenDetailsKeyboard(KeyboardHandler):
     @classmethod
     async def handle(cls, update: Update, context: CallbackContext):
         details = cls.parse_data(update, context).lower()
-
-        # TODO: Get the chain and address
-        user_data = storage.get_user_data(update.effective_user.id, DatabaseTables.USERS)
-        query_pair = user_data["query_pair"]
-
-        # This happens if the server restarted and a user tries to interact with a previously generated keyboard
-        if query_pair is None:
-            # Try to get the arguments from the replied to message
-            message = update.effective_message.reply_to_message
-            found = False
-            if message:
-                try:
-                    query_pair = " ".join(message.text.split(" ")[1:])
-                    storage.set_user_data(update.effective_user.id, DatabaseTables.USERS, query_pair = dumps(query_pair))
-                    user_data = storage.get_user_data(update.effective_user.id, DatabaseTables.USERS)
-                    found = True
-                except IndexError:
-                    pass
-
-            if not found:
-                await update.effective_message.reply_text("Please search again")
-                return
-
-        chain, address = loads(query_pair).split(" ")
-        token = await TokenPaginationKeyboard.client.get_token_pair_async(chain, address)
+        identifier = await cls.parse_identifier(update, context)
+
+        # Buttons made before callback data carried the pair fall back to the last pair saved for the user
+        if identifier is None:
+            user_data = await storage.get_user_data_async(update.effective_user.id, DatabaseTables.USERS)
+            query_pair = user_data["query_pair"]
+
+            # This happens if the server restarted and a user tries to interact with a previously generated keyboard
+            if query_pair is None:
+                # Try to get the arguments from the replied to message
+                message = update.effective_message.reply_to_message
+                found = False
+                if message:
+                    try:
+                        query_pair = dumps(" ".join(message.text.split(" ")[1:]))
+                        await storage.set_user_data_async(update.effective_user.id, DatabaseTables.USERS, query_pair = query_pair)
+                        found = True
+                    except IndexError:
+                        pass
+
+                if not found:
+                    await update.effective_message.reply_text("Please search again")
+                    return
+
+            identifier = loads(query_pair)
+
+        chain, address = identifier.split(" ")
+        token = await cls.get_pair(chain, address)
         text = format_token(token, details == "more")
 
-        markup = await cls.generate_markup(details, update, context)
+        markup = await cls.generate_markup(details, identifier, update, context)
         await update.effective_message.edit_text(text, parse_mode = ParseMode.HTML, reply_markup = markup, disable_web_page_preview = False)
 
 
+
+
+
+class PairListKeyboard(PaginationKeyboardHandler):
+    pattern = "pairs"
+
+    @classmethod
+    def parse_addresses(cls, identifier: str) -> tuple[str, list[str]]:
+        """Splits "<chain> <address>,<address>,..." into the chain and unique addresses, in the order they were sent"""
+        chain, _, addresses = identifier.strip().partition(" ")
+        addresses = list(dict.fromkeys( i.strip() for i in addresses.split(",") if i.strip() ))
+        return chain, addresses[:settings.PAIR_LIST_MAX]
+
+    @classmethod
+    async def get_data(cls, identifier: str, page: int, update: Update, context: CallbackContext) -> tuple[list[tuple[str, TokenPair | None]], int]:
+        chain, addresses = cls.parse_addresses(identifier)
+        # Every page is fetched at once since a request covers more pairs than a page shows, later pages come from the cache
+        pairs = list(zip(addresses, await TokenDetailsKeyboard.get_pairs(chain, addresses)))
+
+        size = settings.PAIR_LIST_PAGE_SIZE
+        last = max(1, ceil(len(pairs) / size))
+        return pairs[(page-1)*size:page*size], last
+
+
+    @classmethod
+    async def handle(cls, update: Update, context: CallbackContext, identifier: str | None = None) -> None:
+        page = cls.parse_data(update, context)
+        new = not bool(page)
+        page = page or 1
+        identifier = identifier or await cls.parse_identifier(update, context)
+
+        # Every list keyboard was made with the addresses in its callback data, this happens if they were purged since
+        if identifier is None:
+            await update.effective_message.reply_text("Please search again")
+            return
+
+        chain = identifier.split(" ")[0]
+
+        pairs, last = await cls.get_data(identifier, page, update, context)
+        start = (page-1) * settings.PAIR_LIST_PAGE_SIZE
+        if pairs:
+            text = f"{chain.title()} pairs, page {page} of {last}\n\n" + "\n\n".join(
+                format_token_summary(start+i+1, address, token) for i, (address, token) in enumerate(pairs)
+            )
+        else:
+            text = f"Page {page} not found for {identifier}"
+
+        markup = await cls.generate_markup(page, last, identifier, update, context)
+
+        if new:
+            await update.effective_message.reply_html(text, reply_to_message_id = update.effective_message.id, reply_markup = markup, disable_web_page_preview = True)
+        else:
+            await update.effective_message.edit_text(text, parse_mode = ParseMode.HTML, reply_markup = markup, disable_web_page_preview = True)
@@ -0,0 +1,108 @@
+"""Runs speculative work in the background after a reply, so the page a user opens next is usually ready"""
+
+from asyncio import CancelledError, Task, create_task
+from typing import Awaitable, Callable
+
+from .ratelimit import TokenBucket
+from settings import get_settings, get_logger
+
+
+settings = get_settings()
+logger = get_logger(__name__)
+
+
+
+class Prefetcher:
+    """Keeps at most one prefetch task per user, a new one cancels the last since the user has moved on.
+    Jobs call `spend` before anything which may reach DexScreener, which draws from the user's budget."""
+
+    def __init__(
+            self,
+            enabled: bool = settings.PREFETCH_ENABLED,
+            rate: float = settings.PREFETCH_RATE,
+            burst: float = settings.PREFETCH_BURST,
+            max_tasks: int = settings.PREFETCH_MAX_TASKS,
+        ) -> None:
+        self.enabled = enabled
+        # Budgets are refilled at rate prefetches per minute
+        self.rate = rate / 60
+        self.burst = burst
+        self.max_tasks = max_tasks
+        self.tasks: dict[int, Task] = {}
+        self.budgets: dict[int, TokenBucket] = {}
+
+        self.scheduled = 0
+        self.cancelled = 0
+        self.skipped = 0
+        self.failed = 0
+
+
+    def budget(self, user_id: int) -> TokenBucket:
+        bucket = self.budgets.get(user_id)
+        if bucket is None:
+            # Drop the budgets of users who haven't prefetched recently before adding more
+            if len(self.budgets) >= settings.PREFETCH_BUDGETS:
+                self.budgets = { key: value for key, value in self.budgets.items() if not value.idle() }
+            bucket = self.budgets[user_id] = TokenBucket(self.rate, self.burst)
+        return bucket
+
+    def spend(self, user_id: int) -> bool:
+        """Takes one upstream prefetch from the user's budget, False if it is used up"""
+        if self.budget(user_id).try_acquire():
+            return True
+        self.skipped += 1
+        return False
+
+
+    def schedule(self, user_id: int, job: Callable[[], Awaitable[None]]) -> None:
+        """Starts a prefetch for the user, cancelling the one still running from their last request"""
+        if not self.enabled:
+            return
+
+        self.cancel(user_id)
+        if len(self.tasks) >= self.max_tasks:
+            self.skipped += 1
+            return
+
+        self.scheduled += 1
+        self.tasks[user_id] = task = create_task(self.run(job))
+        task.add_done_callback(lambda task: self.tasks.pop(user_id, None) if self.tasks.get(user_id) is task else None)
+
+    def cancel(self, user_id: int) -> None:
+        task = self.tasks.pop(user_id, None)
+        if task is not None and not task.done():
+            task.cancel()
+            self.cancelled += 1
+
+
+    async def run(self, job: Callable[[], Awaitable[None]]) -> None:
+        try:
+            await job()
+        except CancelledError:
+            raise
+        except Exception:
+            # A failed prefetch only means the next page is loaded when it is opened
+            self.failed += 1
+            logger.debug("Prefetch failed", exc_info = True)
+
+
+    def close(self) -> None:
+        for user_id in list(self.tasks):
+            self.cancel(user_id)
+
+
+    def stats(self) -> dict:
+        return {
+            "running": len(self.tasks),
+            "scheduled": self.scheduled,
+            "cancelled": self.cancelled,
+            "skipped": self.skipped,
+            "failed": self.failed,
+        }
+
+
+
+prefetcher = Prefetcher()
+
+def get_prefetcher() -> Prefetcher:
+    return prefetcher
@@ -0,0 +1,128 @@
+"""Processes updates from different chats concurrently while keeping each chat's updates in order"""
+
+from time import monotonic
+from asyncio import Lock, Semaphore
+from typing import Any, Awaitable, Hashable
+
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+from metrics import get_metrics
+from settings import get_settings, get_logger
+
+
+settings = get_settings()
+metrics = get_metrics()
+logger = get_logger(__name__)
+update_seconds = metrics.histogram("bot_update_seconds", "Time from the webhook receiving an update to all of its handlers finishing")
+
+
+
+class ChatOrderedUpdateProcessor(BaseUpdateProcessor):
+    """Runs up to max_concurrent_updates handlers at a time, but never two updates of the same chat at once.
+
+    The semaphore of the base class only bounds how many updates can be waiting here, the workers semaphore is taken
+    after the chat lock so updates queued behind a busy chat don't hold a worker slot other chats could use.
+
+    The application takes updates off its queue as soon as they arrive and starts a task for each one, so the queue
+    alone doesn't bound the backlog. The webhook admits updates here instead, an admitted update holds a backlog slot
+    from being queued until it was processed, and no more than max_backlog updates are admitted at once."""
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int, max_backlog: int) -> None:
+        super().__init__(max_pending_updates)
+        self.workers = Semaphore(max_concurrent_updates)
+        self.worker_count = max_concurrent_updates
+
+        # Ids of the admitted updates which haven't finished processing
+        self.admitted: set[int] = set()
+        self.max_backlog = max_backlog
+
+        # Lock and number of updates holding or waiting on it for each chat, dropped once the chat has nothing pending
+        self.chat_locks: dict[Hashable, list[Lock | int]] = {}
+
+        self.pending = 0
+        self.in_flight = 0
+        self.processed = 0
+
+
+    @property
+    def full(self) -> bool:
+        return len(self.admitted) >= self.max_backlog
+
+    def admit(self, update_id: int) -> bool:
+        """Takes a backlog slot for an update about to be queued, returns False if the backlog is full"""
+        if self.full:
+            return False
+        self.admitted.add(update_id)
+        return True
+
+    def release(self, update_id: int) -> None:
+        self.admitted.discard(update_id)
+
+
+    @staticmethod
+    def chat_key(update: object) -> Hashable | None:
+        """The chat or user an update belongs to, updates with the same key are processed in order"""
+        if isinstance(update, Update):
+            if update.effective_chat:
+                return update.effective_chat.id
+            if update.effective_user:
+                return ("user", update.effective_user.id)
+        return None
+
+
+    async def do_process_update(self, update: object, coroutine: Awaitable[Any]) -> None:
+        key = self.chat_key(update)
+        self.pending += 1
+        try:
+            if key is None:
+                await self.run(coroutine)
+                return
+
+            entry = self.chat_locks.setdefault(key, [Lock(), 0])
+            entry[1] += 1
+            try:
+                # Lock waiters are woken first come first served, so updates keep their queue order
+                async with entry[0]:
+                    await self.run(coroutine)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self.chat_locks[key]
+        finally:
+            self.pending -= 1
+            self.release(getattr(update, "update_id", None))
+            received = metrics.received_at.pop(getattr(update, "update_id", None), None)
+            if received is not None:
+                update_seconds.observe(monotonic() - received)
+
+
+    async def run(self, coroutine: Awaitable[Any]) -> None:
+        async with self.workers:
+            self.in_flight += 1
+            try:
+                await coroutine
+            finally:
+                self.in_flight -= 1
+                self.processed += 1
+
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+    def stats(self) -> dict:
+        return {
+            "backlog": len(self.admitted),
+            "max_backlog": self.max_backlog,
+            "pending": self.pending,
+            # Waiting behind an earlier update of their chat or for a worker slot
+            "waiting": self.pending - self.in_flight,
+            "in_flight": self.in_flight,
+            "max_in_flight": self.worker_count,
+            "active_chats": len(self.chat_locks),
+            "processed": self.processed,
+        }
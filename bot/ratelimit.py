@@ -0,0 +1,172 @@
+"""Schedules outgoing Telegram requests within the flood limits, replies to users go before log traffic"""
+
+from enum import IntEnum
+from itertools import count
+from time import monotonic
+from heapq import heappop, heappush
+from asyncio import Future, TimerHandle, get_running_loop, sleep
+from typing import Any, Callable, Coroutine
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from settings import get_settings, get_logger
+
+
+settings = get_settings()
+logger = get_logger(__name__)
+
+
+
+class SendPriority(IntEnum):
+    """Passed as rate_limit_args to bot methods, lower values are sent first"""
+    REPLY = 0
+    LOG = 1
+    BROADCAST = 2
+
+
+
+class TokenBucket:
+    """Allows rate requests per second with bursts of up to capacity, waiters are served by priority and then in arrival order"""
+
+    # Shared so waiters of every bucket can be ordered by arrival
+    counter = count()
+
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = monotonic()
+
+        self.waiters: list[tuple[int, int, Future]] = []
+        self.timer: TimerHandle | None = None
+
+
+    def refill(self) -> None:
+        now = monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def idle(self) -> bool:
+        """True if the bucket is full with nobody waiting, so it can be dropped without changing behaviour"""
+        self.refill()
+        return not self.waiters and self.tokens >= self.capacity
+
+
+    def try_acquire(self) -> bool:
+        """Takes a token without waiting, False if none is available or somebody is already waiting for one"""
+        self.refill()
+        if self.waiters or self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+
+    async def acquire(self, priority: int = SendPriority.REPLY) -> None:
+        future = get_running_loop().create_future()
+        heappush(self.waiters, (priority, next(self.counter), future))
+        self.wake()
+        await future
+
+
+    def on_timer(self) -> None:
+        self.timer = None
+        self.wake()
+
+    def wake(self) -> None:
+        """Hands out available tokens to waiters and schedules itself again for when the next token is due"""
+        self.refill()
+        while self.waiters and self.tokens >= 1:
+            *_, future = heappop(self.waiters)
+            # Waiters which were cancelled don't use up a token
+            if not future.done():
+                self.tokens -= 1
+                future.set_result(None)
+
+        if self.waiters and self.timer is None:
+            self.timer = get_running_loop().call_later((1 - self.tokens) / self.rate, self.on_timer)
+
+
+
+class SendScheduler(BaseRateLimiter[SendPriority]):
+    """Rate limiter for the bot with one global bucket and one bucket per chat. Requests are retried after the
+    delay Telegram asks for when they are still throttled."""
+
+    def __init__(
+            self,
+            global_rate: float = settings.SEND_GLOBAL_RATE,
+            chat_rate: float = settings.SEND_CHAT_RATE,
+            group_rate: float = settings.SEND_GROUP_RATE,
+            chat_burst: float = settings.SEND_CHAT_BURST,
+            max_retries: int = settings.SEND_MAX_RETRIES,
+        ) -> None:
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_buckets: dict[int | str, TokenBucket] = {}
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+
+        self.sent = 0
+        self.retried = 0
+
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+    def chat_bucket(self, chat_id: int | str) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            # Drop the buckets of chats which haven't sent anything recently before adding more
+            if len(self.chat_buckets) >= settings.SEND_CHAT_BUCKETS:
+                self.chat_buckets = { key: value for key, value in self.chat_buckets.items() if not value.idle() }
+
+            # Groups and channels have negative ids or usernames and a lower limit than private chats
+            group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if group else self.chat_rate
+            bucket = self.chat_buckets[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+
+    async def process_request(
+            self,
+            callback: Callable[..., Coroutine[Any, Any, bool | dict | list[dict]]],
+            args: Any,
+            kwargs: dict[str, Any],
+            endpoint: str,
+            data: dict[str, Any],
+            rate_limit_args: SendPriority | None,
+        ) -> bool | dict | list[dict]:
+        priority = SendPriority.REPLY if rate_limit_args is None else rate_limit_args
+        chat_id = data.get("chat_id")
+
+        for attempt in range(self.max_retries + 1):
+            # The chat bucket is waited on first so a throttled chat doesn't hold on to a global token
+            if chat_id is not None:
+                await self.chat_bucket(chat_id).acquire(priority)
+            await self.global_bucket.acquire(priority)
+
+            try:
+                result = await callback(*args, **kwargs)
+            except RetryAfter as exception:
+                if attempt == self.max_retries:
+                    raise
+                self.retried += 1
+                logger.warning(f"Flood limit hit on {endpoint} for chat {chat_id}, retrying in {exception.retry_after} seconds")
+                await sleep(exception.retry_after)
+            else:
+                self.sent += 1
+                return result
+
+
+    def stats(self) -> dict:
+        return {
+            "sent": self.sent,
+            "retried": self.retried,
+            "waiting": len(self.global_bucket.waiters),
+            "chat_buckets": len(self.chat_buckets),
+        }
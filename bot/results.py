@@ -0,0 +1,153 @@
+"""Columnar result sets for sorting, ranking and filtering search results without touching every TokenPair"""
+
+from __future__ import annotations
+
+import re
+from time import time
+from typing import TYPE_CHECKING
+
+from .filters import TokenFilter, OPERATORS
+from startup import lazy_import
+from settings import get_settings, get_logger
+
+# Only needed for annotations, dexscreener is imported when the first response is parsed
+if TYPE_CHECKING:
+    from dexscreener import TokenPair
+
+
+settings = get_settings()
+logger = get_logger(__name__)
+# Loaded on the first search instead of at boot
+np = lazy_import("numpy")
+
+# Search flags users can add after the query, e.g. "WBTC /filter chain=ethereum /sort liquidity". A flag is a word of
+# its own, at the start of the text or after whitespace, so names and queries containing "/top" like "A/top" aren't cut
+FLAG_PATTERN = re.compile(r"(?:^|\s+)(/filter|/sort|/top)(?=\s|$)\s*")
+
+
+
+class ResultSet:
+    """Token pairs of one search along with a typed column per numeric field.
+    Sorting and filtering only reorder an index array, the token pairs themselves are never copied."""
+
+    def __init__(self, pairs: list[TokenPair], columns: dict[str, np.ndarray] | None = None, order: np.ndarray | None = None) -> None:
+        self.pairs = pairs
+        self.columns = columns if columns is not None else self.build_columns(pairs)
+        self.order = order if order is not None else np.arange(len(pairs))
+        # Sorted views are kept so page flips reuse the same index
+        self.views: dict[tuple, "ResultSet"] = {}
+
+
+    @classmethod
+    def build_columns(cls, pairs: list[TokenPair]) -> dict[str, np.ndarray]:
+        """Reads every numeric field once, missing values become NaN so they never pass a comparison"""
+        columns = {
+            name: np.array([ getter(pair) for pair in pairs ], dtype = np.float64)
+            for name, getter in TokenFilter.fields.items() if name != "age"
+        }
+        columns["created"] = np.array([ pair.pair_created_at.timestamp() if pair.pair_created_at else None for pair in pairs ], dtype = np.float64)
+        columns["chain"] = np.array([ pair.chain_id for pair in pairs ], dtype = object)
+        columns["dex"] = np.array([ pair.dex_id for pair in pairs ], dtype = object)
+        return columns
+
+
+    def __len__(self) -> int:
+        return len(self.order)
+
+    def __getitem__(self, index: int) -> TokenPair:
+        return self.pairs[self.order[index]]
+
+    def __iter__(self):
+        return (self.pairs[i] for i in self.order)
+
+
+    def has_column(self, name: str) -> bool:
+        return name == "age" or name in self.columns
+
+    def column(self, name: str) -> np.ndarray:
+        """Returns a column in the order of this view"""
+        if name == "age":
+            return time() - self.columns["created"][self.order]
+        return self.columns[name][self.order]
+
+    def view(self, order: np.ndarray) -> "ResultSet":
+        return ResultSet(self.pairs, self.columns, order)
+
+
+    def sort(self, name: str, descending: bool = True) -> "ResultSet":
+        """Returns a view sorted by a column, pairs missing the value go last"""
+        key = ("sort", name, descending)
+        if key not in self.views:
+            values = self.column(name)
+            if values.dtype == object:
+                ranks = np.argsort(values, kind = "stable")
+                ranks = ranks[::-1] if descending else ranks
+            else:
+                # NaN sorts last either way, so negate instead of reversing for descending order
+                ranks = np.argsort(-values if descending else values, kind = "stable")
+            self.views[key] = self.view(self.order[ranks])
+        return self.views[key]
+
+
+    def top(self, name: str, count: int) -> "ResultSet":
+        """Returns a view of the highest values of a column, without sorting the whole column"""
+        key = ("top", name, count)
+        if key not in self.views:
+            values = np.nan_to_num(self.column(name), nan = -np.inf)
+            if count < len(values):
+                best = np.argpartition(-values, count)[:count]
+            else:
+                best = np.arange(len(values))
+            best = best[np.argsort(-values[best], kind = "stable")]
+            self.views[key] = self.view(self.order[best])
+        return self.views[key]
+
+
+    def where(self, name: str, op: str, value) -> "ResultSet":
+        """Returns a view of pairs where the column compared with value holds"""
+        values = self.column(name)
+        if values.dtype == object:
+            mask = values == value
+        else:
+            with np.errstate(invalid = "ignore"):
+                mask = OPERATORS[op](values, value)
+        return self.view(self.order[mask])
+
+
+    def arrange(self, sort: str | None, descending: bool, top: bool) -> "ResultSet":
+        """Returns the view a search asks for, unknown sort columns leave the order as it is"""
+        if not sort or not self.has_column(sort):
+            return self
+        return self.top(sort, settings.TOP_RESULTS) if top else self.sort(sort, descending)
+
+    def matching(self, text: str) -> "ResultSet":
+        """Returns a view of pairs whose symbols, names or addresses contain every word of text, ignoring case"""
+        words = text.lower().replace("/", " ").split()
+        if "text" not in self.columns:
+            self.columns["text"] = np.array([
+                f"{pair.base_token.symbol} {pair.base_token.name} {pair.quote_token.symbol} {pair.quote_token.name} {pair.base_token.address} {pair.pair_address}".lower()
+                for pair in self.pairs
+            ], dtype = object)
+        text_column = self.columns["text"][self.order]
+        mask = np.array([ all(word in value for word in words) for value in text_column ], dtype = bool)
+        return self.view(self.order[mask])
+
+
+    def filter(self, text: str) -> "ResultSet":
+        """Applies the compiled plan of /filter text to every pair at once, unknown filters are ignored"""
+        results = self
+        for name, op, value in TokenFilter.compile(text):
+            results = results.where(name, op, value)
+        return results
+
+
+def parse_query(text: str) -> tuple[str, str, str | None, bool, bool]:
+    """Splits a search message into the query, filter text, sort column, sort direction and if only the top results are wanted"""
+    parts = FLAG_PATTERN.split(text)
+    query, flags = parts[0].strip(), dict(zip(parts[1::2], (i.strip().lower() for i in parts[2::2])))
+
+    filter_text = flags.get("/filter", "")
+    top = "/top" in flags
+    sort = (flags.get("/top") or flags.get("/sort") or ("volume24h" if top else "")).split()
+    descending = "asc" not in sort[1:]
+    return query, filter_text, sort[0] if sort else None, descending, top
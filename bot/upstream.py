@@ -0,0 +1,254 @@
+"""Gateway for the DexScreener API with a pooled session, a concurrency cap, rate limiting and retries"""
+
+from __future__ import annotations
+
+from random import uniform
+from time import monotonic, time
+from typing import TYPE_CHECKING, Iterable
+from urllib.parse import urlencode
+from asyncio import Semaphore, Task, TimeoutError, create_task, sleep
+
+from orjson import loads
+
+from .ratelimit import TokenBucket
+from storage import get_storage
+from metrics import get_metrics
+from startup import lazy_import
+from settings import get_settings, get_logger
+
+if TYPE_CHECKING:
+    from aiohttp import ClientSession
+    from dexscreener import TokenPair
+
+
+storage = get_storage()
+settings = get_settings()
+metrics = get_metrics()
+logger = get_logger(__name__)
+request_seconds = metrics.histogram("dexscreener_request_seconds", "Time of each DexScreener request attempt by endpoint and status, failed connections have status error", ("endpoint", "status"))
+stale_seconds = metrics.histogram("dexscreener_stale_seconds", "How long past its expiry each stale response served from the cache was", buckets = (5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+# Loaded on the first request instead of at boot
+aiohttp = lazy_import("aiohttp")
+dexscreener = lazy_import("dexscreener")
+
+# Status codes worth trying again, anything else is returned to the caller as an error straight away
+RETRY_STATUSES = { 429, 500, 502, 503, 504 }
+# Most pair addresses the pairs endpoint accepts in one request
+MAX_PAIRS_PER_REQUEST = 30
+# Most pairs a search returns, a search with fewer results returned every match
+MAX_SEARCH_RESULTS = 30
+
+
+
+class UpstreamError(Exception):
+    """Raised when DexScreener can't be reached or keeps failing after every retry"""
+
+
+
+class PairList(list):
+    """The pairs of one response along with when DexScreener made it, a response from the cache is as old as when it was fetched"""
+
+    def __init__(self, pairs: Iterable[TokenPair], fetched: float) -> None:
+        super().__init__(pairs)
+        self.fetched = fetched
+
+
+
+class DexScreenerGateway:
+    """Drop in replacement for `DexscreenerClient` for the async methods the bot uses.
+    Every request shares one connection pool, waits for a concurrency slot and a rate limit token, and is retried
+    with jittered exponential backoff on timeouts, connection errors and throttling.
+    With the response cache, bodies are kept in the database so a request made by one worker serves all of them and
+    survives restarts. Responses which expired recently are served while the cache warms up after a start, and
+    refreshed in the background, or instead of an error when DexScreener can't be reached."""
+
+    base_url = settings.DEXSCREENER_URL
+
+    def __init__(
+            self,
+            concurrency: int = settings.UPSTREAM_CONCURRENCY,
+            rate_limit: float = settings.UPSTREAM_RATE_LIMIT,
+            burst: float = settings.UPSTREAM_BURST,
+            timeout: float = settings.UPSTREAM_TIMEOUT,
+            retries: int = settings.UPSTREAM_RETRIES,
+            backoff: float = settings.UPSTREAM_BACKOFF,
+            cached: bool = settings.RESPONSE_CACHE,
+        ) -> None:
+        self.session: ClientSession | None = None
+        self.concurrency = concurrency
+        self.semaphore = Semaphore(concurrency)
+        # The pairs, search and tokens endpoints share one quota of rate_limit requests per minute
+        self.bucket = TokenBucket(rate_limit / 60, burst)
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.cached = cached
+        self.warm_until = monotonic() + settings.RESPONSE_WARM_PERIOD
+        self.refreshing: dict[str, Task] = {}
+
+        self.cache_hits = 0
+        self.stale_hits = 0
+        self.requests = 0
+        self.failures = 0
+        self.retried = 0
+        self.latency = 0.0
+
+
+    def get_session(self) -> ClientSession:
+        # Created on first use since the session has to belong to the running event loop
+        if self.session is None or self.session.closed:
+            self.session = aiohttp.ClientSession(
+                base_url = self.base_url,
+                timeout = aiohttp.ClientTimeout(total = self.timeout),
+                connector = aiohttp.TCPConnector(limit = self.concurrency, ttl_dns_cache = 300),
+                raise_for_status = False,
+            )
+        return self.session
+
+
+    async def request(self, path: str, cache_ttl: float | None = None, **params) -> tuple[dict, float]:
+        """Returns the decoded response for a GET request and when it was fetched, from the response cache if it was made recently"""
+        if not self.cached or not cache_ttl:
+            return loads(await self.fetch(path, **params)), time()
+
+        key = path + ("?" + urlencode(sorted(params.items())) if params else "")
+        stale = None
+        cached = await storage.run(storage.get_response, key)
+        if cached is not None:
+            body, expires = cached
+            # Responses are cached for cache_ttl from when they were fetched
+            fetched = expires - cache_ttl
+            if expires > time():
+                self.cache_hits += 1
+                return loads(body), fetched
+
+            stale = body
+            if monotonic() < self.warm_until:
+                # Just started, answer old keyboards straight away instead of sending every request upstream at once
+                self.stale_hits += 1
+                stale_seconds.observe(time() - expires)
+                if key not in self.refreshing:
+                    self.refreshing[key] = create_task(self.refresh(key, path, cache_ttl, **params))
+                return loads(stale), fetched
+
+        try:
+            body = await self.fetch(path, **params)
+        except UpstreamError:
+            if stale is None:
+                raise
+            self.stale_hits += 1
+            stale_seconds.observe(time() - expires)
+            logger.warning(f"Serving a stale response for {key}, DexScreener can't be reached")
+            return loads(stale), fetched
+
+        fetched = time()
+        await self.store(key, body, cache_ttl)
+        return loads(body), fetched
+
+
+    async def store(self, key: str, body: bytes, cache_ttl: float) -> None:
+        try:
+            await storage.run(storage.set_response, key, body, cache_ttl)
+        except Exception:
+            # The response is still good, it just isn't cached for the other workers or the next start
+            logger.exception(f"Failed to cache the response for {key}")
+
+
+    async def refresh(self, key: str, path: str, cache_ttl: float, **params) -> None:
+        """Fetches a response which was served stale and caches it for the next request"""
+        try:
+            await self.store(key, await self.fetch(path, **params), cache_ttl)
+        except UpstreamError as exception:
+            logger.warning(f"Failed to refresh the stale response for {key}: {exception}")
+        finally:
+            del self.refreshing[key]
+
+
+    async def fetch(self, path: str, **params) -> bytes:
+        """Sends a GET request and returns the response body, retrying failures until retries run out"""
+        for attempt in range(self.retries + 1):
+            delay = self.backoff * 2 ** attempt
+            try:
+                await self.bucket.acquire()
+                async with self.semaphore:
+                    started = monotonic()
+                    status = "error"
+                    self.requests += 1
+                    try:
+                        async with self.get_session().get(path, params = params or None) as response:
+                            status = str(response.status)
+                            if response.status < 400:
+                                return await response.read()
+                            if response.status not in RETRY_STATUSES:
+                                self.failures += 1
+                                raise UpstreamError(f"DexScreener answered {response.status} for {path}")
+
+                            # Throttled, wait at least as long as the API asks for
+                            retry_after = response.headers.get("Retry-After", "")
+                            delay = max(delay, float(retry_after)) if retry_after.isdigit() else delay
+                            error = UpstreamError(f"DexScreener answered {response.status} for {path}")
+                    finally:
+                        elapsed = monotonic() - started
+                        self.latency += elapsed
+                        # "/latest/dex/<endpoint>/...", the rest of the path is left out to keep the number of series small
+                        request_seconds.observe(elapsed, path.split("/")[3], status)
+
+            except (aiohttp.ClientError, TimeoutError) as exception:
+                error = exception
+
+            self.failures += 1
+            if attempt == self.retries:
+                raise UpstreamError(f"DexScreener request for {path} failed after {attempt + 1} attempts") from error
+
+            self.retried += 1
+            # Full jitter, so clients which failed together don't retry together
+            delay = uniform(0, delay)
+            logger.warning(f"DexScreener request for {path} failed ({error!r}), retrying in {delay:.2f} seconds")
+            await sleep(delay)
+
+
+    async def get_token_pair_async(self, chain: str, address: str) -> PairList:
+        """The pair at an address as a list of at most one pair, so it carries when it was fetched"""
+        resp, fetched = await self.request(f"/latest/dex/pairs/{chain}/{address}", settings.PAIR_CACHE_TTL)
+        return PairList([dexscreener.TokenPair(**resp["pair"])] if resp.get("pair") else [], fetched)
+
+    async def get_token_pair_list_async(self, chain: str, addresses: Iterable[str]) -> PairList:
+        addresses_list = list(addresses)
+        if len(addresses_list) > MAX_PAIRS_PER_REQUEST:
+            raise ValueError(f"The maximum number of addresses allowed is {MAX_PAIRS_PER_REQUEST}.")
+        resp, fetched = await self.request(f"/latest/dex/pairs/{chain}/{','.join(addresses_list)}", settings.PAIR_CACHE_TTL)
+        return PairList([dexscreener.TokenPair(**pair) for pair in resp.get("pairs") or []], fetched)
+
+    async def get_token_pairs_async(self, address: str) -> PairList:
+        resp, fetched = await self.request(f"/latest/dex/tokens/{address}", settings.PAIR_CACHE_TTL)
+        return PairList([dexscreener.TokenPair(**pair) for pair in resp.get("pairs") or []], fetched)
+
+    async def search_pairs_async(self, search_query: str) -> PairList:
+        resp, fetched = await self.request("/latest/dex/search", settings.SEARCH_CACHE_TTL, q = search_query)
+        return PairList([dexscreener.TokenPair(**pair) for pair in resp.get("pairs") or []], fetched)
+
+
+    async def close(self) -> None:
+        for task in list(self.refreshing.values()):
+            task.cancel()
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+
+    def stats(self) -> dict:
+        return {
+            "cache_hits": self.cache_hits,
+            "stale_hits": self.stale_hits,
+            "requests": self.requests,
+            "failures": self.failures,
+            "retried": self.retried,
+            "latency_seconds": self.latency,
+        }
+
+
+
+gateway = DexScreenerGateway()
+
+def get_gateway() -> DexScreenerGateway:
+    return gateway
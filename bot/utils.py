@@ -1,74 +1,140 @@
-from dexscreener import TokenPair
+from __future__ import annotations
 
+import re
+from html import escape as html_escape
+from typing import TYPE_CHECKING
+
+from cache import LRUCache, MISSING
 from settings import get_settings, get_logger
 
+# Only needed for annotations, dexscreener is imported when the first response is parsed
+if TYPE_CHECKING:
+    from dexscreener import TokenPair
+
 
 settings = get_settings()
 logger = get_logger(__name__)
 
 
 
-def format_token(token: TokenPair, detailed = False) -> str:
-    """Returns information about a token pair as a string"""
+# Templates are built once, format_token only fills them in
+SHORT_TEMPLATE = (
+    "⛓ Chain ID:  {chain}\n"
+    "💱 DEX ID:  {dex}\n"
+    "🔗 Token Pair:  {token.base_token.symbol}/{token.quote_token.symbol}\n\n"
+    "📍 Address:  {token.pair_address}\n\n"
+    "🗓️ Created:  {created}\n\n"
+
+    "<b>Prices</b>\n"
+    "FDV:  {token.fdv:,} USD\n"
+    "USD Price:    {token.price_usd:.16f} USD\n"
+    "Native Price: {token.price_native:.16f} {token.quote_token.symbol}\n\n"
+
+    "URL: {token.url}"
+)
+
+DETAILED_TEMPLATE = (
+    "⛓ Chain ID:  {chain}\n"
+    "💱 DEX ID:  {dex}\n"
+    "📍 Address:  {token.pair_address}\n\n"
+    "🗓️ Created:  {created}\n\n"
+
+    "<b>Prices</b>\n"
+    "FDV:  {token.fdv:,} USD\n"
+    "USD Price:    {token.price_usd:.16f} USD\n"
+    "Native Price: {token.price_native:.16f} {token.quote_token.symbol}\n\n"
+
+    "<b>Base Token</b>\n"
+    "Name:    {token.base_token.name}\n"
+    "Symbol:  {token.base_token.symbol}\n"
+    "📍 Address: {token.base_token.address}\n\n"
+
+    "<b>Quote Token</b>\n"
+    "Name:    {token.quote_token.name}\n"
+    "Symbol:  {token.quote_token.symbol}\n"
+    "📍 Address: {token.quote_token.address}\n\n"
+
+    "<b>Liquidity</b>\n"
+    "USD:   {token.liquidity.usd:,}\n"
+    "Base:  {token.liquidity.base:,}\n"
+    "Quote: {token.liquidity.quote:,}\n\n"
+
+    "<b>Transactions</b>\n"
+    "5m:  {token.transactions.m5.buys:>8,} bought  {token.transactions.m5.sells:>8,} sold\n"
+    "1h:  {token.transactions.h1.buys:>8,} bought  {token.transactions.h1.sells:>8,} sold\n"
+    "6h:  {token.transactions.h6.buys:>8,} bought  {token.transactions.h6.sells:>8,} sold\n"
+    "24h: {token.transactions.h24.buys:>8,} bought  {token.transactions.h24.sells:>8,} sold\n\n"
+
+    "<b>Volume</b>\n"
+    "5m:   {token.volume.m5}\n"
+    "1h:   {token.volume.h1}\n"
+    "6h:   {token.volume.h6}\n"
+    "24h:  {token.volume.h24}\n\n"
+
+    "<b>Price Change</b>\n"
+    "5m:   {token.price_change.m5}\n"
+    "1h:   {token.price_change.h1}\n"
+    "6h:   {token.price_change.h6}\n"
+    "24h:  {token.price_change.h24}\n\n"
+
+    "URL: {token.url}"
+)
+
+# Rendered messages keyed by (pair address, detailed, snapshot), see format_token
+render_cache = LRUCache(settings.RENDER_CACHE_SIZE)
+
+# Words this long are addresses rather than names. Base58 (Solana, Tron) and base64 (TON) addresses are case sensitive,
+# only hex (EVM) addresses can be lower cased
+ADDRESS_PATTERN = re.compile(r"[0-9A-Za-z_-]{32,}")
+HEX_ADDRESS_PATTERN = re.compile(r"0x[0-9a-fA-F]+")
+
+
+
+def render_token(token: TokenPair, detailed = False) -> str:
+    """Fills in the template for a token pair, without using the render cache"""
     try:
-        created = token.pair_created_at.strftime("%A, %B %d %Y %h:%M:%S %p")
+        created = token.pair_created_at.strftime("%A, %B %d %Y %I:%M:%S %p")
     except:
         created = "Unknown"
     finally:
         chain = token.chain_id.title()
         dex = token.dex_id.title()
 
-    text_format = (
-        f"⛓ Chain ID:  {chain}\n"
-        f"💱 DEX ID:  {dex}\n"
-        + ("🔗 Token Pair:  {token.base_token.symbol}/{token.quote_token.symbol}\n\n" if not detailed else "") +
-        "📍 Address:  {token.pair_address}\n\n"
-        f"🗓️ Created:  {created}\n\n"
+    template = DETAILED_TEMPLATE if detailed else SHORT_TEMPLATE
+    return template.format(token = token, chain = chain, dex = dex, created = created)
+
+
+def format_token(token: TokenPair, detailed = False) -> str:
+    """Returns information about a token pair as a string"""
+    # The caches hand out the same TokenPair object until a fresh one is fetched, so the object is the snapshot.
+    # The token is stored with the text so a reused id can't return another snapshot's message.
+    key = (token.pair_address, detailed, id(token))
+    cached = render_cache.get(key)
+    if cached is not MISSING and cached[0] is token:
+        return cached[1]
+
+    text = render_token(token, detailed)
+    render_cache.set(key, (token, text))
+    return text
 
-        "<b>Prices</b>\n"
-        "FDV:  {token.fdv:,} USD\n"
-        "USD Price:    {token.price_usd:.16f} USD\n"
-        "Native Price: {token.price_native:.16f} {token.quote_token.symbol}\n\n"
 
+def normalize_query(query: str) -> str:
+    """Collapses the whitespace of a query and lower cases it, except for addresses whose case matters"""
+    return " ".join(
+        word if ADDRESS_PATTERN.fullmatch(word) and not HEX_ADDRESS_PATTERN.fullmatch(word) else word.lower()
+        for word in query.split()
     )
 
-    if detailed:
-        text_format += (
-            "<b>Base Token</b>\n"
-            "Name:    {token.base_token.name}\n"
-            "Symbol:  {token.base_token.symbol}\n"
-            "📍 Address: {token.base_token.address}\n\n"
-
-            "<b>Quote Token</b>\n"
-            "Name:    {token.quote_token.name}\n"
-            "Symbol:  {token.quote_token.symbol}\n"
-            "📍 Address: {token.quote_token.address}\n\n"
-
-            "<b>Liquidity</b>\n"
-            "USD:   {token.liquidity.usd:,}\n"
-            "Base:  {token.liquidity.base:,}\n"
-            "Quote: {token.liquidity.quote:,}\n\n"
-
-            "<b>Transactions</b>\n"
-            "5m:  {token.transactions.m5.buys:>8,} bought  {token.transactions.m5.sells:>8,} sold\n"
-            "1h:  {token.transactions.h1.buys:>8,} bought  {token.transactions.h1.sells:>8,} sold\n"
-            "6h:  {token.transactions.h6.buys:>8,} bought  {token.transactions.h6.sells:>8,} sold\n"
-            "24h: {token.transactions.h24.buys:>8,} bought  {token.transactions.h24.sells:>8,} sold\n\n"
-
-            "<b>Volume</b>\n"
-            "5m:   {token.volume.m5}\n"
-            "1h:   {token.volume.h1}\n"
-            "6h:   {token.volume.h6}\n"
-            "24h:  {token.volume.h24}\n\n"
-
-            "<b>Price Change</b>\n"
-            "5m:   {token.price_change.m5}\n"
-             "1h:   {token.price_change.h1}\n"
-            "6h:   {token.price_change.h6}\n"
-            "24h:  {token.price_change.h24}\n\n"
-
-        )
-
-    text_format += "URL: {token.url}"
-    text = text_format.format(token = token)
-    return text
+
+def format_token_summary(index: int, address: str, token: TokenPair | None) -> str:
+    """Returns a few lines about a token pair, used for lists of pairs"""
+    if token is None:
+        return f"{index}. Not found: <code>{html_escape(address)}</code>"
+
+    liquidity = token.liquidity.usd if token.liquidity and token.liquidity.usd is not None else 0
+    price = f"{token.price_usd:,.8g} USD" if token.price_usd is not None else f"{token.price_native:,.8g} {html_escape(token.quote_token.symbol)}"
+    return (
+        f"{index}. <b>{html_escape(token.base_token.symbol)}/{html_escape(token.quote_token.symbol)}</b> on {token.dex_id.title()}  {price}\n"
+        f"Liquidity: {liquidity:,.0f} USD  24h Volume: {token.volume.h24 or 0:,.0f} USD  24h: {token.price_change.h24 or 0:+.2f}%\n"
+        f"<code>{html_escape(token.pair_address)}</code>"
+    )
@@ -0,0 +1,95 @@
+"""Turns raw webhook requests into updates on the application's update queue"""
+
+from time import monotonic
+from asyncio import Queue, QueueFull
+from collections import deque
+
+from orjson import loads, JSONDecodeError
+from telegram import Bot as TelegramBot, Update
+
+from .processor import ChatOrderedUpdateProcessor
+from metrics import get_metrics
+from settings import get_settings, get_logger
+
+
+settings = get_settings()
+metrics = get_metrics()
+logger = get_logger(__name__)
+
+
+
+class WebhookIngestor:
+    """Decodes webhook bodies, drops updates Telegram delivered more than once and refuses updates when the backlog is full.
+    The backlog is every update queued, waiting in the processor or being processed, not just the queue."""
+
+    def __init__(self, bot: TelegramBot, update_queue: Queue, processor: ChatOrderedUpdateProcessor, window: int = settings.UPDATE_DEDUP_WINDOW) -> None:
+        self.bot = bot
+        self.update_queue = update_queue
+        self.processor = processor
+
+        # Recently queued update ids, the deque remembers insertion order so the oldest id can be forgotten
+        self.seen: set[int] = set()
+        self.seen_order: deque[int] = deque()
+        self.window = window
+
+        self.received = 0
+        self.duplicates = 0
+        self.rejected = 0
+
+
+    def remember(self, update_id: int) -> None:
+        self.seen.add(update_id)
+        self.seen_order.append(update_id)
+        if len(self.seen_order) > self.window:
+            self.seen.discard(self.seen_order.popleft())
+
+
+    def ingest(self, body: bytes) -> bool:
+        """Queues the update in body, returns False if the backlog is full and Telegram should retry later.
+        Raises ValueError if the body isn't a valid update."""
+        self.received += 1
+        try:
+            update_json = loads(body)
+        except JSONDecodeError as exception:
+            raise ValueError("Update is not valid JSON") from exception
+
+        if not isinstance(update_json, dict):
+            raise ValueError("Update is not a JSON object")
+
+        update_id = update_json.get("update_id")
+        if update_id in self.seen:
+            self.duplicates += 1
+            return True
+
+        # Checked before decoding so a stalled backlog costs as little as possible, the id isn't remembered so the retry is accepted
+        if self.processor.full or self.update_queue.full():
+            self.rejected += 1
+            return False
+
+        update = Update.de_json(update_json, self.bot)
+        # The slot is given back by the processor once the update was processed
+        if not self.processor.admit(update.update_id):
+            self.rejected += 1
+            return False
+        try:
+            self.update_queue.put_nowait(update)
+        except QueueFull:
+            self.processor.release(update.update_id)
+            self.rejected += 1
+            return False
+
+        if update_id is not None:
+            self.remember(update_id)
+            metrics.received_at[update_id] = monotonic()
+        return True
+
+
+    def stats(self) -> dict:
+        return {
+            # Everything admitted and not processed yet, updates leave the queue itself right away
+            "queue_size": len(self.processor.admitted),
+            "queue_max_size": self.processor.max_backlog,
+            "received": self.received,
+            "duplicates": self.duplicates,
+            "rejected": self.rejected,
+        }
@@ -0,0 +1,142 @@
+"""In-memory caches shared by the bot and the storage layer"""
+
+from asyncio import Task, create_task, shield
+from time import monotonic
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Hashable
+
+from settings import get_logger
+
+
+logger = get_logger(__name__)
+
+# Sentinel returned when a key is missing, so None can be cached as a value
+MISSING = object()
+
+
+
+class LRUCache:
+    """A size bounded, least recently used cache with an optional time to live for its entries"""
+
+    def __init__(self, max_size: int, ttl: float | None = None) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: OrderedDict[Hashable, tuple[float, Any]] = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __contains__(self, key: Hashable) -> bool:
+        return self.get(key, record = False) is not MISSING
+
+
+    def get(self, key: Hashable, default: Any = MISSING, record: bool = True) -> Any:
+        """Returns the cached value for key and marks it as recently used, or default if missing or expired"""
+        entry = self.entries.get(key)
+        if entry is None:
+            if record:
+                self.misses += 1
+            return default
+
+        expires, value = entry
+        if expires and expires <= monotonic():
+            del self.entries[key]
+            if record:
+                self.misses += 1
+            return default
+
+        self.entries.move_to_end(key)
+        if record:
+            self.hits += 1
+        return value
+
+
+    def set(self, key: Hashable, value: Any, ttl: float | None = None) -> None:
+        """Stores value under key, evicting the least recently used entries when the cache is full"""
+        ttl = self.ttl if ttl is None else ttl
+        expires = monotonic() + ttl if ttl else 0
+
+        self.entries[key] = (expires, value)
+        self.entries.move_to_end(key)
+
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last = False)
+            self.evictions += 1
+
+
+    def expires_in(self, key: Hashable) -> float | None:
+        """Seconds until the entry for key expires, None if it never does or is missing"""
+        entry = self.entries.get(key)
+        if entry is None or not entry[0]:
+            return None
+        return entry[0] - monotonic()
+
+
+    def pop(self, key: Hashable, default: Any = None) -> Any:
+        entry = self.entries.pop(key, None)
+        return default if entry is None else entry[1]
+
+    def clear(self) -> None:
+        self.entries.clear()
+
+
+    def stats(self) -> dict:
+        """Returns the size and hit/miss counters of the cache"""
+        return {
+            "size": len(self.entries),
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+
+
+class AsyncLRUCache(LRUCache):
+    """An LRU cache which also coalesces concurrent loads of the same key into a single in-flight call"""
+
+    def __init__(self, max_size: int, ttl: float | None = None) -> None:
+        super().__init__(max_size, ttl)
+        self.in_flight: dict[Hashable, Task] = {}
+        self.coalesced = 0
+
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]], ttl: float | None = None) -> Any:
+        """Returns the cached value for key, otherwise awaits loader once no matter how many callers are waiting on it"""
+        value = self.get(key)
+        if value is not MISSING:
+            return value
+
+        # Another task is already loading this key, wait for its result instead of calling loader again
+        task = self.in_flight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            # The load runs in its own task, so it finishes and is cached even if the caller which started it is cancelled
+            task = self.in_flight[key] = create_task(self.load(key, loader, ttl))
+            # Mark the exception as retrieved so asyncio doesn't log it when every waiter was cancelled
+            task.add_done_callback(lambda task: task.cancelled() or task.exception())
+
+        # Shielded so a cancelled waiter doesn't cancel the load for everyone else
+        return await shield(task)
+
+
+    async def load(self, key: Hashable, loader: Callable[[], Awaitable[Any]], ttl: float | None) -> Any:
+        try:
+            value = await loader()
+            self.set(key, value, ttl)
+            return value
+        finally:
+            del self.in_flight[key]
+
+
+    def stats(self) -> dict:
+        stats = super().stats()
+        stats["in_flight"] = len(self.in_flight)
+        stats["coalesced"] = self.coalesced
+        return stats
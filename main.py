@@ -1,17 +1,26 @@
 """Main code entry point"""
 
-from telegram import Update
+# Imported first so the startup report includes the time spent importing everything else
+from startup import get_startup_timer
+
+from asyncio import create_task
 from contextlib import asynccontextmanager
-from fastapi import Depends, Header, HTTPException, FastAPI, Request
+from fastapi import Depends, Header, HTTPException, FastAPI, Request, Response
 
 
 from bot import Bot
+from bot.index import get_token_index
 from routes import router
+from storage import get_storage
 from settings import get_settings, get_logger
 
 
+storage = get_storage()
+token_index = get_token_index()
 settings = get_settings()
 logger = get_logger(__name__)
+timer = get_startup_timer()
+timer.mark("imports")
 
 
 # Checks if the secret token included in the headers is matched the one specified
@@ -24,31 +33,60 @@ def auth_bot_token(x_telegram_bot_api_secret_token: str = Header(None)) -> str:
 # The liespan of the fastapi app
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    bot = Bot(settings.BOT_TOKEN)
-    await bot.setup(settings.SECRET_TOKEN, settings.BOT_WEB_URL+settings.WEBHOOK_URL )
-
-
-    # The webhook path handler
-    @router.post(settings.WEBHOOK_URL, status_code=204)
-    async def webhook(request: Request, token: str = Depends(auth_bot_token)) -> None:
-        """Handle incoming updates by putting them into the `update_queue`"""
-        update_json = await request.json()
-        update = Update.de_json( update_json, bot.application.bot )
-        await bot.application.update_queue.put(update)
-
-
-    app.include_router(router)
-    async with bot.application:
-        # Runs when app starts
-        logger.info(f"\n🚀 Bot starting up ...\nDebugging is {'enabled' if settings.DEBUG else 'disabled'}")
-        await bot.application.start()
-
-        yield
-
-        # Runs after app shuts down
-        logger.info("\n⛔ Bot shutting down ...\n")
-        await bot.application.stop()
-
+    try:
+        # Storage comes first, it holds the fingerprints of what was registered with Telegram on the last start
+        with timer.stage("storage"):
+            await storage.start()
+        with timer.stage("bot"):
+            bot = Bot(settings.BOT_TOKEN)
+        await bot.setup(settings.SECRET_TOKEN, settings.BOT_WEB_URL+settings.WEBHOOK_URL )
+
+
+        # The webhook path handler
+        @router.post(settings.WEBHOOK_URL, status_code=204, response_model=None)
+        async def webhook(request: Request, token: str = Depends(auth_bot_token)) -> Response | None:
+            """Handle incoming updates by putting them into the `update_queue`"""
+            try:
+                accepted = bot.ingestor.ingest(await request.body())
+            except ValueError as exception:
+                raise HTTPException(status_code=400, detail=str(exception))
+
+            # Telegram redelivers the update later when the webhook doesn't answer with a 2xx status
+            if not accepted:
+                return Response(status_code=503, headers={"Retry-After": str(settings.WEBHOOK_RETRY_AFTER)})
+
+
+        app.include_router(router)
+        with timer.stage("initialize"):
+            await bot.application.initialize()
+        try:
+            # Runs when app starts
+            logger.info(f"\n🚀 Bot starting up ...\nDebugging is {'enabled' if settings.DEBUG else 'disabled'}")
+            with timer.stage("application"):
+                await bot.application.start()
+            with timer.stage("watches"):
+                await bot.watch_poller.start()
+            with timer.stage("index"):
+                await token_index.start()
+            logger.info(timer.report())
+
+            # Registration may have been skipped, make sure Telegram still has the webhook once updates are being served.
+            # The task is kept in a variable so it isn't garbage collected while it runs
+            if settings.FAST_STARTUP:
+                verify_task = create_task(bot.verify_webhook(settings.BOT_WEB_URL+settings.WEBHOOK_URL, settings.SECRET_TOKEN))
+
+            yield
+
+            # Runs after app shuts down
+            logger.info("\n⛔ Bot shutting down ...\n")
+            await bot.application.stop()
+            await bot.shutdown()
+        finally:
+            await bot.application.shutdown()
+    finally:
+        # Also runs when startup failed, so user state still waiting in the write-behind buffer is written out and
+        # the storage thread stops
+        await storage.close()
 
 
 app = FastAPI( title = "BotFastAPI", description = "A webhook api for a telegram DexScreener bot", lifespan = lifespan )
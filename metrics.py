@@ -0,0 +1,159 @@
+"""Counters and latency histograms exposed in the Prometheus text format, cheap enough to leave on in production"""
+
+from bisect import bisect_left
+from functools import wraps
+from time import monotonic
+from typing import Any, Callable, Iterable
+
+from settings import get_settings, get_logger
+
+
+settings = get_settings()
+logger = get_logger(__name__)
+
+# Upper bounds in seconds, from a cached page flip to a slow DexScreener search with retries
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+# Keys of the stats() dicts which only ever grow, they are exposed as counters
+COUNTER_KEYS = {
+    "hits", "misses", "evictions", "coalesced", "requests", "failures", "retried", "cache_hits", "stale_hits",
+    "received", "duplicates", "rejected", "processed", "sent", "polls", "alerts", "scheduled", "cancelled", "skipped", "failed",
+    "queries", "superseded", "refined", "searched", "indexed", "refreshed",
+}
+
+# A sample is (name, labels, value)
+Sample = tuple[str, dict[str, str], float]
+
+
+
+def format_labels(labels: dict[str, str]) -> str:
+    if not labels:
+        return ""
+    escaped = ( (key, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")) for key, value in labels.items() )
+    return "{" + ",".join(f'{key}="{value}"' for key, value in escaped) + "}"
+
+
+
+class Histogram:
+    """Counts observations per bucket for each combination of label values"""
+
+    def __init__(self, name: str, description: str, label_names: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS) -> None:
+        self.name = name
+        self.description = description
+        self.label_names = label_names
+        self.buckets = buckets
+        # Per label values: a count per bucket plus one for larger values, the sum and the count
+        self.series: dict[tuple[str, ...], list] = {}
+
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} histogram"
+        # Copied, the storage thread may add a series while this runs
+        for labels, (counts, total, count) in list(self.series.items()):
+            labels = dict(zip(self.label_names, labels))
+            cumulative = 0
+            for bound, bucket_count in zip((*self.buckets, "+Inf"), counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket{format_labels(labels | { 'le': str(bound) })} {cumulative}"
+            yield f"{self.name}_sum{format_labels(labels)} {total}"
+            yield f"{self.name}_count{format_labels(labels)} {count}"
+
+
+
+class Metrics:
+    """Histograms are observed as things happen, everything else is read from the stats() of each component when scraped"""
+
+    def __init__(self) -> None:
+        self.histograms: dict[str, Histogram] = {}
+        self.collectors: list[Callable[[], Iterable[Sample]]] = []
+        # Monotonic time each update arrived at the webhook, removed once it has been handled
+        self.received_at: dict[int, float] = {}
+
+        self.handler_seconds = self.histogram("bot_handler_seconds", "Time spent in each update handler", ("handler",))
+        self.update_latency = self.histogram("bot_update_latency_seconds", "Time from the webhook receiving an update to a handler finishing it", ("handler",))
+
+
+    def histogram(self, name: str, description: str, label_names: tuple[str, ...] = (), buckets: tuple[float, ...] = LATENCY_BUCKETS) -> Histogram:
+        histogram = self.histograms.get(name)
+        if histogram is None:
+            histogram = self.histograms[name] = Histogram(name, description, label_names, buckets)
+        return histogram
+
+    def register(self, collector: Callable[[], Iterable[Sample]]) -> None:
+        self.collectors.append(collector)
+
+
+    @staticmethod
+    def from_stats(prefix: str, stats: dict[str, Any], **labels: str) -> Iterable[Sample]:
+        """Turns a stats() dict into samples, growing values get a _total suffix so they are exposed as counters"""
+        for key, value in stats.items():
+            if isinstance(value, bool) or not isinstance(value, (int, float)):
+                continue
+            yield (f"{prefix}_{key}_total" if key in COUNTER_KEYS else f"{prefix}_{key}", labels, value)
+
+    @classmethod
+    def from_cache(cls, name: str, stats: dict[str, Any]) -> Iterable[Sample]:
+        """Samples for a cache, with the hit ratio worked out for dashboards which don't compute it"""
+        yield from cls.from_stats("cache", stats, cache = name)
+        lookups = stats.get("hits", 0) + stats.get("misses", 0)
+        yield ("cache_hit_ratio", { "cache": name }, stats.get("hits", 0) / lookups if lookups else 0)
+
+
+    def render(self) -> str:
+        lines = []
+        for histogram in self.histograms.values():
+            lines.extend(histogram.render())
+
+        # Samples of one name have to be grouped under its type line, even when several collectors report it
+        families: dict[str, list[str]] = {}
+        for collector in self.collectors:
+            try:
+                samples = list(collector())
+            except Exception:
+                # One broken component shouldn't hide the metrics of every other one
+                logger.exception("Failed to collect metrics")
+                continue
+
+            for name, labels, value in samples:
+                families.setdefault(name, []).append(f"{name}{format_labels(labels)} {value}")
+
+        for name, samples in families.items():
+            lines.append(f"# TYPE {name} {'counter' if name.endswith('_total') else 'gauge'}")
+            lines.extend(samples)
+        return "\n".join(lines) + "\n"
+
+
+    def observe_handler(self, name: str, update: object, started: float) -> None:
+        """Observes how long a handler took, and how long after the webhook received its update it finished"""
+        finished = monotonic()
+        self.handler_seconds.observe(finished - started, name)
+        received = self.received_at.get(getattr(update, "update_id", None))
+        if received is not None:
+            self.update_latency.observe(finished - received, name)
+
+    def timed(self, function: Callable) -> Callable:
+        """Decorates an update handler taking (update, context) as its last arguments so it is observed by name"""
+        @wraps(function)
+        async def wrapper(*args, **kwargs):
+            started = monotonic()
+            try:
+                return await function(*args, **kwargs)
+            finally:
+                self.observe_handler(function.__name__, args[-2] if len(args) >= 2 else None, started)
+        return wrapper
+
+
+
+metrics = Metrics()
+
+def get_metrics() -> Metrics:
+    return metrics
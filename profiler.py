@@ -0,0 +1,176 @@
+"""Samples the event loop on demand to find out where a slow bot spends its time, nothing runs while no profile is requested"""
+
+import sys
+from time import monotonic
+from pathlib import Path
+from collections import Counter
+from threading import Event, Thread, get_ident
+from asyncio import Task, create_task, sleep
+from typing import Awaitable, Callable
+
+from settings import get_settings, get_logger
+
+
+settings = get_settings()
+logger = get_logger(__name__)
+
+ROOT = Path(__file__).resolve().parent
+# The loop thread is waiting for I/O when its innermost frame is one of these, uvloop leaves the runner as the innermost frame
+IDLE_FILES = ("selectors.py", "runners.py")
+IDLE_FUNCTIONS = {"_run_once", "run_forever", "run_until_complete"}
+
+
+
+def short_path(filename: str) -> str:
+    if filename.startswith(str(ROOT)):
+        return str(Path(filename).relative_to(ROOT))
+    if "site-packages" in filename:
+        return filename.rsplit("site-packages/", 1)[-1]
+    return "/".join(Path(filename).parts[-2:])
+
+
+def is_idle(frame) -> bool:
+    code = frame.f_code
+    return code.co_filename.endswith(IDLE_FILES) or code.co_name in IDLE_FUNCTIONS
+
+
+def collapse(frame) -> str:
+    """The stack of a frame in the collapsed format, outermost first and starting at the callback the loop is running"""
+    labels = []
+    while frame is not None and not is_idle(frame):
+        code = frame.f_code
+        # Handle._run is the loop calling a callback, everything below it is the loop itself
+        if code.co_name == "_run" and code.co_filename.endswith("events.py"):
+            break
+        labels.append(f"{code.co_qualname} ({short_path(code.co_filename)})")
+        frame = frame.f_back
+    return ";".join(reversed(labels))
+
+
+
+class Profile:
+    """What one profiling run found"""
+
+    def __init__(self, seconds: float, slow: float) -> None:
+        self.seconds = seconds
+        self.slow = slow
+        self.samples = 0
+        # Collapsed stacks of the samples taken while the loop was busy
+        self.stacks: Counter[str] = Counter()
+        # How late each lag probe woke up
+        self.lags: list[float] = []
+        # Stretches the loop spent without polling for I/O, with the stack seen most during each one
+        self.slow_callbacks: list[tuple[float, str]] = []
+
+
+    def collapsed(self) -> bytes:
+        """The format flamegraph.pl, inferno and speedscope read"""
+        return "".join(f"{stack} {count}\n" for stack, count in self.stacks.most_common()).encode()
+
+
+    def summary(self, limit: int = 10) -> str:
+        busy = sum(self.stacks.values())
+        lags = sorted(self.lags)
+        lines = [f"Profiled {self.seconds:g}s: {self.samples} samples, event loop busy {busy / self.samples if self.samples else 0:.1%}"]
+        if lags:
+            lines.append(f"Event loop lag: p50 {lags[len(lags) // 2] * 1000:.1f}ms, p99 {lags[int(len(lags) * 0.99)] * 1000:.1f}ms, max {lags[-1] * 1000:.1f}ms")
+
+        lines.append(f"\nSlow callbacks (over {self.slow * 1000:.0f}ms): {len(self.slow_callbacks)}")
+        for duration, stack in sorted(self.slow_callbacks, reverse = True)[:limit]:
+            lines.append(f"{duration * 1000:>7.0f}ms  {stack.rsplit(';', 1)[-1]}")
+
+        # Self time, the innermost frame of each sample
+        leaves = Counter()
+        for stack, count in self.stacks.items():
+            leaves[stack.rsplit(";", 1)[-1]] += count
+        lines.append("\nHottest functions (share of busy samples):")
+        for label, count in leaves.most_common(limit):
+            lines.append(f"{count / busy:>7.1%}  {label}")
+        return "\n".join(lines)
+
+
+
+class Profiler:
+    """A sampling thread reads the event loop thread's stack every interval while a lag probe runs on the loop.
+    Consecutive busy samples without the loop polling for I/O in between are reported as one slow callback."""
+
+    # Seconds the lag probe sleeps for, it wakes up late by however long the loop was blocked
+    lag_interval = 0.05
+
+    def __init__(self, interval: float = settings.PROFILE_INTERVAL, slow: float = settings.PROFILE_SLOW_CALLBACK) -> None:
+        self.interval = interval
+        self.slow = slow
+        self.task: Task | None = None
+
+    @property
+    def running(self) -> bool:
+        return self.task is not None and not self.task.done()
+
+
+    def sample(self, thread_id: int, profile: Profile, stop: Event) -> None:
+        """Runs on the sampling thread until stopped"""
+        stretch_started = None
+        stretch = Counter()
+        while not stop.wait(self.interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is None:
+                continue
+            profile.samples += 1
+            now = monotonic()
+
+            if is_idle(frame):
+                if stretch_started is not None and now - stretch_started >= self.slow:
+                    profile.slow_callbacks.append((now - stretch_started, stretch.most_common(1)[0][0]))
+                stretch_started = None
+                stretch.clear()
+                continue
+
+            stack = collapse(frame)
+            profile.stacks[stack] += 1
+            stretch[stack] += 1
+            if stretch_started is None:
+                stretch_started = now
+
+
+    async def profile(self, seconds: float) -> Profile:
+        """Samples the loop this is awaited on for a number of seconds"""
+        profile = Profile(seconds, self.slow)
+        stop = Event()
+        thread = Thread(target = self.sample, args = (get_ident(), profile, stop), name = "profiler", daemon = True)
+        thread.start()
+        try:
+            deadline = monotonic() + seconds
+            while (started := monotonic()) < deadline:
+                await sleep(self.lag_interval)
+                profile.lags.append(max(0.0, monotonic() - started - self.lag_interval))
+        finally:
+            stop.set()
+            # Wakes up within one interval
+            thread.join()
+        return profile
+
+
+    def start(self, seconds: float, report: Callable[[Profile], Awaitable[None]]) -> None:
+        """Profiles in the background and passes the result to report, raises RuntimeError if a profile is running"""
+        if self.running:
+            raise RuntimeError("A profile is already running")
+        self.task = create_task(self.run(seconds, report))
+
+    async def run(self, seconds: float, report: Callable[[Profile], Awaitable[None]]) -> None:
+        try:
+            await report(await self.profile(seconds))
+        except Exception:
+            logger.exception("Failed to profile the event loop")
+
+
+    def close(self) -> None:
+        if self.running:
+            self.task.cancel()
+        self.task = None
+
+
+
+profiler = Profiler()
+
+def get_profiler() -> Profiler:
+    return profiler
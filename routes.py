@@ -1,9 +1,12 @@
-from fastapi import APIRouter
+from fastapi import APIRouter, Header, HTTPException
+from fastapi.responses import PlainTextResponse
 
+from metrics import get_metrics
 from settings import get_settings, get_logger
 
 
 settings = get_settings()
+metrics = get_metrics()
 logger = get_logger(__name__)
 
 router = APIRouter(
@@ -19,3 +22,10 @@ router = APIRouter(
 async def health_check():
     return
 
+
+# Metrics in the Prometheus text format
+@router.get(settings.METRICS_URL, response_class=PlainTextResponse)
+async def metrics_endpoint(authorization: str = Header(None)) -> PlainTextResponse:
+    if settings.METRICS_TOKEN and authorization != f"Bearer {settings.METRICS_TOKEN}":
+        raise HTTPException(status_code=403, detail="Not authenticated")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
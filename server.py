@@ -1,7 +1,6 @@
 import logging
 import uvicorn
 
-from main import app
 from settings import get_settings
 
 
@@ -10,5 +9,5 @@ logging.getLogger("httpx").setLevel(logging.WARNING)
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host = settings.HOST, port = settings.PORT, use_colors = True, log_level = settings.LOG_LEVEL)
-
+    # The app is passed as an import string so every worker process imports its own copy
+    uvicorn.run("main:app", host = settings.HOST, port = settings.PORT, workers = settings.WORKERS, use_colors = True, log_level = settings.LOG_LEVEL)
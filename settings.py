@@ -19,23 +19,128 @@ class Settings:
     PORT: int = env.int("PORT")
     DB_PATH: str = env.str("DB_PATH")
     HOST: str = env.str("HOST", "0.0.0.0")
+    WORKERS: int = env.int("WORKERS", 1)
+    # Skip registering the webhook and commands when they haven't changed since the last start
+    FAST_STARTUP: bool = env.bool("FAST_STARTUP", True)
+    LAZY_IMPORTS: bool = env.bool("LAZY_IMPORTS", True)
     DEBUG: bool = env.bool("DEBUG", False)
-    LOG_LEVEL: int = DEBUG_LEVEL if DEBUG else INFO
+    # A level name like "warning", follows DEBUG when unset
+    LOG_LEVEL: int = env.log_level("LOG_LEVEL", DEBUG_LEVEL if DEBUG else INFO)
 
     BOT_TOKEN: str = env.str("TELEGRAM_TOKEN")
+    # The token and method are appended to this, the benchmarks point it at a local stand-in
+    TELEGRAM_API_URL: str = env.str("TELEGRAM_API_URL", "https://api.telegram.org/bot")
     SECRET_TOKEN: str = env.str("SECRET_TOKEN")
 
     BOT_WEB_URL: str = env.str("BOT_WEB_URL")
     HEALTH_URL: str= env.str("HEALTH_URL", "/health/")
+    METRICS_URL: str = env.str("METRICS_URL", "/metrics/")
+    # When set, scrapers have to send it as a bearer token
+    METRICS_TOKEN: str = env.str("METRICS_TOKEN", "")
     WEBHOOK_URL: str = env.str("WEBHOOK_URL", "/webhook/")
 
     LOG_CHAT_IDS: list[int] = [ int(i.strip()) for i in env.list("LOG_CHAT_IDS", []) ]
     DEVELOPER_CHAT_IDS: list[int] = [ int(i.strip()) for i in env.list("DEVELOPER_CHAT_IDS", []) ]
 
+    # The /profile command of the developer chats samples the event loop stack every interval seconds
+    PROFILE_INTERVAL: float = env.float("PROFILE_INTERVAL", 0.005)
+    # Stretches the event loop spends without polling for I/O longer than this are reported as slow callbacks
+    PROFILE_SLOW_CALLBACK: float = env.float("PROFILE_SLOW_CALLBACK", 0.1)
+    PROFILE_SECONDS: float = env.float("PROFILE_SECONDS", 30)
+    PROFILE_MAX_SECONDS: float = env.float("PROFILE_MAX_SECONDS", 300)
+
     MIN_MESSAGE_LENGTH: int = MessageLimit.MIN_TEXT_LENGTH
     MAX_MESSAGE_LENGTH: int = MessageLimit.MAX_TEXT_LENGTH
     ALLOWED_TAGS = [ "a", "b", "code", "i", "pre" ]
 
+    UPDATE_QUEUE_SIZE: int = env.int("UPDATE_QUEUE_SIZE", 1000)
+    UPDATE_DEDUP_WINDOW: int = env.int("UPDATE_DEDUP_WINDOW", 10000)
+    WEBHOOK_RETRY_AFTER: int = env.int("WEBHOOK_RETRY_AFTER", 1)
+    UPDATE_CONCURRENCY: int = env.int("UPDATE_CONCURRENCY", 32)
+
+    # Telegram allows about 30 messages per second overall, one per second in a chat and 20 per minute in a group
+    SEND_GLOBAL_RATE: float = env.float("SEND_GLOBAL_RATE", 30)
+    SEND_CHAT_RATE: float = env.float("SEND_CHAT_RATE", 1)
+    SEND_GROUP_RATE: float = env.float("SEND_GROUP_RATE", 20 / 60)
+    SEND_CHAT_BURST: float = env.float("SEND_CHAT_BURST", 3)
+    SEND_CHAT_BUCKETS: int = env.int("SEND_CHAT_BUCKETS", 10000)
+    SEND_MAX_RETRIES: int = env.int("SEND_MAX_RETRIES", 3)
+
+    ERROR_REPORT_WINDOW: float = env.float("ERROR_REPORT_WINDOW", 60)
+    ERROR_REPORT_MAX: int = env.int("ERROR_REPORT_MAX", 20)
+
+    DEXSCREENER_URL: str = env.str("DEXSCREENER_URL", "https://api.dexscreener.com")
+    # DexScreener allows 300 requests a minute to the pairs, search and tokens endpoints
+    UPSTREAM_RATE_LIMIT: float = env.float("UPSTREAM_RATE_LIMIT", 300)
+    UPSTREAM_BURST: float = env.float("UPSTREAM_BURST", 10)
+    UPSTREAM_CONCURRENCY: int = env.int("UPSTREAM_CONCURRENCY", 16)
+    UPSTREAM_TIMEOUT: float = env.float("UPSTREAM_TIMEOUT", 10)
+    UPSTREAM_RETRIES: int = env.int("UPSTREAM_RETRIES", 3)
+    UPSTREAM_BACKOFF: float = env.float("UPSTREAM_BACKOFF", 0.5)
+
+    SEARCH_CACHE_SIZE: int = env.int("SEARCH_CACHE_SIZE", 512)
+    SEARCH_CACHE_TTL: float = env.float("SEARCH_CACHE_TTL", 60)
+    TOP_RESULTS: int = env.int("TOP_RESULTS", 10)
+    RENDER_CACHE_SIZE: int = env.int("RENDER_CACHE_SIZE", 2048)
+    PAIR_CACHE_SIZE: int = env.int("PAIR_CACHE_SIZE", 1024)
+    PAIR_CACHE_TTL: float = env.float("PAIR_CACHE_TTL", 10)
+    PAIR_LIST_PAGE_SIZE: int = env.int("PAIR_LIST_PAGE_SIZE", 10)
+    PAIR_LIST_MAX: int = env.int("PAIR_LIST_MAX", 90)
+    CALLBACK_CACHE_SIZE: int = env.int("CALLBACK_CACHE_SIZE", 10000)
+    # Saved texts of long buttons are deleted this long after they were last saved, older buttons stop working
+    CALLBACK_TEXT_TTL: float = env.float("CALLBACK_TEXT_TTL", 7 * 24 * 3600)
+
+    # Seconds an inline query waits for the user to stop typing before it is searched
+    INLINE_DEBOUNCE: float = env.float("INLINE_DEBOUNCE", 0.3)
+    INLINE_MIN_LENGTH: int = env.int("INLINE_MIN_LENGTH", 2)
+    # Results per inline answer, Telegram allows at most 50
+    INLINE_RESULTS: int = env.int("INLINE_RESULTS", 10)
+    # Seconds Telegram may reuse an inline answer for the same query without asking again
+    INLINE_CACHE_TIME: int = env.int("INLINE_CACHE_TIME", 30)
+    # Prefetches which may reach DexScreener are limited per user, rendering what is already cached is free
+    PREFETCH_ENABLED: bool = env.bool("PREFETCH_ENABLED", True)
+    PREFETCH_RATE: float = env.float("PREFETCH_RATE", 6)
+    PREFETCH_BURST: float = env.float("PREFETCH_BURST", 2)
+    PREFETCH_MAX_TASKS: int = env.int("PREFETCH_MAX_TASKS", 256)
+    PREFETCH_BUDGETS: int = env.int("PREFETCH_BUDGETS", 10000)
+
+    INDEX_ENABLED: bool = env.bool("INDEX_ENABLED", True)
+    INDEX_MAX_PAIRS: int = env.int("INDEX_MAX_PAIRS", 20000)
+    # Searches of a query before it is answered from the token index
+    INDEX_POPULAR_HITS: int = env.int("INDEX_POPULAR_HITS", 3)
+    # Seconds the pairs a search returned stand in for searching again
+    INDEX_QUERY_TTL: float = env.float("INDEX_QUERY_TTL", 3600)
+    # Indexed prices older than this aren't served, the refresh keeps popular pairs younger than half of it
+    INDEX_MAX_AGE: float = env.float("INDEX_MAX_AGE", 60)
+    INDEX_REFRESH_INTERVAL: float = env.float("INDEX_REFRESH_INTERVAL", 20)
+    # Most DexScreener requests one refresh makes
+    INDEX_REFRESH_REQUESTS: int = env.int("INDEX_REFRESH_REQUESTS", 10)
+    # Popular queries nobody asked for in this many seconds aren't refreshed any more
+    INDEX_ACTIVE_PERIOD: float = env.float("INDEX_ACTIVE_PERIOD", 600)
+    INDEX_FLUSH_INTERVAL: float = env.float("INDEX_FLUSH_INTERVAL", 5)
+    # Saved pairs and queries which weren't updated or used for this many seconds are deleted on startup
+    INDEX_RETENTION: float = env.float("INDEX_RETENTION", 7 * 86400)
+
+    WATCH_INTERVAL: float = env.float("WATCH_INTERVAL", 30)
+    WATCH_MAX_PER_USER: int = env.int("WATCH_MAX_PER_USER", 20)
+
+    USER_CACHE_SIZE: int = env.int("USER_CACHE_SIZE", 10000)
+    STORAGE_WRITE_BEHIND: bool = env.bool("STORAGE_WRITE_BEHIND", True)
+    STORAGE_FLUSH_INTERVAL: float = env.float("STORAGE_FLUSH_INTERVAL", 1)
+    STORAGE_FLUSH_SIZE: int = env.int("STORAGE_FLUSH_SIZE", 500)
+    # With several workers, cached user rows changed by another worker are refreshed this often
+    STORAGE_SYNC_INTERVAL: float = env.float("STORAGE_SYNC_INTERVAL", 0.5)
+    # Bytes of the database file SQLite reads through a memory map
+    STORAGE_MMAP_SIZE: int = env.int("STORAGE_MMAP_SIZE", 256 * 1024 * 1024)
+
+    # Upstream responses are kept in the database, so every worker can use them and they survive restarts
+    RESPONSE_CACHE: bool = env.bool("RESPONSE_CACHE", True)
+    RESPONSE_PURGE_INTERVAL: float = env.float("RESPONSE_PURGE_INTERVAL", 300)
+    # Expired responses are kept this long, to be served while the cache warms up after a restart or when DexScreener fails.
+    # Replies don't say their prices are old, so this stays short
+    RESPONSE_STALE_TTL: float = env.float("RESPONSE_STALE_TTL", 300)
+    RESPONSE_WARM_PERIOD: float = env.float("RESPONSE_WARM_PERIOD", 60)
+
 
 
 
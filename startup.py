@@ -0,0 +1,74 @@
+"""Helpers for a fast cold start: deferred imports, registration fingerprints and a report of where boot time goes"""
+
+import sys
+from json import dumps
+from hashlib import sha256
+from time import perf_counter
+from types import ModuleType
+from contextlib import contextmanager
+from importlib.util import LazyLoader, find_spec, module_from_spec
+
+from settings import get_settings, get_logger
+
+
+settings = get_settings()
+logger = get_logger(__name__)
+
+
+
+def lazy_import(name: str) -> ModuleType:
+    """Returns a module which is only executed when one of its attributes is first used"""
+    module = sys.modules.get(name)
+    if module is not None or not settings.LAZY_IMPORTS:
+        return module or __import__(name)
+
+    spec = find_spec(name)
+    loader = LazyLoader(spec.loader)
+    spec.loader = loader
+    module = module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    return module
+
+
+def fingerprint(*values) -> str:
+    """Hashes values which are registered with Telegram, secrets are never stored as they are"""
+    return sha256(dumps(values, sort_keys = True, default = str).encode()).hexdigest()
+
+
+
+class StartupTimer:
+    """Records how long each stage of the boot takes"""
+
+    def __init__(self) -> None:
+        self.started = perf_counter()
+        self.last = self.started
+        self.stages: list[tuple[str, float]] = []
+
+    def mark(self, name: str) -> None:
+        """Records the time since the last mark or stage as one stage"""
+        now = perf_counter()
+        self.stages.append((name, now - self.last))
+        self.last = now
+
+    @contextmanager
+    def stage(self, name: str):
+        started = perf_counter()
+        try:
+            yield
+        finally:
+            self.last = perf_counter()
+            self.stages.append((name, self.last - started))
+
+
+    def report(self) -> str:
+        total = perf_counter() - self.started
+        stages = ", ".join(f"{name} {seconds * 1000:.0f}ms" for name, seconds in self.stages)
+        return f"Started in {total * 1000:.0f}ms: {stages}"
+
+
+
+timer = StartupTimer()
+
+def get_startup_timer() -> StartupTimer:
+    return timer
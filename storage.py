@@ -1,31 +1,155 @@
+from os import getpid
 from enum import StrEnum
-from sqlite3 import connect
-
+from time import monotonic, time
+from sqlite3 import Connection, Cursor, connect
+from socket import gethostname
+from functools import partial
+from asyncio import Lock, Task, create_task, get_running_loop, sleep
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import LRUCache, MISSING
+from metrics import get_metrics
 from settings import get_settings, get_logger
 
 
 settings = get_settings()
+metrics = get_metrics()
 logger = get_logger(__name__)
-connection = connect(settings.DB_PATH)
-cursor = connection.cursor()
+operation_seconds = metrics.histogram("storage_operation_seconds", "Time each storage function spent on the storage thread", ("operation",))
+queue_seconds = metrics.histogram("storage_queue_seconds", "Time storage functions waited for the storage thread")
+# All database work after setup runs on this single thread, so the connection is never used concurrently
+executor = ThreadPoolExecutor(max_workers = 1, thread_name_prefix = "storage")
+# Opened by Storage.start on the storage thread, so importing this module doesn't touch the database
+connection: Connection | None = None
+cursor: Cursor | None = None
+# Identifies this process in leases shared with the other workers
+worker_id = f"{gethostname()}:{getpid()}"
 
 
 
 class DatabaseTables(StrEnum):
     USERS = "users"
+    WATCHES = "watches"
+    RESPONSES = "responses"
+    LEASES = "leases"
+    CALLBACK_TEXTS = "callback_texts"
+    STAMPS = "stamps"
+    TOKEN_PAIRS = "token_pairs"
+    TOKEN_QUERIES = "token_queries"
+
+
+
+class Record:
+    """A cached table row for one user, columns are kept in slots instead of a dict to keep each cached user small"""
+    __slots__ = ()
+
+    def __init__(self, **values) -> None:
+        for key in self.__slots__:
+            setattr(self, key, values.get(key))
+
+    def __getitem__(self, key: str):
+        return getattr(self, key)
+
+    def __setitem__(self, key: str, value) -> None:
+        setattr(self, key, value)
+
+    def update(self, changes: dict) -> None:
+        for key, value in changes.items():
+            setattr(self, key, value)
+
+    def to_dict(self) -> dict:
+        return { key: getattr(self, key) for key in self.__slots__ }
+
+
+
+class UserRecord(Record):
+    __slots__ = ("query_pair", "query_search", "version")
 
 
 
 class Storage:
     """This class defines functions for storing and retrieving user data"""
-    data_cache = {}
+    # Records keyed by (table, user id), least recently used users are dropped and reloaded from the database when needed
+    data_cache = LRUCache(settings.USER_CACHE_SIZE)
     column_names: dict = {}
+    # Tables with one row per user, which are cached as records. Other tables are only read through their own methods
+    record_types: dict[str, type[Record]] = { DatabaseTables.USERS: UserRecord }
+    # Columns added after a table was first released, they are added to existing databases on startup
+    added_columns: dict[str, dict[str, str]] = {
+        DatabaseTables.USERS: { "version": "INTEGER NOT NULL DEFAULT 0" },
+        DatabaseTables.CALLBACK_TEXTS: { "created": "REAL NOT NULL DEFAULT 0" },
+    }
+    # Buffering writes would hide them from the other workers, so write-behind is only used with a single worker
+    write_behind: bool = settings.STORAGE_WRITE_BEHIND and settings.WORKERS == 1
+    # Pending changes per (table, user id) in write-behind mode, waiting for the next flush
+    dirty: dict[tuple[str, int], dict] = {}
+    flushing: dict[tuple[str, int], dict] = {}
+    # One flush at a time, so the rows being flushed are always the ones in `flushing`
+    flush_lock = Lock()
+    flush_task: Task | None = None
+    # Highest row version seen per user table, rows written by other workers since then are synced into the cache
+    synced_versions: dict[str, int] = {}
+    sync_task: Task | None = None
+    purge_task: Task | None = None
+
+
+    @staticmethod
+    def open_connection() -> None:
+        global connection, cursor
+        # With several workers, write transactions take the database lock when they begin instead of failing when they upgrade to it
+        connection = connect(settings.DB_PATH, check_same_thread = False, isolation_level = "IMMEDIATE" if settings.WORKERS > 1 else "")
+        cursor = connection.cursor()
 
 
     @classmethod
     def setup_storage(cls):
+        # WAL lets readers in every worker carry on while one of them writes
+        cursor.execute("""PRAGMA journal_mode=WAL""")
+        cursor.execute("""PRAGMA synchronous=NORMAL""")
+        # Reads come straight from a memory map of the file instead of being copied through the page cache, which is
+        # what loading the token index at startup is made of
+        cursor.execute(f"""PRAGMA mmap_size={settings.STORAGE_MMAP_SIZE}""")
+
         sql = f"""CREATE TABLE IF NOT EXISTS {DatabaseTables.USERS} (user_id INTEGER PRIMARY KEY, query_pair TEXT, query_search TEXT)"""
         cursor.execute(sql)
+
+        sql = f"""CREATE TABLE IF NOT EXISTS {DatabaseTables.WATCHES} (watch_id INTEGER PRIMARY KEY AUTOINCREMENT, user_id INTEGER NOT NULL, chat_id INTEGER NOT NULL, chain TEXT NOT NULL, address TEXT NOT NULL, field TEXT NOT NULL, op TEXT NOT NULL, threshold REAL NOT NULL)"""
+        cursor.execute(sql)
+        cursor.execute(f"""CREATE INDEX IF NOT EXISTS {DatabaseTables.WATCHES}_user_id ON {DatabaseTables.WATCHES} (user_id)""")
+
+        sql = f"""CREATE TABLE IF NOT EXISTS {DatabaseTables.RESPONSES} (key TEXT PRIMARY KEY, body BLOB NOT NULL, expires REAL NOT NULL)"""
+        cursor.execute(sql)
+
+        sql = f"""CREATE TABLE IF NOT EXISTS {DatabaseTables.LEASES} (name TEXT PRIMARY KEY, owner TEXT NOT NULL, expires REAL NOT NULL)"""
+        cursor.execute(sql)
+
+        sql = f"""CREATE TABLE IF NOT EXISTS {DatabaseTables.CALLBACK_TEXTS} (short_id TEXT PRIMARY KEY, text TEXT NOT NULL, created REAL NOT NULL DEFAULT 0)"""
+        cursor.execute(sql)
+
+        sql = f"""CREATE TABLE IF NOT EXISTS {DatabaseTables.STAMPS} (name TEXT PRIMARY KEY, value TEXT NOT NULL)"""
+        cursor.execute(sql)
+
+        # Chains and pair addresses are lower case in the key, the address column keeps the case DexScreener uses
+        sql = f"""CREATE TABLE IF NOT EXISTS {DatabaseTables.TOKEN_PAIRS} (chain TEXT NOT NULL, pair_address TEXT NOT NULL, address TEXT NOT NULL, text TEXT NOT NULL, liquidity REAL NOT NULL, body BLOB NOT NULL, updated REAL NOT NULL, PRIMARY KEY (chain, pair_address))"""
+        cursor.execute(sql)
+        cursor.execute(f"""CREATE INDEX IF NOT EXISTS {DatabaseTables.TOKEN_PAIRS}_updated ON {DatabaseTables.TOKEN_PAIRS} (updated)""")
+
+        sql = f"""CREATE TABLE IF NOT EXISTS {DatabaseTables.TOKEN_QUERIES} (query TEXT PRIMARY KEY, pairs TEXT NOT NULL, searched REAL NOT NULL, used REAL NOT NULL, hits INTEGER NOT NULL)"""
+        cursor.execute(sql)
+
+        for tablename, columns in cls.added_columns.items():
+            existing = { i[1] for i in cursor.execute(f"""PRAGMA table_info({tablename})""").fetchall() }
+            for column, column_type in columns.items():
+                if column not in existing:
+                    cursor.execute(f"""ALTER TABLE {tablename} ADD COLUMN {column} {column_type}""")
+
+        # Texts saved before they had a timestamp are kept for a full period from now
+        cursor.execute(f"""UPDATE {DatabaseTables.CALLBACK_TEXTS} SET created=? WHERE created=0""", (time(),))
+        cursor.execute(f"""CREATE INDEX IF NOT EXISTS {DatabaseTables.CALLBACK_TEXTS}_created ON {DatabaseTables.CALLBACK_TEXTS} (created)""")
+
+        for tablename in cls.record_types:
+            cursor.execute(f"""CREATE INDEX IF NOT EXISTS {tablename}_version ON {tablename} (version)""")
+            cls.synced_versions[tablename] = cursor.execute(f"""SELECT coalesce(max(version), 0) FROM {tablename}""").fetchone()[0]
         connection.commit()
 
         # Generate tuple of column names for each table, used for setting their values in the cache
@@ -34,64 +158,370 @@ class Storage:
 
 
     @classmethod
-    def setup_user_data(cls, user_id: int):
-        """Setup user data in database and cache"""
-        sql = f"""INSERT OR IGNORE INTO {DatabaseTables.USERS} (user_id) VALUES (?)"""
-        cursor.execute(sql, (user_id,))
-        connection.commit()
-
-        user_data = {}
-        for table in DatabaseTables:
-            tablename = table.value
+    def load_user_data(cls, user_id: int) -> dict[str, Record]:
+        """Creates the user's rows if they don't exist yet and returns them as records, without touching the cache"""
+        records = {}
+        for tablename in cls.record_types:
 
             # Insert an entry for the user in the table
-            user_data[tablename] = {}
             sql = f"""INSERT OR IGNORE INTO {tablename} (user_id) VALUES (?)"""
-
             cursor.execute(sql, (user_id,))
-            connection.commit()
 
-            # Iterate over the column name and column value and set them in the cache, ignoring the user_id which is indexed at 0
-            for key, value in zip(cls.column_names[tablename][1:], cursor.execute(f"""SELECT * FROM {tablename} WHERE user_id=?""", (user_id,)).fetchone()[1:] ):
-                user_data[tablename][key] = value
+            # Pair the column names with the column values, ignoring the user_id which is indexed at 0
+            row = cursor.execute(f"""SELECT * FROM {tablename} WHERE user_id=?""", (user_id,)).fetchone()
+            records[tablename] = cls.record_types[tablename](**dict(zip(cls.column_names[tablename][1:], row[1:])))
+
+        # One commit for every table the user was added to
+        connection.commit()
+        return records
+
+
+    @classmethod
+    def cache_user_data(cls, user_id: int, records: dict[str, Record]) -> None:
+        for tablename, record in records.items():
+            # Changes which haven't reached the database yet are newer than what was just loaded
+            record.update(cls.flushing.get((tablename, user_id), {}))
+            record.update(cls.dirty.get((tablename, user_id), {}))
+            cls.data_cache.set((tablename, user_id), record)
+
+
+    @classmethod
+    def write_user_data(cls, user_id: int, tablename: str, changes: dict) -> dict[tuple[str, int], int]:
+        """Writes and commits one user's changes without touching the cache, returns the row's new version"""
+        versions = cls.write_rows({ (tablename, user_id): changes })
+        connection.commit()
+        return versions
+
+
+    @classmethod
+    def add_watch(cls, user_id: int, chat_id: int, chain: str, address: str, field: str, op: str, threshold: float) -> int:
+        """Saves a watch and returns its id"""
+        sql = f"""INSERT INTO {DatabaseTables.WATCHES} (user_id, chat_id, chain, address, field, op, threshold) VALUES (?, ?, ?, ?, ?, ?, ?)"""
+        cursor.execute(sql, (user_id, chat_id, chain, address, field, op, threshold))
+        connection.commit()
+        return cursor.lastrowid
+
+
+    @classmethod
+    def delete_watches(cls, user_id: int, watch_id: int | None = None) -> list[int]:
+        """Deletes one of the user's watches, or all of them if no id is given, and returns the deleted ids"""
+        condition, args = ("""user_id=?""", (user_id,)) if watch_id is None else ("""user_id=? AND watch_id=?""", (user_id, watch_id))
+        deleted = [ i[0] for i in cursor.execute(f"""SELECT watch_id FROM {DatabaseTables.WATCHES} WHERE {condition}""", args).fetchall() ]
+        cursor.execute(f"""DELETE FROM {DatabaseTables.WATCHES} WHERE {condition}""", args)
+        connection.commit()
+        return deleted
+
+
+    @classmethod
+    def get_watches(cls, user_id: int | None = None) -> list[dict]:
+        """Returns the watches of a user, or every watch if no user is given"""
+        sql = f"""SELECT * FROM {DatabaseTables.WATCHES}""" + (""" WHERE user_id=?""" if user_id is not None else "")
+        rows = cursor.execute(sql, (user_id,) if user_id is not None else ()).fetchall()
+        return [ dict(zip(cls.column_names[DatabaseTables.WATCHES], row)) for row in rows ]
+
+
+    @classmethod
+    def get_response(cls, key: str) -> tuple[bytes, float] | None:
+        """Returns a cached upstream response body and when it expires, expired bodies are returned until they are too stale"""
+        sql = f"""SELECT body, expires FROM {DatabaseTables.RESPONSES} WHERE key=? AND expires>?"""
+        return cursor.execute(sql, (key, time() - settings.RESPONSE_STALE_TTL)).fetchone()
+
+
+    @classmethod
+    def set_response(cls, key: str, body: bytes, ttl: float) -> None:
+        sql = f"""INSERT OR REPLACE INTO {DatabaseTables.RESPONSES} (key, body, expires) VALUES (?, ?, ?)"""
+        cursor.execute(sql, (key, body, time() + ttl))
+        connection.commit()
+
+
+    @classmethod
+    def purge_responses(cls) -> int:
+        """Deletes responses which are too stale to be served and returns how many there were"""
+        cursor.execute(f"""DELETE FROM {DatabaseTables.RESPONSES} WHERE expires<=?""", (time() - settings.RESPONSE_STALE_TTL,))
+        connection.commit()
+        return cursor.rowcount
+
+
+    @classmethod
+    def save_callback_text(cls, short_id: str, text: str) -> None:
+        """Saves text referred to by keyboard buttons, short ids are derived from the text so saving again only renews it"""
+        sql = f"""INSERT INTO {DatabaseTables.CALLBACK_TEXTS} (short_id, text, created) VALUES (?, ?, ?) ON CONFLICT (short_id) DO UPDATE SET created=excluded.created"""
+        cursor.execute(sql, (short_id, text, time()))
+        connection.commit()
+
 
+    @classmethod
+    def load_callback_text(cls, short_id: str) -> tuple[str, float] | None:
+        """Returns a saved text and when it was last saved"""
+        return cursor.execute(f"""SELECT text, created FROM {DatabaseTables.CALLBACK_TEXTS} WHERE short_id=?""", (short_id,)).fetchone()
 
-        cls.data_cache[user_id] = user_data
 
+    @classmethod
+    def purge_callback_texts(cls) -> int:
+        """Deletes texts which weren't saved again within their time to live and returns how many there were"""
+        cursor.execute(f"""DELETE FROM {DatabaseTables.CALLBACK_TEXTS} WHERE created<=?""", (time() - settings.CALLBACK_TEXT_TTL,))
+        connection.commit()
+        return cursor.rowcount
 
 
     @classmethod
-    def get_user_data(cls, user_id: int, tablename: str) -> dict:
-        """Setup user data if not in cache and get requested table from cache"""
-        if user_id not in cls.data_cache:
-            cls.setup_user_data(user_id)
+    def get_stamp(cls, name: str) -> str | None:
+        row = cursor.execute(f"""SELECT value FROM {DatabaseTables.STAMPS} WHERE name=?""", (name,)).fetchone()
+        return row[0] if row else None
 
-        user_data = cls.data_cache[user_id]
-        assert tablename in user_data, f"{tablename} not a valid user data table"
 
-        table = user_data[tablename]
-        return table
+    @classmethod
+    def set_stamp(cls, name: str, value: str) -> None:
+        """Remembers a value between starts, like the fingerprint of what was last registered with Telegram"""
+        cursor.execute(f"""INSERT OR REPLACE INTO {DatabaseTables.STAMPS} (name, value) VALUES (?, ?)""", (name, value))
+        connection.commit()
+
+
+    @classmethod
+    def save_token_index(cls, pairs: list[tuple], queries: list[tuple], removed: list[tuple[str, str]]) -> None:
+        """Saves changed pairs and queries of the token index and deletes the pairs it dropped"""
+        sql = f"""INSERT OR REPLACE INTO {DatabaseTables.TOKEN_PAIRS} (chain, pair_address, address, text, liquidity, body, updated) VALUES (?, ?, ?, ?, ?, ?, ?)"""
+        cursor.executemany(sql, pairs)
+        sql = f"""INSERT OR REPLACE INTO {DatabaseTables.TOKEN_QUERIES} (query, pairs, searched, used, hits) VALUES (?, ?, ?, ?, ?)"""
+        cursor.executemany(sql, queries)
+        cursor.executemany(f"""DELETE FROM {DatabaseTables.TOKEN_PAIRS} WHERE chain=? AND pair_address=?""", removed)
+        connection.commit()
 
 
     @classmethod
-    def set_user_data(cls, user_id: int, tablename: str, **changes) -> None:
-        """Command to set column values using keyword arguments in the database and cache"""
-        if user_id not in cls.data_cache:
-            cls.setup_user_data(user_id)
+    def load_token_index(cls, since: float, limit: int) -> tuple[list[tuple], list[tuple]]:
+        """Deletes what the token index hasn't updated or used since a time and returns the rest, the newest pairs first"""
+        cursor.execute(f"""DELETE FROM {DatabaseTables.TOKEN_PAIRS} WHERE updated<?""", (since,))
+        cursor.execute(f"""DELETE FROM {DatabaseTables.TOKEN_QUERIES} WHERE used<?""", (since,))
+        connection.commit()
+
+        sql = f"""SELECT chain, pair_address, address, text, liquidity, body, updated FROM {DatabaseTables.TOKEN_PAIRS} ORDER BY updated DESC LIMIT ?"""
+        pairs = cursor.execute(sql, (limit,)).fetchall()
+        queries = cursor.execute(f"""SELECT query, pairs, searched, used, hits FROM {DatabaseTables.TOKEN_QUERIES}""").fetchall()
+        return pairs, queries
 
-        user_data = cls.data_cache[user_id]
-        assert tablename in user_data, f"{tablename} not a valid user data table"
 
-        changes_string =  ", ".join(f"""{key}={changes[key]}""" for key in changes)
-        sql = f"""UPDATE {tablename} SET {changes_string} WHERE user_id=?"""
+    @classmethod
+    def load_token_index_changes(cls, since: float) -> tuple[list[tuple], list[tuple]]:
+        """Returns the saved pairs updated and the queries used since a time, by this worker or any other"""
+        sql = f"""SELECT chain, pair_address, address, text, liquidity, body, updated FROM {DatabaseTables.TOKEN_PAIRS} WHERE updated>?"""
+        pairs = cursor.execute(sql, (since,)).fetchall()
+        queries = cursor.execute(f"""SELECT query, pairs, searched, used, hits FROM {DatabaseTables.TOKEN_QUERIES} WHERE used>?""", (since,)).fetchall()
+        return pairs, queries
+
 
-        cursor.execute(sql, (user_id,))
+    @classmethod
+    def acquire_lease(cls, name: str, ttl: float) -> bool:
+        """Takes or renews a named lease for this worker, False while another worker holds it"""
+        now = time()
+        sql = f"""INSERT INTO {DatabaseTables.LEASES} (name, owner, expires) VALUES (?, ?, ?)
+            ON CONFLICT (name) DO UPDATE SET owner=excluded.owner, expires=excluded.expires WHERE owner=excluded.owner OR expires<=?"""
+        cursor.execute(sql, (name, worker_id, now + ttl, now))
         connection.commit()
+        return cursor.rowcount == 1
+
 
-        for key in changes:
-            user_data[tablename][key] = changes[key]
+    @classmethod
+    def load_changes(cls) -> dict[str, list[dict]]:
+        """Returns the user rows written since the last sync, by this worker or any other"""
+        changes = {}
+        for tablename in cls.record_types:
+            sql = f"""SELECT * FROM {tablename} WHERE version>? ORDER BY version"""
+            rows = cursor.execute(sql, (cls.synced_versions[tablename],)).fetchall()
+            changes[tablename] = [ dict(zip(cls.column_names[tablename], row)) for row in rows ]
+            if rows:
+                cls.synced_versions[tablename] = changes[tablename][-1]["version"]
+        return changes
 
-        cls.data_cache[user_id] = user_data
+
+    @classmethod
+    def stats(cls) -> dict:
+        """Returns the size and hit/miss counters of the user cache"""
+        stats = cls.data_cache.stats()
+        stats["dirty"] = len(cls.dirty)
+        return stats
+
+
+    @classmethod
+    def write_rows(cls, rows: dict[tuple[str, int], dict]) -> dict[tuple[str, int], int]:
+        """Runs the updates for the given rows without committing them, returns the version each row was given"""
+        versions = {}
+        for (tablename, user_id), changes in rows.items():
+            for key in changes:
+                assert key in cls.column_names[tablename], f"{key} not a valid column of {tablename}"
+
+            # Each write gets the next version of the table, so other workers can find the rows changed since they last looked
+            changes_string = ", ".join(f"""{key}=?""" for key in changes)
+            sql = f"""UPDATE {tablename} SET {changes_string}, version=(SELECT coalesce(max(version), 0) + 1 FROM {tablename}) WHERE user_id=? RETURNING version"""
+            row = cursor.execute(sql, (*changes.values(), user_id)).fetchone()
+            if row is not None:
+                versions[(tablename, user_id)] = row[0]
+        return versions
+
+
+    @classmethod
+    def flush_rows(cls, rows: dict[tuple[str, int], dict]) -> dict[tuple[str, int], int]:
+        """Writes a batch of dirty rows in a single transaction and returns their new versions"""
+        try:
+            versions = cls.write_rows(rows)
+            connection.commit()
+        except Exception:
+            connection.rollback()
+            raise
+        return versions
+
+
+    @classmethod
+    def set_versions(cls, versions: dict[tuple[str, int], int]) -> None:
+        """Moves cached records to the versions they were written as, so syncing doesn't take them for older rows"""
+        for key, version in versions.items():
+            record = cls.data_cache.get(key, record = False)
+            if record is not MISSING and (record.version or 0) < version:
+                record.version = version
+
+
+    # Async API, used by the bot handlers so sqlite never blocks the event loop
+
+    @classmethod
+    async def run(cls, function, *args, **kwargs):
+        """Runs a blocking storage function on the storage thread and waits for the result"""
+        return await get_running_loop().run_in_executor(executor, partial(cls.timed, monotonic(), function, args, kwargs))
+
+
+    @staticmethod
+    def timed(queued: float, function, args: tuple, kwargs: dict):
+        started = monotonic()
+        queue_seconds.observe(started - queued)
+        try:
+            return function(*args, **kwargs)
+        finally:
+            operation_seconds.observe(monotonic() - started, function.__name__)
+
+
+    @classmethod
+    async def get_user_data_async(cls, user_id: int, tablename: str) -> Record:
+        """Returns a cached record of the user's row, only touches the storage thread if the user isn't cached"""
+        assert tablename in cls.record_types, f"{tablename} not a valid user data table"
+
+        record = cls.data_cache.get((tablename, user_id))
+        if record is MISSING:
+            # The cache is only changed on the event loop, the storage thread just reads and writes the rows
+            cls.cache_user_data(user_id, await cls.run(cls.load_user_data, user_id))
+            record = cls.data_cache.get((tablename, user_id), record = False)
+
+        return record
+
+
+    @classmethod
+    async def set_user_data_async(cls, user_id: int, tablename: str, **changes) -> None:
+        """Sets column values using keyword arguments in the database and cache, in write-behind mode the change is only cached and queued for the next flush"""
+        user_data = await cls.get_user_data_async(user_id, tablename)
+        if not cls.write_behind:
+            versions = await cls.run(cls.write_user_data, user_id, tablename, changes)
+            user_data.update(changes)
+            cls.set_versions(versions)
+            return
+
+        user_data.update(changes)
+        cls.dirty.setdefault((tablename, user_id), {}).update(changes)
+
+        if len(cls.dirty) >= settings.STORAGE_FLUSH_SIZE:
+            await cls.flush()
+
+
+    @classmethod
+    async def flush(cls) -> None:
+        """Writes every pending change to the database in one transaction, waiting for a flush already running"""
+        async with cls.flush_lock:
+            if not cls.dirty:
+                return
+
+            rows, cls.dirty = cls.dirty, {}
+            cls.flushing = rows
+            try:
+                cls.set_versions(await cls.run(cls.flush_rows, rows))
+            except Exception:
+                # Put the rows back without overwriting anything that changed since, they are retried on the next flush
+                for key, changes in rows.items():
+                    cls.dirty[key] = changes | cls.dirty.get(key, {})
+                logger.exception(f"Failed to flush {len(rows)} user rows")
+            finally:
+                cls.flushing = {}
+
+
+    @classmethod
+    async def flush_periodically(cls) -> None:
+        while True:
+            await sleep(settings.STORAGE_FLUSH_INTERVAL)
+            await cls.flush()
+
+
+    @classmethod
+    async def sync(cls) -> None:
+        """Refreshes cached records whose rows another worker changed, users which aren't cached are loaded when needed.
+        This worker's own writes are skipped by their version, and users with unflushed changes are left as they are."""
+        changes = await cls.run(cls.load_changes)
+        for tablename, rows in changes.items():
+            for row in rows:
+                user_id = row.pop("user_id")
+                if (tablename, user_id) in cls.dirty or (tablename, user_id) in cls.flushing:
+                    continue
+                record = cls.data_cache.get((tablename, user_id), record = False)
+                if record is not MISSING and (record.version or 0) < row["version"]:
+                    record.update(row)
+
+
+    @classmethod
+    async def sync_periodically(cls) -> None:
+        while True:
+            await sleep(settings.STORAGE_SYNC_INTERVAL)
+            try:
+                await cls.sync()
+            except Exception:
+                logger.exception("Failed to sync user rows from the database")
+
+
+    @classmethod
+    async def purge_periodically(cls) -> None:
+        while True:
+            await sleep(settings.RESPONSE_PURGE_INTERVAL)
+            try:
+                if settings.RESPONSE_CACHE:
+                    purged = await cls.run(cls.purge_responses)
+                    logger.debug(f"Purged {purged} stale upstream responses")
+                purged = await cls.run(cls.purge_callback_texts)
+                logger.debug(f"Purged {purged} expired callback texts")
+            except Exception:
+                logger.exception("Failed to purge stale upstream responses and callback texts")
+
+
+    @classmethod
+    async def start(cls) -> None:
+        """Sets up the tables and starts the background flush task used in write-behind mode, the sync task when running several workers and the purge task"""
+        # Done on startup instead of on import, on the storage thread
+        await cls.run(cls.open_connection)
+        await cls.run(cls.setup_storage)
+
+        if cls.write_behind and cls.flush_task is None:
+            cls.flush_task = create_task(cls.flush_periodically())
+        if settings.WORKERS > 1 and cls.sync_task is None:
+            cls.sync_task = create_task(cls.sync_periodically())
+        if cls.purge_task is None:
+            cls.purge_task = create_task(cls.purge_periodically())
+
+
+    @classmethod
+    async def close(cls) -> None:
+        """Stops the flush task and writes any pending changes, called when the app shuts down or failed to start"""
+        for task in (cls.flush_task, cls.sync_task, cls.purge_task):
+            if task is not None:
+                task.cancel()
+        cls.flush_task = cls.sync_task = cls.purge_task = None
+
+        if connection is not None:
+            await cls.flush()
+            await cls.run(connection.close)
+        executor.shutdown()
 
 
 
@@ -99,5 +529,3 @@ def get_storage() -> Storage:
     return Storage()
 
 
-get_storage().setup_storage()
-